@@ -0,0 +1,83 @@
+import hmac
+import os
+import secrets
+import tempfile
+
+from fastapi import Depends, Header, HTTPException
+
+# Credentials for calls between our own services (proxy registration,
+# replication, key operations made on a user's behalf) and for admin
+# endpoints. Set SERVICE_TOKEN in a real deployment; otherwise every process
+# on the host shares a token generated into a file at the project root, the
+# same way they share the local store.
+TOKEN_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '.service_token'))
+TOKEN_HEADER = "X-Service-Token"
+# The user a service call acts for. Only trusted alongside a valid token: the
+# caller (the gateway) has already authenticated that user.
+USER_HEADER = "X-User-Id"
+ADMIN_HEADER = "X-Admin-Token"
+
+_token = None
+
+def _shared_token() -> str:
+    try:
+        with open(TOKEN_PATH) as f:
+            token = f.read().strip()
+        if token:
+            return token
+    except FileNotFoundError:
+        pass
+    # Write it beside the target and link it in, so concurrent first starts
+    # agree on one token and nobody reads a half-written file
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(TOKEN_PATH), prefix=".service_token.")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(secrets.token_urlsafe(32))
+        try:
+            os.link(tmp, TOKEN_PATH)
+        except FileExistsError:
+            pass # Another process won
+    finally:
+        os.unlink(tmp)
+    with open(TOKEN_PATH) as f:
+        return f.read().strip()
+
+def service_token() -> str:
+    global _token
+    if _token is None:
+        _token = os.environ.get("SERVICE_TOKEN") or _shared_token()
+    return _token
+
+def admin_token() -> str:
+    return os.environ.get("ADMIN_TOKEN") or service_token()
+
+def service_headers(user_id: str = None) -> dict:
+    """
+    Headers for a call to another service, optionally on behalf of `user_id`.
+    """
+    headers = {TOKEN_HEADER: service_token()}
+    if user_id is not None:
+        headers[USER_HEADER] = user_id
+    return headers
+
+def admin_headers() -> dict:
+    return {ADMIN_HEADER: admin_token()}
+
+def _matches(given, expected: str) -> bool:
+    return given is not None and hmac.compare_digest(given.encode(), expected.encode())
+
+def require_service(x_service_token: str = Header(None)):
+    if not _matches(x_service_token, service_token()):
+        raise HTTPException(status_code=401, detail="Service token required")
+
+def require_admin(x_admin_token: str = Header(None)):
+    if not _matches(x_admin_token, admin_token()):
+        raise HTTPException(status_code=401, detail="Admin token required")
+
+def caller(x_user_id: str = Header(None), _: None = Depends(require_service)) -> str:
+    """
+    The user a service call was made for.
+    """
+    if not x_user_id:
+        raise HTTPException(status_code=401, detail="Missing X-User-Id header")
+    return x_user_id
@@ -0,0 +1,191 @@
+import contextvars
+import time
+
+# Per-request deadlines. The gateway gives each request a time budget; every
+# hop receives what is left of it in the X-Deadline-Ms header (milliseconds
+# remaining, so hosts don't need synchronized clocks), and every outgoing
+# requests/httpx call has its timeout clamped to the remaining budget and
+# forwards the header again.
+HEADER = "x-deadline-ms"
+# Budget at least this small is treated as already expired
+MIN_BUDGET = 0.005
+
+class _Deadline:
+    # Mutable so the middleware can lift it once the response is sent, which
+    # also reaches contexts copied from the request (background tasks)
+    __slots__ = ("at",)
+
+    def __init__(self, at: float):
+        self.at = at
+
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+class DeadlineExceeded(Exception):
+    pass
+
+def remaining():
+    """
+    Seconds left for the current request, or None if it has no deadline.
+    """
+    deadline = _deadline.get()
+    if deadline is None or deadline.at is None:
+        return None
+    return deadline.at - time.monotonic()
+
+def expired() -> bool:
+    left = remaining()
+    return left is not None and left < MIN_BUDGET
+
+def timeout(default: float = None):
+    """
+    The timeout to use for a downstream call: `default` clamped to the budget.
+    """
+    left = remaining()
+    if left is None:
+        return default
+    if left < MIN_BUDGET:
+        raise DeadlineExceeded("Request deadline exceeded")
+    return left if default is None else min(default, left)
+
+def set_budget(seconds: float):
+    """
+    Starts (or tightens) the deadline for the current context. Returns a token for reset().
+    """
+    at = time.monotonic() + seconds
+    left = remaining()
+    if left is not None:
+        at = min(at, time.monotonic() + left)
+    return _deadline.set(_Deadline(at))
+
+def reset(token):
+    _deadline.reset(token)
+
+def inject(headers) -> None:
+    left = remaining()
+    if left is not None:
+        headers[HEADER] = str(max(0, int(left * 1000)))
+
+def budget_from_header(value: str):
+    try:
+        return max(0.0, float(value) / 1000)
+    except (TypeError, ValueError):
+        return None
+
+# --- Instrumentation ---
+
+_http_patched = False
+
+def instrument_http_clients():
+    """
+    Clamps timeouts of every requests/httpx call to the remaining budget and
+    propagates it, without touching each call site.
+    """
+    global _http_patched
+    if _http_patched:
+        return
+    _http_patched = True
+
+    import requests
+    import httpx
+
+    class RequestsDeadlineExceeded(DeadlineExceeded, requests.exceptions.Timeout):
+        pass
+
+    class HttpxDeadlineExceeded(DeadlineExceeded, httpx.TimeoutException):
+        pass
+
+    original_request = requests.Session.request
+
+    def request_with_deadline(self, method, url, *args, **kwargs):
+        if remaining() is None:
+            return original_request(self, method, url, *args, **kwargs)
+        try:
+            limit = kwargs.get("timeout")
+            if isinstance(limit, tuple):
+                kwargs["timeout"] = tuple(timeout(t) for t in limit) # (connect, read)
+            else:
+                kwargs["timeout"] = timeout(limit)
+        except DeadlineExceeded as e:
+            raise RequestsDeadlineExceeded(str(e))
+        headers = dict(kwargs.get("headers") or {})
+        inject(headers)
+        kwargs["headers"] = headers
+        return original_request(self, method, url, *args, **kwargs)
+
+    requests.Session.request = request_with_deadline
+
+    def clamp(request):
+        try:
+            left = timeout()
+        except DeadlineExceeded as e:
+            raise HttpxDeadlineExceeded(str(e), request=request)
+        limits = dict(request.extensions.get("timeout") or {})
+        for phase in ("connect", "read", "write", "pool"):
+            limits[phase] = left if limits.get(phase) is None else min(limits[phase], left)
+        request.extensions["timeout"] = limits
+        inject(request.headers)
+
+    original_async_send = httpx.AsyncClient.send
+
+    async def async_send_with_deadline(self, request, *args, **kwargs):
+        if remaining() is not None:
+            clamp(request)
+        return await original_async_send(self, request, *args, **kwargs)
+
+    httpx.AsyncClient.send = async_send_with_deadline
+
+    original_send = httpx.Client.send
+
+    def send_with_deadline(self, request, *args, **kwargs):
+        if remaining() is not None:
+            clamp(request)
+        return original_send(self, request, *args, **kwargs)
+
+    httpx.Client.send = send_with_deadline
+
+class DeadlineMiddleware:
+    """
+    Starts the request's deadline from X-Deadline-Ms (capped at `default_budget`,
+    which also applies when the header is missing). Requests that arrive
+    with no budget left are answered 504 without running the handler.
+    """
+    def __init__(self, app, default_budget: float = None):
+        self.app = app
+        self.default_budget = default_budget
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        budget = None
+        for name, value in scope["headers"]:
+            if name == HEADER.encode():
+                budget = budget_from_header(value.decode())
+                break
+        if self.default_budget is not None:
+            budget = self.default_budget if budget is None else min(budget, self.default_budget)
+        if budget is None:
+            return await self.app(scope, receive, send)
+        if budget < MIN_BUDGET:
+            from starlette.responses import JSONResponse
+            return await JSONResponse({"detail": "Request deadline exceeded"}, status_code=504)(scope, receive, send)
+        token = set_budget(budget)
+        current = _deadline.get()
+
+        async def send_wrapper(message):
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body"):
+                # Background tasks (audit logging) run after this and aren't bound by the budget
+                current.at = None
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            reset(token)
+
+def instrument_app(app, default_budget: float = None):
+    """
+    Honors incoming deadlines and propagates them on outgoing calls.
+    Pass `default_budget` (seconds) at the edge to give every request one.
+    """
+    instrument_http_clients()
+    app.add_middleware(DeadlineMiddleware, default_budget=default_budget)
@@ -0,0 +1,78 @@
+import contextvars
+import itertools
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from common import metrics
+
+# Hedged requests for idempotent reads: if the first attempt hasn't answered
+# within the p95 of recent latencies, a second one goes to the next replica
+# and whichever succeeds first wins. Costs ~5% extra calls, cuts the tail a
+# single slow replica (or a slow worker behind one address) would add.
+HEDGING = os.environ.get("HEDGING", "on") != "off"
+HEDGE_QUANTILE = 0.95
+# Until there are enough samples, and never hedge sooner than this
+DEFAULT_HEDGE_DELAY = 0.05
+MIN_HEDGE_DELAY = 0.005
+MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+
+_pool = ThreadPoolExecutor(max_workers=32, thread_name_prefix="hedge")
+
+HEDGES_SENT = metrics.counter("hedged_requests_total", "Backup requests sent", ("target",))
+HEDGES_WON = metrics.counter("hedged_requests_won_total", "Backup requests that answered first", ("target",))
+
+class Hedger:
+    def __init__(self, name: str, replicas: list):
+        self.name = name
+        self.replicas = list(replicas)
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self._next = itertools.count()
+        self._sent = HEDGES_SENT.labels(name)
+        self._won = HEDGES_WON.labels(name)
+
+    def hedge_delay(self) -> float:
+        if len(self.latencies) < MIN_SAMPLES:
+            return DEFAULT_HEDGE_DELAY
+        ordered = sorted(self.latencies)
+        return max(MIN_HEDGE_DELAY, ordered[int(len(ordered) * HEDGE_QUANTILE) - 1])
+
+    def _timed(self, fn, base_url: str):
+        started = time.perf_counter()
+        result = fn(base_url)
+        self.latencies.append(time.perf_counter() - started)
+        return result
+
+    def call(self, fn):
+        """
+        Calls fn(base_url) on one replica, hedging to the next if it is slow
+        or fails. fn must be idempotent and raise on failure.
+        """
+        start = next(self._next)
+        primary = self.replicas[start % len(self.replicas)]
+        if not HEDGING or len(self.replicas) < 2:
+            # A backup to the same address would only double the load on it
+            return self._timed(fn, primary)
+        backup = self.replicas[(start + 1) % len(self.replicas)]
+
+        # Attempts run on pool threads; carry the trace and deadline along
+        first = _pool.submit(contextvars.copy_context().run, self._timed, fn, primary)
+        done, _ = wait([first], timeout=self.hedge_delay())
+        if done and first.exception() is None:
+            return first.result()
+
+        self._sent.inc()
+        second = _pool.submit(contextvars.copy_context().run, self._timed, fn, backup)
+        pending = {first, second}
+        errors = []
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is second:
+                        self._won.inc()
+                    return future.result()
+                errors.append(future.exception())
+        raise errors[0]
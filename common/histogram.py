@@ -0,0 +1,91 @@
+import math
+
+class Histogram:
+    """
+    HDR-style latency histogram: log2 magnitude buckets, each split into
+    2**SUB_BITS linear sub-buckets, so every recorded value keeps ~3 significant
+    digits (<1% relative error) at constant memory, whatever the range.
+    Values are recorded as integer microseconds.
+    """
+    SUB_BITS = 7
+
+    def __init__(self):
+        self.counts = {}
+        self.total = 0
+        self.min = None
+        self.max = None
+        self.sum = 0
+
+    def _index(self, value: int) -> int:
+        if value < (1 << self.SUB_BITS):
+            return value
+        shift = value.bit_length() - self.SUB_BITS - 1
+        return ((shift + 1) << self.SUB_BITS) + (value >> shift) - (1 << self.SUB_BITS)
+
+    def _value_at(self, index: int) -> int:
+        # Upper bound of the bucket, so percentiles never under-report
+        if index < (1 << self.SUB_BITS):
+            return index
+        shift = (index >> self.SUB_BITS) - 1
+        sub = (index & ((1 << self.SUB_BITS) - 1)) + (1 << self.SUB_BITS)
+        return ((sub + 1) << shift) - 1
+
+    def record(self, value_us: int):
+        value_us = max(0, int(value_us))
+        idx = self._index(value_us)
+        self.counts[idx] = self.counts.get(idx, 0) + 1
+        self.total += 1
+        self.sum += value_us
+        self.min = value_us if self.min is None else min(self.min, value_us)
+        self.max = value_us if self.max is None else max(self.max, value_us)
+
+    def merge(self, other: "Histogram"):
+        for idx, count in other.counts.items():
+            self.counts[idx] = self.counts.get(idx, 0) + count
+        self.total += other.total
+        self.sum += other.sum
+        if other.total:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def percentile(self, q: float) -> int:
+        """
+        Value (us) at percentile q in [0, 100].
+        """
+        if not self.total:
+            return 0
+        rank = max(1, math.ceil(q / 100 * self.total))
+        seen = 0
+        for idx in sorted(self.counts):
+            seen += self.counts[idx]
+            if seen >= rank:
+                return min(self._value_at(idx), self.max)
+        return self.max
+
+    def values(self):
+        """
+        Yields (bucket value us, count) pairs in ascending order.
+        """
+        for idx in sorted(self.counts):
+            yield min(self._value_at(idx), self.max), self.counts[idx]
+
+    def summary_ms(self) -> dict:
+        return {
+            "p50": self.percentile(50) / 1000,
+            "p90": self.percentile(90) / 1000,
+            "p99": self.percentile(99) / 1000,
+            "p999": self.percentile(99.9) / 1000,
+            "max": (self.max or 0) / 1000,
+            "mean": (self.sum / self.total / 1000) if self.total else 0.0
+        }
+
+    def to_dict(self) -> dict:
+        return {"sub_bits": self.SUB_BITS, "counts": {str(k): v for k, v in sorted(self.counts.items())},
+                "total": self.total, "sum": self.sum, "min": self.min, "max": self.max}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Histogram":
+        h = cls()
+        h.counts = {int(k): v for k, v in data["counts"].items()}
+        h.total, h.sum, h.min, h.max = data["total"], data["sum"], data["min"], data["max"]
+        return h
@@ -0,0 +1,121 @@
+import contextvars
+import itertools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from common import metrics, deadline
+from common.hedging import Hedger
+from common.ring import HashRing
+
+# Key-id aware routing to a sharded KMS. KMS_SHARDS lists the shards,
+# separated by ';', each as its primary followed by its read replicas:
+#   KMS_SHARDS="http://kms0:8005,http://kms0r:8015;http://kms1:8006"
+# A key lives on the shard its id hashes to (common.ring, same node names as
+# the KMS). Reads are hedged across the shard's primary and replicas and
+# fall back to the primary, which a lagging replica may be behind; writes go
+# to primaries. With several shards, each has a cap on calls in flight, so
+# a hot or stuck shard fails its own keys instead of tying up every request
+# thread. A call over the cap queues for a slot for up to
+# SHARD_QUEUE_TIMEOUT (less if the request's deadline is closer) and only
+# then fails; a burst just above the cap waits its turn. A single shard has
+# no one to isolate and no cap.
+SHARD_MAX_IN_FLIGHT = int(os.environ.get("KMS_SHARD_MAX_IN_FLIGHT", 32))
+SHARD_QUEUE_TIMEOUT = float(os.environ.get("KMS_SHARD_QUEUE_TIMEOUT", 0.25))
+
+_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="kms-router")
+
+SHED = metrics.counter("kms_shard_shed_total", "KMS calls refused after queueing for a busy shard", ("shard",))
+
+class ShardBusy(Exception):
+    pass
+
+class Shard:
+    def __init__(self, index: int, urls: list, limit: bool = True):
+        self.index = index
+        self.primary = urls[0]
+        self.replicas = urls[1:]
+        self.reads = Hedger(f"kms.shard{index}", urls)
+        self._slots = threading.BoundedSemaphore(SHARD_MAX_IN_FLIGHT) if limit else None
+        self._shed = SHED.labels(str(index))
+
+    def call(self, fn, read: bool = True):
+        """
+        fn(base_url) on this shard: any copy for reads, the primary for writes.
+        """
+        if self._slots is None:
+            return self._call(fn, read)
+        if not self._slots.acquire(timeout=deadline.timeout(SHARD_QUEUE_TIMEOUT)):
+            self._shed.inc()
+            raise ShardBusy(f"KMS shard {self.index} is overloaded")
+        try:
+            return self._call(fn, read)
+        finally:
+            self._slots.release()
+
+    def _call(self, fn, read: bool):
+        if not read:
+            return fn(self.primary)
+        try:
+            return self.reads.call(fn)
+        except Exception:
+            if not self.replicas:
+                raise
+            # A replica may not have the key yet
+            return fn(self.primary)
+
+class KMSRouter:
+    def __init__(self, shards: list):
+        self.shards = [Shard(i, urls, limit=len(shards) > 1) for i, urls in enumerate(shards)]
+        self.ring = HashRing([str(i) for i in range(len(self.shards))])
+        self._next = itertools.count()
+
+    def shard_for(self, key: str) -> Shard:
+        return self.shards[int(self.ring.node_for(key))]
+
+    def read(self, key: str, fn):
+        return self.shard_for(key).call(fn)
+
+    def create(self, fn):
+        """
+        fn(base_url) on the next primary in turn; any shard can mint a key,
+        so one that fails passes the call on to the next.
+        """
+        start = next(self._next)
+        errors = []
+        for i in range(len(self.shards)):
+            try:
+                return self.shards[(start + i) % len(self.shards)].call(fn, read=False)
+            except Exception as e:
+                errors.append(e)
+        raise errors[0]
+
+    def read_many(self, keys: list, fn) -> dict:
+        """
+        fn(base_url, shard_keys) -> dict on every shard holding some of `keys`,
+        in parallel, merged. Results from shards that fail are left out.
+        """
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.shard_for(key), []).append(key)
+
+        def fetch(item):
+            shard, shard_keys = item
+            try:
+                return shard.call(lambda base_url: fn(base_url, shard_keys))
+            except Exception:
+                return {}
+
+        merged = {}
+        if len(groups) == 1:
+            results = map(fetch, groups.items())
+        else:
+            # Carry the trace and deadline onto the pool threads
+            results = [future.result() for future in [_pool.submit(contextvars.copy_context().run, fetch, item)
+                                                      for item in groups.items()]]
+        for result in results:
+            merged.update(result)
+        return merged
+
+def parse_shards(value: str) -> list:
+    return [[url for url in shard.split(",") if url] for shard in value.split(";") if shard.strip(",")]
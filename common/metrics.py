@@ -0,0 +1,310 @@
+import bisect
+import threading
+import time
+import weakref
+
+# Prometheus-style metrics, exposed in the text format on /metrics.
+#
+# Recording is lock-free: every thread increments its own shard (a plain list
+# reached through a threading.local), and a scrape sums the shards. The only
+# lock is taken once per thread per metric, when its shard is created, and
+# again when the thread exits and its shard is folded into a running total.
+# Values that already live somewhere else (ledger height, LB node stats) are
+# read at scrape time through callbacks instead of being mirrored on each change.
+
+# Seconds; covers sub-millisecond cache hits up to multi-second crypto on large files
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class _Owner:
+    # Lives in the thread-local, so it dies with its thread
+    __slots__ = ("__weakref__",)
+
+class _Shards:
+    def __init__(self, size: int):
+        self._size = size
+        self._local = threading.local()
+        # (live shards, totals of shards whose threads have exited), swapped
+        # as one tuple so a scrape never sees a shard in both or neither
+        self._state = ([], [0.0] * size)
+        self._lock = threading.Lock()
+
+    def mine(self) -> list:
+        try:
+            return self._local.values
+        except AttributeError:
+            values = [0.0] * self._size
+            owner = _Owner()
+            with self._lock:
+                shards, retired = self._state
+                self._state = (shards + [values], retired)
+            weakref.finalize(owner, self._retire, values)
+            self._local.owner = owner
+            self._local.values = values
+            return values
+
+    def _retire(self, values: list):
+        # The thread is gone and won't write again; keep its counts, drop its shard
+        with self._lock:
+            shards, retired = self._state
+            self._state = ([v for v in shards if v is not values],
+                           [a + b for a, b in zip(retired, values)])
+
+    def total(self) -> list:
+        shards, retired = self._state
+        sums = list(retired)
+        for values in shards:
+            for i, v in enumerate(values):
+                sums[i] += v
+        return sums
+
+class _CounterChild:
+    __slots__ = ("_shards",)
+
+    def __init__(self):
+        self._shards = _Shards(1)
+
+    def inc(self, amount: float = 1.0):
+        self._shards.mine()[0] += amount
+
+    def value(self) -> float:
+        return self._shards.total()[0]
+
+class _GaugeChild(_CounterChild):
+    __slots__ = ()
+
+    def dec(self, amount: float = 1.0):
+        self._shards.mine()[0] -= amount
+
+class _HistogramChild:
+    __slots__ = ("_bounds", "_shards")
+
+    def __init__(self, bounds: tuple):
+        self._bounds = bounds
+        # One slot per bucket, one for +Inf, then the sum
+        self._shards = _Shards(len(bounds) + 2)
+
+    def observe(self, value: float):
+        values = self._shards.mine()
+        values[bisect.bisect_left(self._bounds, value)] += 1
+        values[-1] += value
+
+    def time(self):
+        return _Timer(self)
+
+class _Timer:
+    __slots__ = ("_child", "_start")
+
+    def __init__(self, child):
+        self._child = child
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._child.observe(time.perf_counter() - self._start)
+
+class _Metric:
+    """
+    Counters and gauges are either updated from the hot path, or given `fn`
+    to read the value (or {label_values: value}) at scrape time.
+    """
+    kind = None
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), fn=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.fn = fn
+        self._children = {}
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.get(values)
+                if child is None:
+                    child = self._new_child()
+                    # Copy-on-write, so lookups on the hot path never need the lock
+                    self._children = {**self._children, values: child}
+        return child
+
+    def _default(self):
+        return self.labels()
+
+    def _label_str(self, values, extra: str = "") -> str:
+        pairs = [f'{k}="{_escape(v)}"' for k, v in zip(self.labelnames, values)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        if self.fn is not None:
+            return lines + self._render_fn()
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(values, child))
+        return lines
+
+    def _render_fn(self) -> list:
+        try:
+            value = self.fn()
+        except Exception:
+            return [] # A broken callback must not break the scrape
+        samples = value.items() if isinstance(value, dict) else [((), value)]
+        return [f"{self.name}{self._label_str(values)} {_fmt(v)}" for values, v in samples if v is not None]
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0):
+        self._default().inc(amount)
+
+    def _render_child(self, values, child):
+        return [f"{self.name}{self._label_str(values)} {_fmt(child.value())}"]
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def inc(self, amount: float = 1.0):
+        self._default().inc(amount)
+
+    def dec(self, amount: float = 1.0):
+        self._default().dec(amount)
+
+    def _render_child(self, values, child):
+        return [f"{self.name}{self._label_str(values)} {_fmt(child.value())}"]
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+    def _render_child(self, values, child):
+        totals = child._shards.total()
+        lines = []
+        cumulative = 0.0
+        for bound, count in zip(self.buckets + (float("inf"),), totals):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else _fmt(bound)
+            labels = self._label_str(values, 'le="%s"' % le)
+            lines.append(f"{self.name}_bucket{labels} {_fmt(cumulative)}")
+        lines.append(f"{self.name}_sum{self._label_str(values)} {_fmt(totals[-1])}")
+        lines.append(f"{self.name}_count{self._label_str(values)} {_fmt(cumulative)}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric: _Metric):
+        self._metrics[metric.name] = metric
+
+    def get(self, name: str):
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _fmt(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+def _get_or_create(cls, name: str, help: str, labelnames: tuple, fn):
+    # Modules may be imported more than once (e.g. as __main__ and by name), reuse the metric
+    existing = REGISTRY.get(name)
+    if existing is None:
+        return cls(name, help, labelnames, fn)
+    if fn is not None:
+        existing.fn = fn
+    return existing
+
+def counter(name: str, help: str, labelnames: tuple = (), fn=None) -> Counter:
+    return _get_or_create(Counter, name, help, labelnames, fn)
+
+def gauge(name: str, help: str, labelnames: tuple = (), fn=None) -> Gauge:
+    return _get_or_create(Gauge, name, help, labelnames, fn)
+
+def histogram(name: str, help: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.get(name) or Histogram(name, help, labelnames, buckets)
+
+# --- HTTP instrumentation ---
+
+HTTP_REQUESTS = counter("http_requests_total", "HTTP requests by route and status", ("service", "method", "route", "status"))
+HTTP_LATENCY = histogram("http_request_duration_seconds", "HTTP request latency by route", ("service", "method", "route"))
+HTTP_IN_FLIGHT = gauge("http_requests_in_flight", "HTTP requests currently being served", ("service",))
+
+class MetricsMiddleware:
+    """
+    Plain ASGI middleware (no per-request task or body buffering), so the
+    cost is a couple of dict lookups and list increments per request.
+    Latency covers the whole response, including streamed bodies.
+    """
+    def __init__(self, app, service: str):
+        self.app = app
+        self.service = service
+        self.in_flight = HTTP_IN_FLIGHT.labels(service)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        started = time.perf_counter()
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        self.in_flight.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            self.in_flight.dec()
+            # The matched route template keeps label cardinality bounded
+            route = scope.get("route")
+            path = getattr(route, "path", "unmatched")
+            method = scope["method"]
+            HTTP_REQUESTS.labels(self.service, method, path, str(status[0])).inc()
+            HTTP_LATENCY.labels(self.service, method, path).observe(time.perf_counter() - started)
+
+def instrument_app(app, service_name: str):
+    """
+    Records request rate, latency and in-flight requests, and serves /metrics.
+    """
+    from fastapi.responses import PlainTextResponse
+
+    app.add_middleware(MetricsMiddleware, service=service_name)
+
+    @app.get("/metrics", include_in_schema=False)
+    def metrics():
+        return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
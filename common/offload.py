@@ -0,0 +1,137 @@
+import hashlib
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.shared_memory import SharedMemory
+
+from Crypto.Cipher import AES
+
+from common import metrics, serve
+
+# Optional process pool for AES-GCM and SHA-256 on large payloads. It is
+# not needed to keep request threads responsive: pycryptodome (through
+# ctypes) and hashlib release the GIL for the whole call. While a 16 MiB
+# AES-GCM call runs inline, another thread stalls for ~3 ms at most. A C
+# call that holds the GIL stalls it ~30 ms, and the pool ~15 ms, because
+# copying into shared memory holds the GIL (`python tests/microbench.py
+# --benches offload`). The pool's two copies also halve throughput
+# (~400 MB/s against ~780 MB/s inline). So payloads run inline unless
+# OFFLOAD_THRESHOLD is set. The pool then caps the cores large payloads
+# can take at OFFLOAD_WORKERS, so they queue instead of crowding out
+# everything else. Payloads are handed over in shared memory and
+# encrypted/decrypted in place there.
+OFFLOAD_THRESHOLD = int(os.environ.get("OFFLOAD_THRESHOLD", 0))
+# Split the cores between the service's worker processes (common.serve)
+OFFLOAD_WORKERS = int(os.environ.get("OFFLOAD_WORKERS", 0)) or max(1, (os.cpu_count() or 1) // serve.worker_count())
+
+_pool = None
+_pool_lock = threading.Lock()
+_pending = 0
+
+metrics.gauge("offload_workers", "Processes in the offload pool", fn=lambda: OFFLOAD_WORKERS)
+metrics.gauge("offload_in_flight", "Offloaded tasks submitted and not yet finished", fn=lambda: _pending)
+metrics.gauge("offload_queue_depth", "Offloaded tasks waiting for a free process", fn=lambda: queue_depth())
+OFFLOADED = metrics.counter("offload_tasks_total", "Tasks run in the offload pool", ("operation",))
+
+def queue_depth() -> int:
+    return max(0, _pending - OFFLOAD_WORKERS)
+
+def _inline(size: int) -> bool:
+    return not OFFLOAD_THRESHOLD or size < OFFLOAD_THRESHOLD
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # Not fork: the service process already runs threads holding locks
+            _pool = ProcessPoolExecutor(max_workers=OFFLOAD_WORKERS,
+                                        mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+def _run(operation: str, data, read_back: bool, fn, *args):
+    """
+    Copies `data` into shared memory and runs fn(name, size, *args) in the
+    pool. Returns (result, buffer contents after the call if `read_back`).
+    """
+    global _pool, _pending
+    size = len(data)
+    shm = SharedMemory(create=True, size=size)
+    try:
+        shm.buf[:size] = data
+        with _pool_lock:
+            _pending += 1
+        pool = _get_pool()
+        try:
+            OFFLOADED.labels(operation).inc()
+            result = pool.submit(fn, shm.name, size, *args).result()
+        except BrokenProcessPool:
+            # A pool process died; start a fresh pool for the next call, and
+            # shut this one down so its remaining processes and threads go too
+            with _pool_lock:
+                if _pool is pool:
+                    _pool = None
+            pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        finally:
+            with _pool_lock:
+                _pending -= 1
+        return result, shm.buf[:size].tobytes() if read_back else None
+    finally:
+        shm.close()
+        shm.unlink()
+
+# --- Run in the pool processes ---
+
+def _with_buffer(name: str, size: int, fn):
+    shm = SharedMemory(name=name)
+    buf = shm.buf[:size]
+    try:
+        return fn(buf)
+    finally:
+        buf.release()
+        shm.close()
+
+def _encrypt_in_place(name: str, size: int, key: bytes):
+    def run(buf):
+        cipher = AES.new(key, AES.MODE_GCM)
+        _, tag = cipher.encrypt_and_digest(buf, output=buf)
+        return cipher.nonce, tag
+    return _with_buffer(name, size, run)
+
+def _decrypt_in_place(name: str, size: int, key: bytes, nonce: bytes, tag: bytes):
+    def run(buf):
+        AES.new(key, AES.MODE_GCM, nonce=nonce).decrypt_and_verify(buf, tag, output=buf)
+    return _with_buffer(name, size, run)
+
+def _sha256(name: str, size: int):
+    return _with_buffer(name, size, lambda buf: hashlib.sha256(buf).hexdigest())
+
+# --- API ---
+
+def aes_gcm_encrypt(key: bytes, data: bytes) -> tuple:
+    """
+    Returns (nonce, ciphertext, tag).
+    """
+    if _inline(len(data)):
+        cipher = AES.new(key, AES.MODE_GCM)
+        ciphertext, tag = cipher.encrypt_and_digest(data)
+        return cipher.nonce, ciphertext, tag
+    (nonce, tag), ciphertext = _run("aes_gcm.encrypt", data, True, _encrypt_in_place, key)
+    return nonce, ciphertext, tag
+
+def aes_gcm_decrypt(key: bytes, nonce: bytes, ciphertext: bytes, tag: bytes) -> bytes:
+    """
+    Raises ValueError if the tag doesn't match.
+    """
+    if _inline(len(ciphertext)):
+        return AES.new(key, AES.MODE_GCM, nonce=nonce).decrypt_and_verify(ciphertext, tag)
+    _, plaintext = _run("aes_gcm.decrypt", ciphertext, True, _decrypt_in_place, key, nonce, tag)
+    return plaintext
+
+def sha256_hex(data: bytes) -> str:
+    if _inline(len(data)):
+        return hashlib.sha256(data).hexdigest()
+    result, _ = _run("sha256", data, False, _sha256)
+    return result
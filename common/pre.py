@@ -0,0 +1,390 @@
+import hashlib
+import secrets
+
+from Crypto.Cipher import AES
+from Crypto.Hash import SHA256
+from Crypto.Protocol.KDF import HKDF
+
+# Proxy re-encryption over secp256k1: a single-hop, unidirectional KEM after
+# Umbral. A blob encrypted for Alice carries a capsule (E, V, s) and a
+# payload sealed (AES-GCM) under K = KDF((r+u)·A). A rekey from Alice to Bob
+# is rk = a·d⁻¹ with d = H(X, B, x·B) for a fresh precursor X = x·G; the
+# proxy turns a capsule into W = rk·(E+V), which Bob opens as d·W with d
+# recomputed from X and his own key. The proxy never sees K, and the payload
+# passes through untouched.
+#
+# All arithmetic is on Python ints. Points are affine (x, y) tuples or
+# Jacobian (X, Y, Z) triples, with None as the point at infinity. Multiples
+# of G use a fixed-base table built once per process; other multiples split
+# the scalar with the curve's endomorphism (GLV) and walk both halves in
+# width-5 NAF, and a rekey keeps its split scalar so each re-encryption
+# skips the recoding.
+
+P = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEFFFFFC2F
+N = 0xFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFFEBAAEDCE6AF48A03BBFD25E8CD0364141
+G = (0x79BE667EF9DCBBAC55A06295CE870B07029BFCDB2DCE28D959F2815B16F81798,
+     0x483ADA7726A3C4655DA4FBFC0E1108A8FD17B448A68554199C47D08FFB10D4B8)
+# λ·(x, y) = (β·x, y)
+BETA = 0x7AE96A2B657C07106E64479EAC3434E99CF0497512F58995C1396C28719501EE
+LAMBDA = 0x5363AD4CC05C30E0A5261C028812645A122E22EA20816678DF02967C1B23BD72
+# Short basis of the GLV lattice, for splitting k into k1 + k2·λ
+A1 = 0x3086D221A7D46BCDE86C90E49284EB15
+B1 = -0xE4437ED6010E88286F547FA90ABFE4C3
+A2 = 0x114CA50F7A8E2F3F657C1108D9D44CFD8
+B2 = A1
+
+MAGIC = b"PRE1"
+ORIGINAL = 0
+REENCRYPTED = 1
+POINT_SIZE = 33
+SCALAR_SIZE = 32
+CAPSULE_SIZE = 2 * POINT_SIZE + SCALAR_SIZE
+HEADER_SIZE = len(MAGIC) + 1 + CAPSULE_SIZE
+REENCRYPTED_HEADER_SIZE = HEADER_SIZE + 2 * POINT_SIZE
+NONCE_SIZE = 12
+TAG_SIZE = 16
+REKEY_SIZE = SCALAR_SIZE + POINT_SIZE
+
+# Fixed-base table: WINDOW-bit windows, TABLE[i][j - 1] = j·2^(WINDOW·i)·G
+WINDOW = 8
+NAF_WIDTH = 5
+
+# --- Field and group arithmetic ---
+
+def _double(pt):
+    if pt is None:
+        return None
+    x, y, z = pt
+    if y == 0:
+        return None
+    a = x * x % P
+    b = y * y % P
+    c = b * b % P
+    d = 2 * ((x + b) ** 2 - a - c) % P
+    e = 3 * a
+    f = e * e % P
+    x3 = (f - 2 * d) % P
+    return x3, (e * (d - x3) - 8 * c) % P, 2 * y * z % P
+
+def _add_affine(pt, q):
+    """
+    Jacobian pt + affine q.
+    """
+    if pt is None:
+        return q[0], q[1], 1
+    x1, y1, z1 = pt
+    x2, y2 = q
+    zz = z1 * z1 % P
+    h = (x2 * zz - x1) % P
+    r = 2 * (y2 * z1 * zz - y1) % P
+    if h == 0:
+        return _double(pt) if r == 0 else None
+    hh = h * h % P
+    i = 4 * hh
+    j = h * i % P
+    v = x1 * i % P
+    x3 = (r * r - j - 2 * v) % P
+    return x3, (r * (v - x3) - 2 * y1 * j) % P, ((z1 + h) ** 2 - zz - hh) % P
+
+def _add(pt, q):
+    """
+    Jacobian pt + Jacobian q.
+    """
+    if pt is None:
+        return q
+    if q is None:
+        return pt
+    x1, y1, z1 = pt
+    x2, y2, z2 = q
+    z1z1 = z1 * z1 % P
+    z2z2 = z2 * z2 % P
+    u1 = x1 * z2z2 % P
+    s1 = y1 * z2 * z2z2 % P
+    h = (x2 * z1z1 - u1) % P
+    r = 2 * (y2 * z1 * z1z1 - s1) % P
+    if h == 0:
+        return _double(pt) if r == 0 else None
+    i = 4 * h * h % P
+    j = h * i % P
+    v = u1 * i % P
+    x3 = (r * r - j - 2 * v) % P
+    return x3, (r * (v - x3) - 2 * s1 * j) % P, ((z1 + z2) ** 2 - z1z1 - z2z2) * h % P
+
+def _affine(pt):
+    if pt is None:
+        return None
+    x, y, z = pt
+    zinv = pow(z, -1, P)
+    zz = zinv * zinv % P
+    return x * zz % P, y * zz * zinv % P
+
+def _affine_many(pts: list) -> list:
+    """
+    Normalizes Jacobian points (none at infinity) with one inversion.
+    """
+    prefix = []
+    acc = 1
+    for _, _, z in pts:
+        prefix.append(acc)
+        acc = acc * z % P
+    inv = pow(acc, -1, P)
+    out = [None] * len(pts)
+    for i in range(len(pts) - 1, -1, -1):
+        x, y, z = pts[i]
+        zinv = inv * prefix[i] % P
+        inv = inv * z % P
+        zz = zinv * zinv % P
+        out[i] = (x * zz % P, y * zz * zinv % P)
+    return out
+
+def _neg(q):
+    return q[0], P - q[1]
+
+# --- Scalar multiplication ---
+
+_table = None
+
+def _base_table() -> list:
+    global _table
+    if _table is None:
+        rows = []
+        base = G
+        for _ in range(256 // WINDOW):
+            row = [(base[0], base[1], 1)]
+            for _ in range((1 << WINDOW) - 2):
+                row.append(_add_affine(row[-1], base))
+            row = _affine_many(row)
+            rows.append(row)
+            base = _affine(_add_affine((row[-1][0], row[-1][1], 1), base))
+        _table = rows
+    return _table
+
+def base_mul(k: int):
+    """
+    k·G in affine coordinates, with one addition per non-zero window.
+    """
+    table = _base_table()
+    acc = None
+    k %= N
+    mask = (1 << WINDOW) - 1
+    i = 0
+    while k:
+        digit = k & mask
+        if digit:
+            acc = _add_affine(acc, table[i][digit - 1])
+        k >>= WINDOW
+        i += 1
+    return _affine(acc)
+
+def _wnaf(k: int) -> list:
+    """
+    Width-NAF_WIDTH digits of k >= 0, least significant first.
+    """
+    digits = []
+    full = 1 << NAF_WIDTH
+    half = full >> 1
+    while k:
+        if k & 1:
+            d = k & (full - 1)
+            if d >= half:
+                d -= full
+            k -= d
+        else:
+            d = 0
+        digits.append(d)
+        k >>= 1
+    return digits
+
+def split(k: int) -> tuple:
+    """
+    (k1, k2) with k ≡ k1 + k2·λ (mod N) and both about half as long as k.
+    """
+    c1 = (B2 * k + N // 2) // N
+    c2 = (-B1 * k + N // 2) // N
+    return k - c1 * A1 - c2 * A2, -c1 * B1 - c2 * B2
+
+class Scalar:
+    """
+    A scalar recoded for repeated multiplication: GLV halves in wNAF form.
+    """
+    def __init__(self, k: int):
+        self.value = k % N
+        k1, k2 = split(self.value)
+        self.negate = (k1 < 0, k2 < 0)
+        self.digits = (_wnaf(abs(k1)), _wnaf(abs(k2)))
+
+    def mul(self, q):
+        """
+        self·q for an affine point q.
+        """
+        # Odd multiples q, 3q, ..., 15q, and their images under λ
+        q2 = _double((q[0], q[1], 1))
+        odd = [(q[0], q[1], 1)]
+        for _ in range((1 << (NAF_WIDTH - 2)) - 1):
+            odd.append(_add(odd[-1], q2))
+        odd = _affine_many(odd)
+        tables = []
+        for half, endo in enumerate((False, True)):
+            table = [(BETA * x % P, y) for x, y in odd] if endo else odd
+            if self.negate[half]:
+                table = [_neg(t) for t in table]
+            tables.append(table)
+
+        d1, d2 = self.digits
+        acc = None
+        for i in range(max(len(d1), len(d2)) - 1, -1, -1):
+            acc = _double(acc)
+            for digits, table in ((d1, tables[0]), (d2, tables[1])):
+                if i < len(digits) and digits[i]:
+                    d = digits[i]
+                    acc = _add_affine(acc, table[d >> 1] if d > 0 else _neg(table[-d >> 1]))
+        return _affine(acc)
+
+def mul(k: int, q):
+    return Scalar(k).mul(q)
+
+# --- Encoding ---
+
+def encode_point(q) -> bytes:
+    return bytes([2 | (q[1] & 1)]) + q[0].to_bytes(32, "big")
+
+def decode_point(raw: bytes):
+    if len(raw) != POINT_SIZE or raw[0] not in (2, 3):
+        raise ValueError("Invalid point encoding")
+    x = int.from_bytes(raw[1:], "big")
+    if x >= P:
+        raise ValueError("Invalid point encoding")
+    y = pow((x * x * x + 7) % P, (P + 1) // 4, P)
+    if y * y % P != (x * x * x + 7) % P:
+        raise ValueError("Point is not on the curve")
+    if (y & 1) != (raw[0] & 1):
+        y = P - y
+    return x, y
+
+def encode_scalar(k: int) -> bytes:
+    return k.to_bytes(SCALAR_SIZE, "big")
+
+def decode_scalar(raw: bytes) -> int:
+    k = int.from_bytes(raw, "big")
+    if len(raw) != SCALAR_SIZE or not 0 < k < N:
+        raise ValueError("Invalid scalar")
+    return k
+
+def _hash_scalar(label: bytes, *parts: bytes) -> int:
+    digest = hashlib.sha512(label + b"".join(parts)).digest()
+    return int.from_bytes(digest, "big") % (N - 1) + 1
+
+def _kdf(q) -> bytes:
+    return HKDF(encode_point(q), 32, b"", SHA256, context=b"pre-kem")
+
+def random_scalar() -> int:
+    return secrets.randbelow(N - 1) + 1
+
+# --- Keys, capsules, rekeys ---
+
+def generate_keypair() -> tuple:
+    """
+    (secret, public key bytes).
+    """
+    secret = random_scalar()
+    return secret, public_key(secret)
+
+def public_key(secret: int) -> bytes:
+    return encode_point(base_mul(secret))
+
+def _open_capsule(blob: bytes) -> tuple:
+    if not is_pre(blob):
+        raise ValueError("Not a PRE ciphertext")
+    e = decode_point(blob[5:5 + POINT_SIZE])
+    v = decode_point(blob[5 + POINT_SIZE:5 + 2 * POINT_SIZE])
+    s = decode_scalar(blob[5 + 2 * POINT_SIZE:HEADER_SIZE])
+    if e == _neg(v):
+        raise ValueError("Invalid capsule") # E + V would be the point at infinity
+    # s·G = V + H(E, V)·E, so only capsules made with encrypt() are transformed
+    h = _hash_scalar(b"capsule", blob[5:5 + 2 * POINT_SIZE])
+    if base_mul(s) != _affine(_add_affine((*mul(h, e), 1), v)):
+        raise ValueError("Invalid capsule")
+    return e, v
+
+def _seal(key: bytes, capsule: bytes, data: bytes) -> bytes:
+    nonce = secrets.token_bytes(NONCE_SIZE)
+    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+    cipher.update(capsule)
+    ciphertext, tag = cipher.encrypt_and_digest(data)
+    return nonce + ciphertext + tag
+
+def _unseal(key: bytes, capsule: bytes, sealed: bytes) -> bytes:
+    cipher = AES.new(key, AES.MODE_GCM, nonce=sealed[:NONCE_SIZE])
+    cipher.update(capsule)
+    return cipher.decrypt_and_verify(sealed[NONCE_SIZE:-TAG_SIZE], sealed[-TAG_SIZE:])
+
+def is_pre(blob: bytes) -> bool:
+    return len(blob) >= HEADER_SIZE and blob[:4] == MAGIC and blob[4] in (ORIGINAL, REENCRYPTED)
+
+def encrypt(public: bytes, data: bytes) -> bytes:
+    """
+    Encrypts `data` for the holder of `public`.
+    """
+    pk = decode_point(public)
+    r, u = random_scalar(), random_scalar()
+    ev = encode_point(base_mul(r)) + encode_point(base_mul(u))
+    s = (u + r * _hash_scalar(b"capsule", ev)) % N
+    capsule = ev + encode_scalar(s)
+    key = _kdf(mul(r + u, pk))
+    return MAGIC + bytes([ORIGINAL]) + capsule + _seal(key, capsule, data)
+
+def make_rekey(secret: int, to_public: bytes) -> bytes:
+    """
+    Rekey from the owner of `secret` to the holder of `to_public`: rk and
+    the precursor X the recipient needs to undo it.
+    """
+    pk = decode_point(to_public)
+    x = random_scalar()
+    precursor = encode_point(base_mul(x))
+    d = _hash_scalar(b"rekey", precursor, to_public, encode_point(mul(x, pk)))
+    return encode_scalar(secret * pow(d, -1, N) % N) + precursor
+
+class Rekey:
+    """
+    A parsed rekey, ready to re-encrypt. Build once and keep it: parsing
+    checks the precursor and recodes the scalar.
+    """
+    def __init__(self, raw: bytes):
+        if len(raw) != REKEY_SIZE:
+            raise ValueError("Invalid rekey")
+        self.scalar = Scalar(decode_scalar(raw[:SCALAR_SIZE]))
+        self.precursor = raw[SCALAR_SIZE:]
+        decode_point(self.precursor)
+
+    def reencrypt(self, blob: bytes) -> bytes:
+        """
+        The blob, re-encrypted for the rekey's recipient. Its payload is
+        carried over as is.
+        """
+        if is_pre(blob) and blob[4] == REENCRYPTED:
+            raise ValueError("Already re-encrypted")
+        e, v = _open_capsule(blob)
+        w = self.scalar.mul(_affine(_add_affine((*e, 1), v)))
+        return (MAGIC + bytes([REENCRYPTED]) + blob[5:HEADER_SIZE] + encode_point(w) + self.precursor
+                + blob[HEADER_SIZE:])
+
+def decrypt(secret: int, blob: bytes) -> bytes:
+    """
+    Opens a blob encrypted for, or re-encrypted to, the owner of `secret`.
+    """
+    e, v = _open_capsule(blob)
+    capsule = blob[5:HEADER_SIZE]
+    if blob[4] == ORIGINAL:
+        key = _kdf(mul(secret, _affine(_add_affine((*e, 1), v))))
+        sealed = blob[HEADER_SIZE:]
+    else:
+        if len(blob) < REENCRYPTED_HEADER_SIZE:
+            raise ValueError("Truncated PRE ciphertext")
+        w = decode_point(blob[HEADER_SIZE:HEADER_SIZE + POINT_SIZE])
+        precursor = blob[HEADER_SIZE + POINT_SIZE:REENCRYPTED_HEADER_SIZE]
+        d = _hash_scalar(b"rekey", precursor, public_key(secret), encode_point(mul(secret, decode_point(precursor))))
+        key = _kdf(mul(d, w))
+        sealed = blob[REENCRYPTED_HEADER_SIZE:]
+    if len(sealed) < NONCE_SIZE + TAG_SIZE:
+        raise ValueError("Truncated PRE ciphertext")
+    return _unseal(key, capsule, sealed)
@@ -0,0 +1,246 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+from common import tracing
+
+# Opt-in sampling profiler and slow-request log. Nothing runs until one of
+# them is switched on through the /admin/profiler endpoints (or SLOW_REQUEST_MS
+# at startup); while off, the only cost is one flag check per request.
+#
+# The sampler is a background thread that reads every thread's Python stack
+# with sys._current_frames() at a fixed interval. Output is in the folded
+# format ("a;b;c 42" per line) read by flamegraph.pl, speedscope and inferno.
+PROFILE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'profiles'))
+SAMPLE_INTERVAL = 0.005
+MAX_DEPTH = 128
+# Samples kept for slow-request capture, across all threads
+RING_SIZE = 50_000
+SLOW_LOG_SIZE = 100
+SLOW_REQUEST_MS = float(os.environ.get("SLOW_REQUEST_MS", "0"))  # 0 = off
+
+# Leaf frames of threads parked waiting for work; sampling them only adds noise
+IDLE_FRAMES = {
+    ("threading.py", "wait"), ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"), ("selectors.py", "select"), ("thread.py", "_worker")
+}
+
+SERVICE_NAME = "unknown"
+
+class Sampler:
+    def __init__(self):
+        self.interval = SAMPLE_INTERVAL
+        self.profiling = False
+        self.capturing = False
+        self.counts = Counter()
+        self.samples = 0
+        self.started_at = None
+        self.ring = deque(maxlen=RING_SIZE)
+        self._labels = {}
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+            self._labels[code] = label
+        return label
+
+    def _stack(self, frame) -> str:
+        leaf = frame.f_code
+        if (os.path.basename(leaf.co_filename), leaf.co_name) in IDLE_FRAMES:
+            return None
+        labels = []
+        while frame is not None and len(labels) < MAX_DEPTH:
+            labels.append(self._label(frame.f_code))
+            frame = frame.f_back
+        labels.reverse()
+        return ";".join(labels)
+
+    def _run(self):
+        own = threading.get_ident()
+        while True:
+            with self._lock:
+                if not (self.profiling or self.capturing):
+                    self._thread = None
+                    return
+            now = time.monotonic()
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = self._stack(frame)
+                if stack is None:
+                    continue
+                if self.profiling:
+                    self.counts[stack] += 1
+                if self.capturing:
+                    self.ring.append((now, stack))
+            if self.profiling:
+                self.samples += 1
+            time.sleep(self.interval)
+
+    def _ensure_running(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True, name="sampling-profiler")
+                self._thread.start()
+
+    def start_profile(self, interval: float = None):
+        self.interval = interval or SAMPLE_INTERVAL
+        self.counts = Counter()
+        self.samples = 0
+        self.started_at = time.time()
+        self.profiling = True
+        self._ensure_running()
+
+    def stop_profile(self) -> Counter:
+        self.profiling = False
+        return self.counts
+
+    def set_capture(self, on: bool):
+        self.capturing = on
+        if on:
+            self._ensure_running()
+        else:
+            self.ring.clear()
+
+    def window(self, start: float, end: float) -> Counter:
+        # Stacks of every busy thread while the request ran; sync endpoints run
+        # on pool threads, so samples aren't tied to one thread
+        return Counter(stack for t, stack in list(self.ring) if start <= t <= end)
+
+sampler = Sampler()
+slow_log = deque(maxlen=SLOW_LOG_SIZE)
+slow_threshold_ms = SLOW_REQUEST_MS
+
+def folded(counts: Counter) -> str:
+    return "".join(f"{stack} {n}\n" for stack, n in counts.most_common())
+
+def save_profile(counts: Counter) -> str:
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"{SERVICE_NAME}-{time.strftime('%Y%m%dT%H%M%S')}.folded")
+    with open(path, "w") as f:
+        f.write(folded(counts))
+    return path
+
+def set_slow_threshold(threshold_ms: float):
+    global slow_threshold_ms
+    slow_threshold_ms = threshold_ms
+    sampler.set_capture(threshold_ms > 0)
+
+def span_breakdown(spans: list, request_start: float) -> list:
+    return [{
+        "name": s["name"],
+        "kind": s["kind"],
+        "offset_ms": round((s["start"] - request_start) * 1000, 3),
+        "duration_ms": round(s["duration_ms"], 3),
+        "attrs": s["attrs"]
+    } for s in sorted(spans, key=lambda s: s["start"])]
+
+class SlowRequestMiddleware:
+    """
+    Records spans for every request while the slow log is on, and keeps the
+    ones slower than the threshold together with the stack samples taken
+    while they ran.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or slow_threshold_ms <= 0:
+            return await self.app(scope, receive, send)
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        spans, token = tracing.start_recording()
+        wall_start, started = time.time(), time.monotonic()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            tracing.stop_recording(token)
+            ended = time.monotonic()
+            duration_ms = (ended - started) * 1000
+            if duration_ms >= slow_threshold_ms:
+                slow_log.append({
+                    "service": SERVICE_NAME,
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "status": status[0],
+                    "started_at": wall_start,
+                    "duration_ms": round(duration_ms, 3),
+                    "spans": span_breakdown(spans, wall_start),
+                    "stacks": dict(sampler.window(started, ended).most_common(20))
+                })
+
+def instrument_app(app, service_name: str):
+    """
+    Adds the slow-request middleware and the /admin/profiler endpoints. The
+    endpoints need the admin token: stacks and slow-log paths expose internals.
+    """
+    from fastapi import APIRouter, Depends, HTTPException
+    from fastapi.responses import PlainTextResponse
+    from pydantic import BaseModel
+
+    from common import auth
+
+    global SERVICE_NAME
+    SERVICE_NAME = service_name
+    app.add_middleware(SlowRequestMiddleware)
+    if slow_threshold_ms > 0:
+        sampler.set_capture(True)
+
+    class ProfileStartRequest(BaseModel):
+        interval_ms: float = SAMPLE_INTERVAL * 1000
+
+    class SlowLogRequest(BaseModel):
+        threshold_ms: float  # 0 turns the slow log off
+
+    router = APIRouter(prefix="/admin/profiler", dependencies=[Depends(auth.require_admin)],
+                       include_in_schema=False)
+
+    @router.post("/start")
+    def profiler_start(req: ProfileStartRequest):
+        if sampler.profiling:
+            raise HTTPException(status_code=409, detail="Profiler already running")
+        sampler.start_profile(req.interval_ms / 1000)
+        return {"status": "profiling", "interval_ms": req.interval_ms}
+
+    @router.post("/stop")
+    def profiler_stop():
+        """
+        Stops the profiler and returns the folded stacks (also saved under profiles/).
+        """
+        if not sampler.profiling:
+            raise HTTPException(status_code=409, detail="Profiler not running")
+        counts = sampler.stop_profile()
+        path = save_profile(counts)
+        return PlainTextResponse(folded(counts), headers={"x-profile-path": path,
+                                                          "x-profile-samples": str(sampler.samples)})
+
+    @router.get("/status")
+    def profiler_status():
+        return {
+            "profiling": sampler.profiling,
+            "samples": sampler.samples,
+            "started_at": sampler.started_at,
+            "slow_threshold_ms": slow_threshold_ms,
+            "slow_requests": len(slow_log)
+        }
+
+    @router.post("/slowlog")
+    def slowlog_config(req: SlowLogRequest):
+        set_slow_threshold(req.threshold_ms)
+        return {"slow_threshold_ms": slow_threshold_ms}
+
+    @router.get("/slowlog")
+    def slowlog_entries(limit: int = 20):
+        return {"threshold_ms": slow_threshold_ms, "requests": list(slow_log)[-limit:]}
+
+    app.include_router(router)
@@ -0,0 +1,22 @@
+import bisect
+import hashlib
+
+# Consistent hashing. Each node owns VNODES points on a 64-bit ring and a
+# key belongs to the first point at or after its hash, so adding or removing
+# a node only moves about 1/N of the keys. Services that partition by key
+# (the KMS shards) must build the ring from the same node names.
+VNODES = 64
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), "big")
+
+class HashRing:
+    def __init__(self, nodes: list, vnodes: int = VNODES):
+        self.nodes = list(nodes)
+        points = sorted((_hash(f"{node}#{i}"), node) for node in self.nodes for i in range(vnodes))
+        self._hashes = [h for h, _ in points]
+        self._owners = [node for _, node in points]
+
+    def node_for(self, key: str) -> str:
+        i = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._owners[i]
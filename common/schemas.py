@@ -1,22 +1,38 @@
 from pydantic import BaseModel
-from typing import Optional, Dict
+from typing import Optional, Dict, List
 
 class EncryptRequest(BaseModel):
     plaintext: str  # Base64 encoded
     meta: Optional[Dict[str, str]] = None
+    store: bool = False  # Keep the ciphertext server-side, addressed by cipher_id
+    segmented: bool = False  # Return a segmented container, which supports range decryption
 
 class EncryptResponse(BaseModel):
     cipher_id: str
-    cipher: str     # Base64 encoded
+    cipher: Optional[str] = None  # Base64 encoded; None when stored
     key_id: str
 
 class DecryptRequest(BaseModel):
-    cipher: str     # Base64 encoded
+    cipher: Optional[str] = None  # Base64 encoded
+    cipher_id: Optional[str] = None  # Or a stored object
     key_id: str
+    offset: int = 0  # Plaintext byte range to return
+    length: Optional[int] = None  # Up to the end when None
+    stream: bool = False  # Raw bytes as they're decrypted instead of a JSON body
 
 class DecryptResponse(BaseModel):
     plaintext: str  # Base64 encoded
 
+class DecryptBatchRequest(BaseModel):
+    items: List[DecryptRequest]
+
+class DecryptBatchResult(BaseModel):
+    plaintext: Optional[str] = None  # Base64 encoded
+    error: Optional[str] = None
+
+class DecryptBatchResponse(BaseModel):
+    results: List[DecryptBatchResult]
+
 class ReKeyRequest(BaseModel):
     from_user: str
     to_user: str
@@ -31,3 +47,10 @@ class ReEncryptRequest(BaseModel):
 
 class ReEncryptResponse(BaseModel):
     cipher_re: str
+
+class ReEncryptBatchRequest(BaseModel):
+    items: List[ReEncryptRequest]
+    user: str = "admin"
+
+class RevokeReKeyRequest(BaseModel):
+    rekey_id: str
@@ -0,0 +1,33 @@
+import os
+
+# Multi-worker mode. With --workers N, uvicorn starts N processes that each
+# import the app by module path, so nothing set up in the launching process
+# reaches them except the environment. State the workers must agree on lives
+# outside the process: SQLite (common.store, the ledger, gateway usage) or
+# files mapped read-only (the ML model).
+WORKERS_ENV = "SERVICE_WORKERS"
+
+def worker_count() -> int:
+    """
+    Number of worker processes this service was started with (1 when run directly).
+    """
+    try:
+        return max(1, int(os.environ.get(WORKERS_ENV, "1")))
+    except ValueError:
+        return 1
+
+def add_arguments(parser):
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes; state is shared through SQLite/mmap")
+
+def run(app, app_path: str, port: int, workers: int = 1):
+    """
+    Serves `app` in this process, or `app_path` (e.g. "services.kms.main:app")
+    in `workers` processes.
+    """
+    import uvicorn
+    if workers <= 1:
+        uvicorn.run(app, host="0.0.0.0", port=port)
+        return
+    os.environ[WORKERS_ENV] = str(workers)
+    uvicorn.run(app_path, host="0.0.0.0", port=port, workers=workers)
@@ -0,0 +1,95 @@
+import sqlite3
+import json
+import os
+import time
+import threading
+
+from common.tracing import TracedConnection
+
+# Local stand-in for a shared cache (Redis/Memcached in a real deployment).
+# Backed by one SQLite file so every service process on the host sees the same data.
+# Anchored at the project root (not the cwd) so nodes launched from different
+# directories still share one store.
+STORE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'shared_store.db'))
+
+class LocalStore:
+    def __init__(self, namespace: str, path: str = STORE_PATH):
+        self.namespace = namespace
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self):
+        # sqlite3 connections can't be shared across threads, keep one per thread
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, factory=TracedConnection)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS kv (
+                    key TEXT PRIMARY KEY,
+                    value TEXT,
+                    expires_at REAL
+                )
+            ''')
+            self._local.conn = conn
+        return conn
+
+    def _key(self, key: str) -> str:
+        return f"{self.namespace}:{key}"
+
+    def get(self, key: str):
+        row = self._conn().execute("SELECT value, expires_at FROM kv WHERE key = ?",
+                                   (self._key(key),)).fetchone()
+        if not row:
+            return None
+        value, expires_at = row
+        if expires_at is not None and expires_at < time.time():
+            self.delete(key)
+            return None
+        return json.loads(value)
+
+    def set(self, key: str, value, ttl: float = None):
+        expires_at = time.time() + ttl if ttl else None
+        self._conn().execute("INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                             (self._key(key), json.dumps(value), expires_at))
+
+    def items(self) -> dict:
+        """
+        All live entries in this namespace.
+        """
+        prefix = self._key("")
+        # Range scan on the primary key; ';' sorts right after ':'
+        rows = self._conn().execute(
+            "SELECT key, value FROM kv WHERE key >= ? AND key < ? AND (expires_at IS NULL OR expires_at >= ?)",
+            (prefix, prefix[:-1] + ";", time.time())).fetchall()
+        return {key[len(prefix):]: json.loads(value) for key, value in rows}
+
+    def add(self, key: str, value, ttl: float = None) -> bool:
+        """
+        Like set, but never overwrites a live entry. Returns False if one exists.
+        """
+        expires_at = time.time() + ttl if ttl else None
+        cur = self._conn().execute('''
+            INSERT INTO kv (key, value, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at
+            WHERE kv.expires_at IS NOT NULL AND kv.expires_at < ?
+        ''', (self._key(key), json.dumps(value), expires_at, time.time()))
+        return cur.rowcount > 0
+
+    def delete(self, *keys: str):
+        self._conn().executemany("DELETE FROM kv WHERE key = ?", [(self._key(k),) for k in keys])
+
+    def incr(self, key: str, amount: int = 1) -> int:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT value FROM kv WHERE key = ?", (self._key(key),)).fetchone()
+            value = (json.loads(row[0]) if row else 0) + amount
+            conn.execute("INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, NULL)",
+                         (self._key(key), json.dumps(value)))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return value
@@ -0,0 +1,304 @@
+import contextvars
+import json
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from common import metrics
+
+# Lightweight distributed tracing with W3C `traceparent` propagation.
+#
+# TRACE_EXPORT=off            (default) spans are no-ops, nothing is propagated
+# TRACE_EXPORT=file           append spans as JSON lines to TRACE_FILE
+# TRACE_EXPORT=http://host/.. POST batches of spans to a collector
+# TRACE_SAMPLE_RATE=0.1       head sampling; downstream services follow the caller's decision
+TRACE_EXPORT = os.environ.get("TRACE_EXPORT", "off")
+TRACE_FILE = os.environ.get(
+    "TRACE_FILE", os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'traces', 'spans.jsonl')))
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "1.0"))
+EXPORT_BATCH = 256
+EXPORT_INTERVAL = 1.0
+
+SERVICE_NAME = "unknown"
+
+_current = contextvars.ContextVar("current_span", default=None)
+# Set by the slow-request log (common/profiler.py) to collect one request's
+# spans in process, whether or not they are exported
+_recorder = contextvars.ContextVar("span_recorder", default=None)
+
+def enabled() -> bool:
+    return TRACE_EXPORT != "off" or _recorder.get() is not None
+
+def start_recording():
+    """
+    Collects every span finished in this context into the returned list.
+    Returns (spans, token); pass the token to stop_recording.
+    """
+    spans = []
+    return spans, _recorder.set(spans)
+
+def stop_recording(token):
+    _recorder.reset(token)
+
+class Span:
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "kind", "start", "end", "attrs", "status", "sampled")
+
+    def __init__(self, name: str, trace_id: str, parent_id: str, sampled: bool, kind: str = "internal", attrs=None):
+        self.trace_id = trace_id
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start = time.time()
+        self.end = None
+        self.attrs = attrs or {}
+        self.status = "ok"
+        self.sampled = sampled
+
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "service": SERVICE_NAME,
+            "name": self.name,
+            "kind": self.kind,
+            "start": self.start,
+            "duration_ms": (self.end - self.start) * 1000,
+            "attrs": self.attrs,
+            "status": self.status
+        }
+
+def parse_traceparent(header: str):
+    """
+    Returns (trace_id, parent_span_id, sampled) or None if malformed.
+    """
+    try:
+        version, trace_id, span_id, flags = header.strip().split("-")
+        if len(trace_id) != 32 or len(span_id) != 16:
+            return None
+        return trace_id, span_id, int(flags, 16) & 1 == 1
+    except (ValueError, AttributeError):
+        return None
+
+def current_span():
+    return _current.get()
+
+@contextmanager
+def span(name: str, kind: str = "internal", traceparent: str = None, **attrs):
+    """
+    Opens a child of the current span (or of `traceparent`, or a new trace).
+    Yields the Span, or None when tracing is off. Unsampled spans still carry
+    context downstream but are not exported.
+    """
+    if not enabled():
+        yield None
+        return
+    parent = _current.get()
+    if parent is not None:
+        trace_id, parent_id, sampled = parent.trace_id, parent.span_id, parent.sampled
+    else:
+        parsed = parse_traceparent(traceparent) if traceparent else None
+        if parsed:
+            trace_id, parent_id, sampled = parsed
+        else:
+            trace_id, parent_id = f"{random.getrandbits(128):032x}", None
+            sampled = random.random() < TRACE_SAMPLE_RATE
+
+    s = Span(name, trace_id, parent_id, sampled, kind, attrs)
+    token = _current.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.status = f"error: {type(e).__name__}"
+        raise
+    finally:
+        s.end = time.time()
+        _current.reset(token)
+        recorder = _recorder.get()
+        if recorder is not None:
+            recorder.append(s.to_dict())
+        if sampled and TRACE_EXPORT != "off":
+            _exporter.submit(s.to_dict())
+
+def inject(headers: dict = None) -> dict:
+    """
+    Returns headers carrying the current trace context.
+    """
+    headers = dict(headers or {})
+    s = _current.get()
+    if s is not None:
+        headers["traceparent"] = s.traceparent()
+    return headers
+
+# --- Export ---
+
+class _Exporter:
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=100_000)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, record: dict):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, daemon=True)
+                    self._thread.start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            pass # Never block the request path on tracing
+
+    def _drain(self) -> list:
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=EXPORT_INTERVAL))
+            while len(batch) < EXPORT_BATCH:
+                batch.append(self._queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def _write(self, batch: list):
+        if TRACE_EXPORT == "file":
+            os.makedirs(os.path.dirname(TRACE_FILE), exist_ok=True)
+            with open(TRACE_FILE, "a") as f:
+                f.write("".join(json.dumps(r) + "\n" for r in batch))
+        else:
+            import requests
+            requests.post(TRACE_EXPORT, json=batch, timeout=2, headers={"x-no-trace": "1"})
+
+    def _run(self):
+        while True:
+            batch = self._drain()
+            if batch:
+                try:
+                    self._write(batch)
+                except Exception:
+                    pass # Drop the batch; tracing must not take a service down
+
+_exporter = _Exporter()
+
+# --- Instrumentation ---
+
+SQLITE_LATENCY = metrics.histogram("sqlite_query_duration_seconds", "SQLite statement latency", ("operation",))
+
+class TracedCursor(sqlite3.Cursor):
+    # Every query is timed; only queries inside a traced request get a span
+    def _run(self, method, sql, args):
+        started = time.perf_counter()
+        try:
+            if _current.get() is None:
+                return method(sql, args)
+            with span("sqlite", kind="client", statement=sql.strip().split("\n")[0][:80]):
+                return method(sql, args)
+        finally:
+            operation = sql.split(None, 1)[0].upper() if sql.strip() else "EMPTY"
+            SQLITE_LATENCY.labels(operation).observe(time.perf_counter() - started)
+
+    def execute(self, sql, parameters=()):
+        return self._run(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._run(super().executemany, sql, seq_of_parameters)
+
+class TracedConnection(sqlite3.Connection):
+    """
+    Pass as sqlite3.connect(..., factory=TracedConnection) to get a span per query.
+    """
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+_http_patched = False
+
+def instrument_http_clients():
+    """
+    Wraps requests and httpx so every outgoing call gets a client span and a
+    traceparent header, without touching each call site.
+    """
+    global _http_patched
+    if _http_patched:
+        return
+    _http_patched = True
+
+    import requests
+    import httpx
+
+    original_request = requests.Session.request
+
+    def traced_request(self, method, url, *args, **kwargs):
+        if not enabled() or _current.get() is None:
+            return original_request(self, method, url, *args, **kwargs)
+        with span(f"HTTP {method.upper()}", kind="client", url=str(url)) as s:
+            kwargs["headers"] = inject(kwargs.get("headers"))
+            resp = original_request(self, method, url, *args, **kwargs)
+            if s is not None:
+                s.attrs["status_code"] = resp.status_code
+            return resp
+
+    requests.Session.request = traced_request
+
+    original_async_send = httpx.AsyncClient.send
+
+    async def traced_async_send(self, request, *args, **kwargs):
+        if not enabled() or _current.get() is None:
+            return await original_async_send(self, request, *args, **kwargs)
+        with span(f"HTTP {request.method}", kind="client", url=str(request.url)) as s:
+            if s is not None:
+                request.headers["traceparent"] = s.traceparent()
+            resp = await original_async_send(self, request, *args, **kwargs)
+            if s is not None:
+                s.attrs["status_code"] = resp.status_code
+            return resp
+
+    httpx.AsyncClient.send = traced_async_send
+
+    original_send = httpx.Client.send
+
+    def traced_send(self, request, *args, **kwargs):
+        if not enabled() or _current.get() is None:
+            return original_send(self, request, *args, **kwargs)
+        with span(f"HTTP {request.method}", kind="client", url=str(request.url)) as s:
+            if s is not None:
+                request.headers["traceparent"] = s.traceparent()
+            resp = original_send(self, request, *args, **kwargs)
+            if s is not None:
+                s.attrs["status_code"] = resp.status_code
+            return resp
+
+    httpx.Client.send = traced_send
+
+def instrument_app(app, service_name: str):
+    """
+    Opens a server span per request (continuing the caller's trace) and
+    instruments outgoing HTTP clients for this process.
+    """
+    global SERVICE_NAME
+    SERVICE_NAME = service_name
+    instrument_http_clients()
+
+    @app.middleware("http")
+    async def tracing_middleware(request, call_next):
+        if not enabled() or request.headers.get("x-no-trace"):
+            return await call_next(request)
+        with span(f"{request.method} {request.url.path}", kind="server",
+                  traceparent=request.headers.get("traceparent")) as s:
+            response = await call_next(request)
+            if s is not None:
+                s.attrs["status_code"] = response.status_code
+                response.headers["traceparent"] = s.traceparent()
+            return response
@@ -5,6 +5,11 @@ import subprocess
 import os
 import sys
 
+# Add project root to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from common import auth
+
 ENC_URL = "http://localhost:8001"
 PROXY_URL = "http://localhost:8002"
 
@@ -46,7 +51,7 @@ def demo_share_flow():
     rekey_resp = requests.post(f"{PROXY_URL}/gen_rekey", json={
         "from_user": "alice@company.com",
         "to_user": "bob@company.com"
-    }).json()
+    }, headers=auth.service_headers("alice@company.com")).json()
     
     rk_id = rekey_resp['rekey_id']
     print(f"[Alice] Created Re-Key ID: {rk_id}")
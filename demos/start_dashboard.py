@@ -47,9 +47,13 @@ def main():
 
         # Start App Services
         launch([sys.executable, "services/encryption/main.py"], "Encryption", ENC_PORT)
-        launch([sys.executable, "services/proxy/main.py", "--port", str(PROXY1_PORT), "--id", "p1"], "Proxy1", PROXY1_PORT)
-        launch([sys.executable, "services/proxy/main.py", "--port", str(PROXY2_PORT), "--id", "p2"], "Proxy2", PROXY2_PORT)
+        lb_url = f"http://localhost:{LB_PORT}"
+        launch([sys.executable, "services/proxy/main.py", "--port", str(PROXY1_PORT), "--id", "p1", "--lb-url", lb_url], "Proxy1", PROXY1_PORT)
+        launch([sys.executable, "services/proxy/main.py", "--port", str(PROXY2_PORT), "--id", "p2", "--lb-url", lb_url], "Proxy2", PROXY2_PORT)
         launch([sys.executable, "services/load_balancer/main.py"], "Load Balancer", LB_PORT)
+        if "--autoscale" in sys.argv:
+            # Adds/removes extra proxies on 8010+ based on LB queue depth and p95
+            launch([sys.executable, "services/load_balancer/supervisor.py", "--lb-url", lb_url], "Supervisor", None)
 
         # Start UI (Interactive Mode)
         print("\n>> Launching Streamlit UI...")
@@ -0,0 +1,114 @@
+import json
+import os
+import sys
+from collections import defaultdict
+
+# Add project root to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from common.tracing import TRACE_FILE
+
+def load_traces(path: str) -> dict:
+    traces = defaultdict(list)
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue # Partially written line at the end of a live file
+            record["end"] = record["start"] + record["duration_ms"] / 1000
+            traces[record["trace_id"]].append(record)
+    return traces
+
+def find_root(spans: list) -> dict:
+    ids = {s["span_id"] for s in spans}
+    roots = [s for s in spans if s["parent_id"] not in ids]
+    # Orphans happen when the caller wasn't sampled or its span is still in flight
+    return min(roots, key=lambda s: s["start"]) if roots else None
+
+def critical_path(span: dict, children: dict, limit: float = None) -> list:
+    """
+    Returns [(span, self_ms)] for the chain of work that determined when `span`
+    finished. Walks back from the span's end, each time descending into the
+    child that finished last before the cursor; gaps between them are the
+    span's own (self) time.
+    """
+    end = min(span["end"], limit) if limit is not None else span["end"]
+    cursor = end
+    self_s = 0.0
+    path = []
+    for child in sorted(children.get(span["span_id"], []), key=lambda c: c["end"], reverse=True):
+        if child["start"] >= cursor:
+            continue
+        child_end = min(child["end"], cursor)
+        self_s += cursor - child_end
+        path.extend(critical_path(child, children, child_end))
+        cursor = max(child["start"], span["start"])
+    self_s += max(0.0, cursor - span["start"])
+    return [(span, self_s * 1000)] + path
+
+def hop_name(span: dict) -> str:
+    return f"{span.get('service', '?')}:{span['name']}"
+
+def analyze(spans: list) -> dict:
+    root = find_root(spans)
+    if root is None:
+        return None
+    children = defaultdict(list)
+    for s in spans:
+        if s is not root:
+            children[s["parent_id"]].append(s)
+    return {"root": root, "path": critical_path(root, children), "spans": len(spans)}
+
+def print_trace(trace_id: str, result: dict):
+    root = result["root"]
+    total = root["duration_ms"]
+    print(f"\nTrace {trace_id}  {hop_name(root)}  {total:.2f}ms  ({result['spans']} spans)")
+    for span, self_ms in result["path"]:
+        if self_ms < 0.01:
+            continue
+        share = self_ms / total * 100 if total else 0.0
+        detail = span["attrs"].get("statement") or span["attrs"].get("url") or ""
+        print(f"  {self_ms:>9.2f}ms {share:>5.1f}%  {hop_name(span):<40} {detail}")
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Critical-path breakdown of exported traces")
+    parser.add_argument("--file", default=TRACE_FILE)
+    parser.add_argument("--trace", default=None, help="Only show this trace id")
+    parser.add_argument("--root", default=None, help="Only traces whose root span name contains this, e.g. /share")
+    parser.add_argument("--top", type=int, default=5, help="Show the N slowest traces in detail")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for trace_id, spans in load_traces(args.file).items():
+        if args.trace and trace_id != args.trace:
+            continue
+        result = analyze(spans)
+        if result is None or (args.root and args.root not in result["root"]["name"]):
+            continue
+        results[trace_id] = result
+    if not results:
+        print("No matching traces.")
+        return
+
+    slowest = sorted(results.items(), key=lambda kv: kv[1]["root"]["duration_ms"], reverse=True)
+    for trace_id, result in slowest[:args.top]:
+        print_trace(trace_id, result)
+
+    # Where the time goes across all matching traces
+    totals = defaultdict(float)
+    for result in results.values():
+        for span, self_ms in result["path"]:
+            totals[hop_name(span)] += self_ms
+    grand = sum(totals.values())
+    print(f"\nCritical-path time by hop over {len(results)} trace(s):")
+    for hop, ms in sorted(totals.items(), key=lambda kv: kv[1], reverse=True):
+        print(f"  {ms / len(results):>9.2f}ms avg {ms / grand * 100 if grand else 0:>5.1f}%  {hop}")
+
+if __name__ == "__main__":
+    main()
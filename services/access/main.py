@@ -1,13 +1,26 @@
 from fastapi import FastAPI, HTTPException, BackgroundTasks
 from pydantic import BaseModel
 import sqlite3
+import sys
 import os
 
+# Add project root to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
+
+from common import tracing, metrics, profiler, deadline, serve
+
 app = FastAPI(title="Access Control Service")
+tracing.instrument_app(app, "access")
+metrics.instrument_app(app, "access")
+profiler.instrument_app(app, "access")
+deadline.instrument_app(app)
 DB_PATH = "access.db"
 
+def get_db_connection():
+    return sqlite3.connect(DB_PATH, factory=tracing.TracedConnection)
+
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     # Users: id, username, role, active
     c.execute('''CREATE TABLE IF NOT EXISTS users
@@ -40,7 +53,7 @@ class AuthorizeRequest(BaseModel):
 
 @app.post("/authorize")
 def authorize(req: AuthorizeRequest):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     
     # Check user active
@@ -75,7 +88,7 @@ class UserRequest(BaseModel):
 
 @app.post("/users")
 def create_user(req: UserRequest):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     try:
         c.execute("INSERT INTO users VALUES (?, ?, 1)", (req.username, req.role))
@@ -91,7 +104,7 @@ class RevokeRequest(BaseModel):
 
 @app.post("/revoke")
 def revoke_user(req: RevokeRequest):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db_connection()
     c = conn.cursor()
     c.execute("UPDATE users SET active=0 WHERE username=?", (req.username,))
     conn.commit()
@@ -99,6 +112,10 @@ def revoke_user(req: RevokeRequest):
     return {"status": "revoked", "username": req.username}
 
 if __name__ == "__main__":
-    import uvicorn
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    serve.add_arguments(parser)
+    args = parser.parse_args()
     print("Starting Access Service on port 8008")
-    uvicorn.run(app, host="0.0.0.0", port=8008)
+    serve.run(app, "services.access.main:app", 8008, args.workers)
@@ -1,7 +1,12 @@
-import hashlib
 import json
+import os
+import sqlite3
+import threading
 import time
 
+from common import offload
+from common.tracing import TracedConnection
+
 class Block:
     def __init__(self, index, timestamp, transactions, prev_hash, nonce=0):
         self.index = index
@@ -17,7 +22,15 @@ class Block:
         if 'hash' in data:
             del data['hash']
         block_string = json.dumps(data, sort_keys=True)
-        return hashlib.sha256(block_string.encode()).hexdigest()
+        # Blocks carrying large transactions go to the offload pool when it is enabled
+        return offload.sha256_hex(block_string.encode())
+
+    @classmethod
+    def from_dict(cls, data):
+        # Restores a stored block as-is; validate_chain re-checks its hash
+        block = cls.__new__(cls)
+        block.__dict__.update(data)
+        return block
 
 class Blockchain:
     def __init__(self):
@@ -53,9 +66,10 @@ class Blockchain:
         return new_block
 
     def validate_chain(self):
-        for i in range(1, len(self.chain)):
-            curr = self.chain[i]
-            prev = self.chain[i-1]
+        chain = self.chain
+        for i in range(1, len(chain)):
+            curr = chain[i]
+            prev = chain[i-1]
             
             # Check 1: Hash integrity
             if curr.hash != curr.compute_hash():
@@ -65,3 +79,81 @@ class Blockchain:
             if curr.prev_hash != prev.hash:
                 return False
         return True
+
+class SharedLedger(Blockchain):
+    """
+    The chain kept in a SQLite file, for running the service with several
+    worker processes. Appends take SQLite's write lock (BEGIN IMMEDIATE), so
+    blocks from every worker go through one writer at a time and always link
+    to the current tip. Each worker keeps the chain in memory and only reads
+    the blocks other workers added since it last looked.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.pending_transactions = []
+        self._chain = []
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, isolation_level=None,
+                                     check_same_thread=False, factory=TracedConnection)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS blocks (idx INTEGER PRIMARY KEY, block TEXT)")
+        with self._lock:
+            # Whichever worker gets here first writes the genesis block
+            self._write(lambda: None if self._chain else [])
+
+    @staticmethod
+    def reset(path: str):
+        """
+        Starts a fresh chain, like a restart of the in-memory ledger. Call
+        before the workers start.
+        """
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    @property
+    def chain(self):
+        with self._lock:
+            self._catch_up()
+            return self._chain
+
+    def _catch_up(self):
+        rows = self._conn.execute("SELECT block FROM blocks WHERE idx >= ? ORDER BY idx",
+                                  (len(self._chain),)).fetchall()
+        for (data,) in rows:
+            self._chain.append(Block.from_dict(json.loads(data)))
+
+    def _write(self, get_transactions):
+        """
+        Appends a block for get_transactions() under the write lock; None means
+        nothing to append. Caller holds self._lock.
+        """
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._catch_up()
+            transactions = get_transactions()
+            if transactions is None:
+                self._conn.execute("ROLLBACK")
+                return False
+            if self._chain:
+                block = Block(len(self._chain), time.time(), transactions, self._chain[-1].hash)
+            else:
+                block = Block(0, time.time(), [], "0")
+            self._conn.execute("INSERT INTO blocks (idx, block) VALUES (?, ?)",
+                               (block.index, json.dumps(block.__dict__)))
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._chain.append(block)
+        return block
+
+    def add_transaction(self, tx_data):
+        # Mines immediately, like Blockchain
+        with self._lock:
+            return self._write(lambda: [tx_data])
+
+    def mine(self):
+        with self._lock:
+            transactions, self.pending_transactions = self.pending_transactions, []
+            return self._write(lambda: transactions or None)
@@ -6,10 +6,21 @@ import os
 # Add project root to sys.path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
 
-from services.blockchain.ledger import Blockchain
+from services.blockchain.ledger import Blockchain, SharedLedger
+from common import tracing, metrics, profiler, deadline, serve
 
 app = FastAPI(title="Blockchain Service")
-blockchain = Blockchain()
+tracing.instrument_app(app, "blockchain")
+metrics.instrument_app(app, "blockchain")
+profiler.instrument_app(app, "blockchain")
+deadline.instrument_app(app)
+
+# Workers share one chain through this file; a single process keeps it in memory
+LEDGER_DB = "ledger.db"
+blockchain = SharedLedger(LEDGER_DB) if serve.worker_count() > 1 else Blockchain()
+
+MINE_LATENCY = metrics.histogram("ledger_mine_duration_seconds", "Time to mine a block for one transaction")
+metrics.gauge("ledger_height", "Blocks in the chain", fn=lambda: len(blockchain.chain))
 
 @app.get("/health")
 def health():
@@ -25,7 +36,8 @@ class Transaction(BaseModel):
 def add_transaction(tx: Transaction):
     # Depending on implementation, add_transaction might return a block or T/F
     # Our ledger.py mines immediately
-    new_block = blockchain.add_transaction(tx.dict())
+    with tracing.span("ledger.mine"), MINE_LATENCY.time():
+        new_block = blockchain.add_transaction(tx.dict())
     return {
         "status": "mined",
         "block_index": new_block.index,
@@ -46,6 +58,13 @@ def validate_chain():
     return {"is_valid": is_valid}
 
 if __name__ == "__main__":
-    import uvicorn
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    serve.add_arguments(parser)
+    args = parser.parse_args()
+    if args.workers > 1:
+        SharedLedger.reset(LEDGER_DB)
+
     print("Starting Blockchain Service on port 8006")
-    uvicorn.run(app, host="0.0.0.0", port=8006)
+    serve.run(app, "services.blockchain.main:app", 8006, args.workers)
@@ -1,12 +1,47 @@
 import base64
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
 import requests
-from Crypto.Cipher import AES
+from Crypto.Hash import SHA256
+from Crypto.Protocol.KDF import HKDF
 from Crypto.Random import get_random_bytes
 from fastapi import BackgroundTasks
 
+from common import tracing, metrics, offload, kms_router
+
 KMS_URL = "http://localhost:8005"
 BLOCKCHAIN_URL = "http://localhost:8006"
 
+# KMS shards, each a primary and its read replicas (see kms_router); a
+# single shard at KMS_URL by default. Key reads are hedged across a shard's copies
+KMS_SHARDS = kms_router.parse_shards(os.environ.get("KMS_SHARDS", "")) or [[KMS_URL]]
+kms = kms_router.KMSRouter(KMS_SHARDS)
+
+KMS_LATENCY = metrics.histogram("kms_call_duration_seconds", "Round trip of key calls to the KMS", ("operation",))
+
+# Derived file keys: with DERIVE_FILE_KEYS=1, a tenant's files get keys
+# derived (HKDF-SHA256) from the tenant's master key, the key version and a
+# random per-file id, all carried in the key_id:
+#   dk.<version>.<file id>.<tenant_id>
+# The KMS then stores one row per tenant key version instead of one per file,
+# and decrypts derive the key locally from a cached master key. The file id
+# is random rather than the client's file_id so the key_id stays unguessable.
+DERIVE_FILE_KEYS = os.environ.get("DERIVE_FILE_KEYS", "0") == "1"
+DERIVED_PREFIX = "dk"
+# How long the latest master key version is trusted before asking the KMS again
+MASTER_VERSION_TTL = 60.0
+
+_master_keys = {} # (tenant_id, version) -> key; versions never change
+_latest_versions = {} # tenant_id -> (version, fetched_at)
+_master_lock = threading.Lock()
+_pre_public_keys = {} # user_id -> PRE public key
+
+DERIVED_KEYS = metrics.counter("derived_keys_total", "File keys derived locally from master keys", ("operation",))
+
 def log_event(user: str, action: str, file_id: str, details: dict):
     try:
         requests.post(f"{BLOCKCHAIN_URL}/tx", json={
@@ -18,20 +53,162 @@ def log_event(user: str, action: str, file_id: str, details: dict):
     except:
         pass # Fire and forget failure for MVI
 
+# Keys fetched ahead for the batch being served (see prefetched)
+_prefetched = contextvars.ContextVar("prefetched_keys", default=None)
+# Larger sets go through the KMS's streaming variant
+GET_KEYS_MAX = 5000
+
+def _fetch_keys(base_url: str, key_ids: list) -> dict:
+    if len(key_ids) <= GET_KEYS_MAX:
+        resp = requests.post(f"{base_url}/get_keys", json={"key_ids": key_ids}, timeout=5)
+        resp.raise_for_status()
+        body = resp.json()
+        return {**body["keys"], **dict.fromkeys(body["missing"])}
+    keys = {}
+    with requests.post(f"{base_url}/get_keys/stream", json={"key_ids": key_ids}, timeout=5, stream=True) as resp:
+        resp.raise_for_status()
+        for line in resp.iter_lines():
+            item = json.loads(line)
+            keys[item["key_id"]] = None if item.get("missing") else item["key_bytes_b64"]
+    return keys
+
+def get_keys_from_kms(key_ids: list) -> dict:
+    """
+    key_id -> key (None if the KMS has no such key), in one round trip per
+    KMS shard, made in parallel. Keys on a shard that failed are left out.
+    Derived keys are computed locally (one master key fetch per uncached tenant).
+    """
+    keys = {}
+    stored = []
+    for key_id in dict.fromkeys(key_ids):
+        if parse_derived_key_id(key_id):
+            keys[key_id] = get_key_from_kms(key_id)
+        else:
+            stored.append(key_id)
+    if stored:
+        with KMS_LATENCY.labels("get_keys").time():
+            found = kms.read_many(stored, _fetch_keys)
+        keys.update((key_id, base64.b64decode(key_b64) if key_b64 else None) for key_id, key_b64 in found.items())
+    return keys
+
+@contextlib.contextmanager
+def prefetched(keys: dict):
+    """
+    Serves get_key_from_kms calls inside the block from `keys`, as fetched
+    ahead by get_keys_from_kms. Keys it doesn't cover are fetched as usual.
+    """
+    token = _prefetched.set(keys)
+    try:
+        yield
+    finally:
+        _prefetched.reset(token)
+
+def _fetch_key(base_url: str, key_id: str) -> str:
+    resp = requests.post(f"{base_url}/get_key", json={"key_id": key_id}, timeout=2)
+    resp.raise_for_status()
+    return resp.json()["key_bytes_b64"]
+
+def _fetch_master_key(base_url: str, tenant_id: str, version: int = None) -> dict:
+    resp = requests.post(f"{base_url}/master_key", json={"tenant_id": tenant_id, "version": version}, timeout=2)
+    resp.raise_for_status()
+    return resp.json()
+
+def master_key(tenant_id: str, version: int = None) -> tuple:
+    """
+    (version, key) of a tenant's master key; the latest version when none is
+    given. Cached, so most derivations never reach the KMS.
+    """
+    with _master_lock:
+        if version is None:
+            latest = _latest_versions.get(tenant_id)
+            if latest and time.monotonic() - latest[1] < MASTER_VERSION_TTL:
+                version = latest[0]
+        if version is not None and (tenant_id, version) in _master_keys:
+            return version, _master_keys[(tenant_id, version)]
+    try:
+        with KMS_LATENCY.labels("master_key").time():
+            body = kms.read(tenant_id, lambda base_url: _fetch_master_key(base_url, tenant_id, version))
+    except Exception as e:
+        raise ValueError(f"Failed to fetch master key from KMS: {e}")
+    key = base64.b64decode(body["key_bytes_b64"])
+    with _master_lock:
+        _master_keys[(tenant_id, body["version"])] = key
+        if version is None:
+            _latest_versions[tenant_id] = (body["version"], time.monotonic())
+    return body["version"], key
+
+def derive_file_key(master: bytes, tenant_id: str, version: int, file_id: str) -> bytes:
+    return HKDF(master, 32, b"", SHA256, context=f"file-key|{tenant_id}|{version}|{file_id}".encode())
+
+def parse_derived_key_id(key_id: str):
+    """
+    (tenant_id, version, file_id) of a derived key_id, or None for KMS key ids.
+    """
+    parts = key_id.split(".", 3)
+    if len(parts) != 4 or parts[0] != DERIVED_PREFIX or not parts[1].isdigit():
+        return None
+    return parts[3], int(parts[1]), parts[2]
+
+def create_file_key(tenant_id: str = None) -> str:
+    """
+    key_id for a new file: derived from the tenant's master key when enabled,
+    otherwise a new random key stored in the KMS.
+    """
+    if not (DERIVE_FILE_KEYS and tenant_id):
+        return create_key_in_kms()
+    version, _ = master_key(tenant_id)
+    file_id = base64.urlsafe_b64encode(get_random_bytes(12)).decode()
+    DERIVED_KEYS.labels("create").inc()
+    return f"{DERIVED_PREFIX}.{version}.{file_id}.{tenant_id}"
+
 def get_key_from_kms(key_id: str) -> bytes:
+    prefetched = _prefetched.get()
+    if prefetched and key_id in prefetched:
+        if prefetched[key_id] is None:
+            raise ValueError("Failed to fetch key from KMS: not found")
+        return prefetched[key_id]
+    derived = parse_derived_key_id(key_id)
+    if derived:
+        tenant_id, version, file_id = derived
+        _, master = master_key(tenant_id, version)
+        DERIVED_KEYS.labels("get").inc()
+        return derive_file_key(master, tenant_id, version, file_id)
     try:
-        resp = requests.post(f"{KMS_URL}/get_key", json={"key_id": key_id}, timeout=2)
-        resp.raise_for_status()
-        key_b64 = resp.json()["key_bytes_b64"]
+        with KMS_LATENCY.labels("get_key").time():
+            key_b64 = kms.read(key_id, lambda base_url: _fetch_key(base_url, key_id))
         return base64.b64decode(key_b64)
     except Exception as e:
         raise ValueError(f"Failed to fetch key from KMS: {e}")
 
+def _fetch_pre_public_key(base_url: str, user_id: str) -> str:
+    resp = requests.post(f"{base_url}/pre/public_key", json={"user_id": user_id}, timeout=2)
+    resp.raise_for_status()
+    return resp.json()["public_key_b64"]
+
+def pre_public_key(user_id: str) -> bytes:
+    """
+    A user's proxy re-encryption public key (created by the KMS on first
+    use). Cached; a user's key pair never changes.
+    """
+    public = _pre_public_keys.get(user_id)
+    if public is None:
+        try:
+            with KMS_LATENCY.labels("pre_public_key").time():
+                public_b64 = kms.read(user_id, lambda base_url: _fetch_pre_public_key(base_url, user_id))
+        except Exception as e:
+            raise ValueError(f"Failed to fetch PRE public key from KMS: {e}")
+        public = _pre_public_keys[user_id] = base64.b64decode(public_b64)
+    return public
+
+def _generate_key(base_url: str) -> str:
+    resp = requests.post(f"{base_url}/generate_key", json={"key_len": 32}, timeout=2)
+    resp.raise_for_status()
+    return resp.json()["key_id"]
+
 def create_key_in_kms() -> str:
     try:
-        resp = requests.post(f"{KMS_URL}/generate_key", json={"key_len": 32}, timeout=2)
-        resp.raise_for_status()
-        return resp.json()["key_id"]
+        with KMS_LATENCY.labels("generate_key").time():
+            return kms.create(_generate_key)
     except Exception as e:
         raise ValueError(f"Failed to generate key in KMS: {e}")
 
@@ -45,12 +222,13 @@ def encrypt_data(data: bytes, key_id: str = None) -> dict:
     
     key = get_key_from_kms(key_id)
 
-    cipher = AES.new(key, AES.MODE_GCM)
-    ciphertext, tag = cipher.encrypt_and_digest(data)
+    # Large payloads go to the offload pool when OFFLOAD_THRESHOLD is set
+    with tracing.span("aes_gcm.encrypt", bytes=len(data)):
+        nonce, ciphertext, tag = offload.aes_gcm_encrypt(key, data)
 
     return {
         "key_id": key_id,
-        "nonce": base64.b64encode(cipher.nonce).decode('utf-8'),
+        "nonce": base64.b64encode(nonce).decode('utf-8'),
         "ciphertext": base64.b64encode(ciphertext).decode('utf-8'),
         "tag": base64.b64encode(tag).decode('utf-8')
     }
@@ -66,7 +244,7 @@ def decrypt_data(encrypted_payload: dict, key_id: str) -> bytes:
     ciphertext = base64.b64decode(encrypted_payload['ciphertext'])
     tag = base64.b64decode(encrypted_payload['tag'])
 
-    cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
-    plaintext = cipher.decrypt_and_verify(ciphertext, tag)
+    with tracing.span("aes_gcm.decrypt", bytes=len(ciphertext)):
+        plaintext = offload.aes_gcm_decrypt(key, nonce, ciphertext, tag)
     
     return plaintext
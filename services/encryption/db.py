@@ -0,0 +1,73 @@
+import sqlite3
+
+from common.tracing import TracedConnection
+
+DB_PATH = "encryption.db"
+
+def init_db():
+    conn = sqlite3.connect(DB_PATH)
+    conn.execute("PRAGMA journal_mode=WAL")
+    c = conn.cursor()
+    # KMS key each deduplicating tenant's chunk keys and ids are derived from
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS dedup_tenants (
+            tenant_id TEXT PRIMARY KEY,
+            key_id TEXT NOT NULL
+        )
+    ''')
+    # Chunk index: one encrypted copy per distinct chunk per tenant, kept in
+    # the pack store (older rows hold the ciphertext inline)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS chunks (
+            tenant_id TEXT,
+            chunk_id TEXT,
+            size INTEGER,
+            ciphertext BLOB,
+            refs INTEGER DEFAULT 1,
+            digest TEXT,
+            PRIMARY KEY (tenant_id, chunk_id)
+        )
+    ''')
+    try:
+        c.execute("ALTER TABLE chunks ADD COLUMN digest TEXT")
+    except sqlite3.OperationalError:
+        pass
+    # Where each content-addressed blob sits in the packfiles
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS pack_index (
+            digest TEXT PRIMARY KEY,
+            pack INTEGER,
+            offset INTEGER,
+            length INTEGER
+        )
+    ''')
+    # Stored objects: the segmented container header (or a dedup manifest),
+    # with the segments themselves in the pack store
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS objects (
+            cipher_id TEXT PRIMARY KEY,
+            key_id TEXT,
+            format TEXT,
+            header BLOB,
+            manifest TEXT,
+            size INTEGER,
+            tenant_id TEXT,
+            source_id TEXT,
+            created_at TEXT
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS object_segments (
+            cipher_id TEXT,
+            idx INTEGER,
+            digest TEXT,
+            PRIMARY KEY (cipher_id, idx)
+        )
+    ''')
+    conn.commit()
+    conn.close()
+
+def get_db_connection():
+    conn = sqlite3.connect(DB_PATH, timeout=10, factory=TracedConnection)
+    conn.row_factory = sqlite3.Row
+    return conn
@@ -0,0 +1,219 @@
+import base64
+import hashlib
+import hmac
+import json
+from collections import Counter
+
+import numpy as np
+from Crypto.Cipher import AES
+
+from common import metrics, tracing, offload
+from services.encryption import crypto, db, packstore
+
+# Opt-in per-tenant deduplication with convergent encryption. A file is cut
+# into content-defined chunks; each chunk is encrypted under a key derived
+# from its content, so a chunk the tenant uploaded before has the same id
+# and ciphertext and is stored (and encrypted) only once. Ids, keys and the
+# cut points themselves are keyed with a per-tenant secret, so one tenant
+# can't learn whether another holds some known content. The file is
+# represented by a manifest (chunk ids and keys) encrypted with that secret.
+MIN_CHUNK = 2 * 1024
+AVG_CHUNK_BITS = 13 # ~8 KiB between cut points
+MAX_CHUNK = 64 * 1024
+# Bytes the rolling hash looks at
+WINDOW = 48
+# Cut points are searched this many bytes at a time to bound memory
+SCAN_BLOCK = 1024 * 1024
+# Safe with convergent keys: a key only ever encrypts one plaintext
+CHUNK_NONCE = bytes(12)
+# SQLite variable limit per IN (...) query
+LOOKUP_BATCH = 500
+
+_MIX = np.uint64(0x9E3779B1)
+_tenant_keys = {}
+
+DEDUP_CHUNKS = metrics.counter("dedup_chunks_total", "Chunks in deduplicated uploads", ("result",))
+DEDUP_BYTES = metrics.counter("dedup_bytes_total", "Bytes in deduplicated uploads", ("result",))
+
+def _subkey(secret: bytes, label: bytes) -> bytes:
+    return hmac.new(secret, label, hashlib.sha256).digest()
+
+class TenantKeys:
+    def __init__(self, key_id: str, secret: bytes):
+        self.key_id = key_id
+        self.secret = secret
+        # Random per-byte values for the rolling hash, so cut points are secret too
+        self.gear = np.frombuffer(hashlib.shake_256(_subkey(secret, b"dedup-gear")).digest(256 * 4),
+                                  dtype=np.uint32).astype(np.uint64)
+        self._id_key = _subkey(secret, b"dedup-chunk-id")
+        self._chunk_key = _subkey(secret, b"dedup-chunk-key")
+        self.manifest_key = _subkey(secret, b"dedup-manifest")
+
+    def chunk_id(self, chunk) -> str:
+        return hmac.new(self._id_key, chunk, hashlib.sha256).hexdigest()
+
+    def chunk_key(self, chunk) -> bytes:
+        return hmac.new(self._chunk_key, chunk, hashlib.sha256).digest()
+
+def _cut_candidates(data, gear: np.ndarray) -> np.ndarray:
+    """
+    Offsets where the rolling hash of the preceding WINDOW bytes matches the
+    cut pattern. The hash is a moving sum of gear values (a cumsum
+    difference, so numpy computes it for a whole block at once).
+    """
+    arr = np.frombuffer(data, dtype=np.uint8)
+    found = []
+    for start in range(0, len(arr), SCAN_BLOCK):
+        lo = max(0, start - WINDOW) # Overlap so windows spanning blocks are seen
+        sums = np.cumsum(gear[arr[lo:start + SCAN_BLOCK]])
+        window = sums[WINDOW:] - sums[:-WINDOW]
+        mixed = (window * _MIX) & np.uint64(0xFFFFFFFF)
+        hits = np.flatnonzero((mixed >> np.uint64(32 - AVG_CHUNK_BITS)) == 0)
+        found.append(hits + lo + WINDOW + 1)
+    return np.concatenate(found) if found else np.empty(0, dtype=np.int64)
+
+def chunk_boundaries(data, gear: np.ndarray) -> list:
+    """
+    End offsets of the chunks of `data`, each MIN_CHUNK..MAX_CHUNK long
+    (except the last).
+    """
+    candidates = _cut_candidates(data, gear)
+    ends = []
+    start = 0
+    while start < len(data):
+        i = np.searchsorted(candidates, start + MIN_CHUNK)
+        if i < len(candidates) and candidates[i] <= start + MAX_CHUNK:
+            end = int(candidates[i])
+        else:
+            end = min(len(data), start + MAX_CHUNK)
+        ends.append(end)
+        start = end
+    return ends
+
+# --- Keys ---
+
+def keys_for(key_id: str) -> TenantKeys:
+    keys = _tenant_keys.get(key_id)
+    if keys is None:
+        keys = _tenant_keys[key_id] = TenantKeys(key_id, crypto.get_key_from_kms(key_id))
+    return keys
+
+def tenant_keys(tenant_id: str) -> TenantKeys:
+    conn = db.get_db_connection()
+    try:
+        row = conn.execute("SELECT key_id FROM dedup_tenants WHERE tenant_id = ?", (tenant_id,)).fetchone()
+        if row is None:
+            # First deduplicated upload; a concurrent one may win the insert
+            conn.execute("INSERT OR IGNORE INTO dedup_tenants (tenant_id, key_id) VALUES (?, ?)",
+                         (tenant_id, crypto.create_key_in_kms()))
+            conn.commit()
+            row = conn.execute("SELECT key_id FROM dedup_tenants WHERE tenant_id = ?", (tenant_id,)).fetchone()
+    finally:
+        conn.close()
+    return keys_for(row['key_id'])
+
+# --- Chunk index ---
+
+def _aad(tenant_id: str, chunk_id: str) -> bytes:
+    # Binds each stored ciphertext to its row
+    return f"{tenant_id}:{chunk_id}".encode()
+
+def _existing(conn, tenant_id: str, chunk_ids: list) -> dict:
+    """
+    chunk_id -> (pack store digest, inline ciphertext) for chunks already stored.
+    """
+    rows = {}
+    for i in range(0, len(chunk_ids), LOOKUP_BATCH):
+        batch = chunk_ids[i:i + LOOKUP_BATCH]
+        rows.update((row['chunk_id'], (row['digest'], row['ciphertext'])) for row in conn.execute(
+            f"SELECT chunk_id, digest, ciphertext FROM chunks WHERE tenant_id = ? AND chunk_id IN ({','.join('?' * len(batch))})",
+            [tenant_id, *batch]))
+    return rows
+
+def encrypt(tenant_id: str, data: bytes) -> dict:
+    """
+    Stores the tenant's new chunks of `data` and returns the encrypted manifest
+    (nonce, ciphertext, tag), the tenant's key_id and dedup stats.
+    """
+    keys = tenant_keys(tenant_id)
+    with tracing.span("dedup.chunk", bytes=len(data)):
+        ends = chunk_boundaries(data, keys.gear)
+    view = memoryview(data)
+    chunks = []
+    start = 0
+    for end in ends:
+        chunk = view[start:end]
+        chunks.append((keys.chunk_id(chunk), chunk))
+        start = end
+
+    refs = Counter(chunk_id for chunk_id, _ in chunks)
+    conn = db.get_db_connection()
+    try:
+        known = _existing(conn, tenant_id, list(refs))
+        new = {}
+        with tracing.span("dedup.encrypt_chunks"):
+            for chunk_id, chunk in chunks:
+                if chunk_id in known or chunk_id in new:
+                    continue
+                cipher = AES.new(keys.chunk_key(chunk), AES.MODE_GCM, nonce=CHUNK_NONCE)
+                cipher.update(_aad(tenant_id, chunk_id))
+                ciphertext, tag = cipher.encrypt_and_digest(chunk)
+                new[chunk_id] = (len(chunk), ciphertext + tag)
+        digests = packstore.store.put_many([blob for _, blob in new.values()])
+        # Two uploads may add the same chunk at once; the ciphertext is identical either way
+        conn.executemany("INSERT OR IGNORE INTO chunks (tenant_id, chunk_id, size, digest, refs) VALUES (?, ?, ?, ?, 0)",
+                         [(tenant_id, chunk_id, size, digest)
+                          for (chunk_id, (size, _)), digest in zip(new.items(), digests)])
+        conn.executemany("UPDATE chunks SET refs = refs + ? WHERE tenant_id = ? AND chunk_id = ?",
+                         [(n, tenant_id, chunk_id) for chunk_id, n in refs.items()])
+        conn.commit()
+    finally:
+        conn.close()
+
+    new_bytes = sum(size for size, _ in new.values())
+    DEDUP_CHUNKS.labels("new").inc(len(new))
+    DEDUP_CHUNKS.labels("duplicate").inc(len(chunks) - len(new))
+    DEDUP_BYTES.labels("new").inc(new_bytes)
+    DEDUP_BYTES.labels("duplicate").inc(len(data) - new_bytes)
+
+    manifest = json.dumps({
+        "tenant_id": tenant_id,
+        "size": len(data),
+        "chunks": [[chunk_id, base64.b64encode(keys.chunk_key(chunk)).decode()] for chunk_id, chunk in chunks]
+    }).encode()
+    nonce, ciphertext, tag = offload.aes_gcm_encrypt(keys.manifest_key, manifest)
+    return {
+        "key_id": keys.key_id,
+        "nonce": base64.b64encode(nonce).decode(),
+        "ciphertext": base64.b64encode(ciphertext).decode(),
+        "tag": base64.b64encode(tag).decode(),
+        "stats": {"chunks": len(chunks), "new_chunks": len(new), "new_bytes": new_bytes}
+    }
+
+def decrypt(payload: dict, key_id: str) -> bytes:
+    keys = keys_for(key_id)
+    manifest = json.loads(offload.aes_gcm_decrypt(keys.manifest_key, base64.b64decode(payload['nonce']),
+                                                  base64.b64decode(payload['ciphertext']),
+                                                  base64.b64decode(payload['tag'])))
+    tenant_id = manifest['tenant_id']
+    conn = db.get_db_connection()
+    try:
+        stored = _existing(conn, tenant_id, list({chunk_id for chunk_id, _ in manifest['chunks']}))
+    finally:
+        conn.close()
+
+    missing = [chunk_id for chunk_id, _ in manifest['chunks'] if chunk_id not in stored]
+    if missing:
+        raise ValueError(f"Chunk {missing[0]} missing from the chunk index")
+    packed = [chunk_id for chunk_id, (digest, _) in stored.items() if digest]
+    blobs = dict(zip(packed, packstore.store.get_many([stored[chunk_id][0] for chunk_id in packed])))
+
+    out = bytearray()
+    for chunk_id, chunk_key in manifest['chunks']:
+        blob = blobs.get(chunk_id) or stored[chunk_id][1]
+        cipher = AES.new(base64.b64decode(chunk_key), AES.MODE_GCM, nonce=CHUNK_NONCE)
+        cipher.update(_aad(tenant_id, chunk_id))
+        out += cipher.decrypt_and_verify(blob[:-16], blob[-16:])
+    if len(out) != manifest['size']:
+        raise ValueError("Reassembled size doesn't match the manifest")
+    return bytes(out)
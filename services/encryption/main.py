@@ -1,67 +1,275 @@
-from fastapi import FastAPI, UploadFile, HTTPException, BackgroundTasks, Body
+from fastapi import FastAPI, UploadFile, HTTPException, BackgroundTasks, Body, Header
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel
 import base64
+import itertools
+import requests
 import sys
 import os
 
 # Add project root to sys.path to import common
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
 
-from common.schemas import EncryptRequest, EncryptResponse, DecryptRequest, DecryptResponse
-from services.encryption import crypto, wrappers
+from common.schemas import (EncryptRequest, EncryptResponse, DecryptRequest, DecryptResponse,
+                            DecryptBatchRequest, DecryptBatchResult, DecryptBatchResponse)
+from services.encryption import crypto, wrappers, dedup, db, objects, segments
+from common import tracing, metrics, profiler, deadline, serve, pre
 
 app = FastAPI(title="Encryption Service")
+tracing.instrument_app(app, "encryption")
+metrics.instrument_app(app, "encryption")
+profiler.instrument_app(app, "encryption")
+deadline.instrument_app(app)
+
+# Re-encryption of stored objects goes through the proxy tier
+PROXY_URL = "http://localhost:8002"
+
+@app.on_event("startup")
+def startup():
+    db.init_db()
 
 @app.get("/health")
 def health():
     return {"status": "ok"}
 
+# Marks blobs holding a dedup manifest rather than the file itself
+DEDUP_PREFIX = "dedup"
+
+def pack_cipher_blob(result: dict, prefix: str = None) -> str:
+    # We pack nonce+ciphertext+tag into a single blob for the client
+    # Format: nonce|ciphertext|tag (all base64), optionally after a format prefix
+    combined_cipher = f"{result['nonce']}|{result['ciphertext']}|{result['tag']}"
+    if prefix:
+        combined_cipher = f"{prefix}|{combined_cipher}"
+    return base64.b64encode(combined_cipher.encode()).decode()
+
+def unpack_cipher_blob(blob: str) -> dict:
+    raw_cipher_str = base64.b64decode(blob).decode()
+    parts = raw_cipher_str.split('|')
+    prefix = None
+    if len(parts) == 4:
+        prefix, parts = parts[0], parts[1:]
+    if len(parts) != 3 or prefix not in (None, DEDUP_PREFIX):
+        raise ValueError("Invalid cipher format")
+        
+    return {
+        'nonce': parts[0],
+        'ciphertext': parts[1],
+        'tag': parts[2],
+        'prefix': prefix
+    }
+
 @app.post("/encrypt", response_model=EncryptResponse)
-def encrypt(req: EncryptRequest, background_tasks: BackgroundTasks):
+def encrypt(req: EncryptRequest, background_tasks: BackgroundTasks, x_tenant_id: str = Header(None),
+            x_tenant_dedup: str = Header(None)):
     try:
         data = base64.b64decode(req.plaintext)
-        result = crypto.encrypt_data(data)
-        
-        # We pack nonce+ciphertext+tag into a single blob for the client
-        # Format: nonce|ciphertext|tag (all base64)
-        combined_cipher = f"{result['nonce']}|{result['ciphertext']}|{result['tag']}"
-        
-        cid = f"c_{base64.urlsafe_b64encode(os.urandom(4)).decode().strip('=')}"
+        # The gateway passes the tenant in a header rather than rewriting the body
+        tenant_id = x_tenant_id or (req.meta.get("tenant_id") if req.meta else None)
+        # Tenants that opted in share one key and store repeated chunks once
+        deduplicate = x_tenant_dedup == "1" and bool(tenant_id)
+        cid = objects.new_cipher_id()
+        cipher = None
+        if deduplicate:
+            result = dedup.encrypt(tenant_id, data)
+            cipher = pack_cipher_blob(result, DEDUP_PREFIX)
+            if req.store:
+                objects.store_manifest(cid, result['key_id'], cipher, len(data), tenant_id)
+                cipher = None
+        elif req.store:
+            result = objects.store(cid, data, tenant_id, crypto.create_file_key(tenant_id))
+        elif req.segmented:
+            key_id = crypto.create_file_key(tenant_id)
+            with tracing.span("aes_gcm.encrypt", bytes=len(data)):
+                container = segments.encrypt(crypto.get_key_from_kms(key_id), key_id, data)
+            result = {'key_id': key_id}
+            cipher = base64.b64encode(container).decode()
+        else:
+            result = crypto.encrypt_data(data, crypto.create_file_key(tenant_id))
+            cipher = pack_cipher_blob(result) # Return as one blob
         
         # Log to Blockchain
         owner = req.meta.get("owner", "unknown") if req.meta else "unknown"
         file_id = req.meta.get("file_id", "unknown") if req.meta else "unknown"
+        details = {"key_id": result['key_id'], "cid": cid}
+        if tenant_id:
+            details["tenant_id"] = tenant_id
+        if deduplicate:
+            details["dedup"] = result['stats']
+        if req.store:
+            details["stored"] = True
         
-        background_tasks.add_task(crypto.log_event, owner, "ENC_FILE", file_id, {"key_id": result['key_id'], "cid": cid})
+        background_tasks.add_task(crypto.log_event, owner, "ENC_FILE", file_id, details)
         
         return EncryptResponse(
             cipher_id=cid,
-            cipher=base64.b64encode(combined_cipher.encode()).decode(), # Return as one blob
+            cipher=cipher,
             key_id=result['key_id']
         )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def decrypt_range(req: DecryptRequest):
+    """
+    Iterator over the plaintext bytes the request asks for. Segmented
+    ciphertext (stored objects and segmented blobs) only has the segments
+    covering the range decrypted; other formats are decrypted whole and sliced.
+    """
+    if req.offset < 0 or (req.length is not None and req.length < 0):
+        raise ValueError("Invalid range")
+    start = req.offset
+    end = None if req.length is None else start + req.length
+    if req.cipher_id:
+        obj = objects.load(req.cipher_id, req.key_id)
+        if obj['format'] != "dedup":
+            return objects.iter_range(obj, start, end)
+        plaintext_bytes = dedup.decrypt(unpack_cipher_blob(obj['manifest']), req.key_id)
+    else:
+        raw = base64.b64decode(req.cipher)
+        if segments.is_container(raw):
+            header = segments.Header.parse(raw)
+            key = crypto.get_key_from_kms(req.key_id)
+            return segments.iter_range(header, key, lambda batch: segments.container_segments(header, raw, batch),
+                                       start, end)
+        # Unpack the blob
+        payload = unpack_cipher_blob(req.cipher)
+        if payload['prefix'] == DEDUP_PREFIX:
+            plaintext_bytes = dedup.decrypt(payload, req.key_id)
+        else:
+            plaintext_bytes = crypto.decrypt_data(payload, req.key_id)
+    return iter([plaintext_bytes[start:end]])
+
 @app.post("/decrypt", response_model=DecryptResponse)
 def decrypt(req: DecryptRequest):
     try:
-        # Unpack the blob
-        raw_cipher_str = base64.b64decode(req.cipher).decode()
-        parts = raw_cipher_str.split('|')
-        if len(parts) != 3:
-            raise ValueError("Invalid cipher format")
-            
-        payload = {
-            'nonce': parts[0],
-            'ciphertext': parts[1],
-            'tag': parts[2]
-        }
-        
-        plaintext_bytes = crypto.decrypt_data(payload, req.key_id)
-        return DecryptResponse(plaintext=base64.b64encode(plaintext_bytes).decode())
+        pieces = decrypt_range(req)
+        if not req.stream:
+            return DecryptResponse(plaintext=base64.b64encode(b"".join(pieces)).decode())
+        # Fail with a status code if the first batch doesn't verify; past
+        # that, a segment that fails verification aborts the stream
+        first = next(pieces, b"")
+        return StreamingResponse(itertools.chain([first], pieces), media_type="application/octet-stream")
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Object not found")
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
+# Most items one /decrypt/batch call takes
+MAX_BATCH_ITEMS = 1000
+
+@app.post("/decrypt/batch", response_model=DecryptBatchResponse)
+def decrypt_batch(req: DecryptBatchRequest):
+    """
+    Decrypts many blobs or stored objects, resolving all their keys in one
+    KMS round trip first. Items fail independently.
+    """
+    if len(req.items) > MAX_BATCH_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BATCH_ITEMS} items per batch")
+    try:
+        keys = crypto.get_keys_from_kms([item.key_id for item in req.items])
+    except ValueError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+    results = []
+    with crypto.prefetched(keys):
+        for item in req.items:
+            try:
+                plaintext_bytes = b"".join(decrypt_range(item))
+                results.append(DecryptBatchResult(plaintext=base64.b64encode(plaintext_bytes).decode()))
+            except KeyError:
+                results.append(DecryptBatchResult(error="Object not found"))
+            except Exception as e:
+                results.append(DecryptBatchResult(error=str(e)))
+    return DecryptBatchResponse(results=results)
+
+# --- Stored objects ---
+
+def parse_range(value: str, size: int) -> tuple:
+    """
+    [start, end) for a single "bytes=a-b", "bytes=a-" or "bytes=-n" Range header.
+    """
+    unit, _, spec = value.partition("=")
+    first, dash, last = spec.strip().partition("-")
+    if unit.strip() != "bytes" or not dash or "," in spec:
+        raise ValueError("Unsupported range")
+    if not first:
+        start, end = max(0, size - int(last)), size
+    else:
+        start = int(first)
+        end = min(size, int(last) + 1) if last else size
+    if start >= size or end <= start:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+@app.get("/objects/{cipher_id}")
+def read_object(cipher_id: str, key_id: str, range: str = Header(None)):
+    """
+    Streams the plaintext of a stored object, or just the bytes of a Range
+    header; only the segments covering the range are read and decrypted.
+    """
+    try:
+        obj = objects.load(cipher_id, key_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Object not found")
+    size = obj['size']
+    start, end, status = 0, size, 200
+    if range:
+        try:
+            start, end = parse_range(range, size)
+        except ValueError:
+            return Response(status_code=416, headers={"content-range": f"bytes */{size}"})
+        status = 206
+    try:
+        if obj['format'] == "dedup":
+            pieces = iter([dedup.decrypt(unpack_cipher_blob(obj['manifest']), key_id)[start:end]])
+        else:
+            pieces = objects.iter_range(obj, start, end)
+        first = next(pieces, b"")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    headers = {"accept-ranges": "bytes", "content-length": str(end - start)}
+    if status == 206:
+        headers["content-range"] = f"bytes {start}-{end - 1}/{size}"
+    return StreamingResponse(itertools.chain([first], pieces), status_code=status,
+                             media_type="application/octet-stream", headers=headers)
+
+class ObjectReEncryptRequest(BaseModel):
+    key_id: str
+    rekey_id: str
+    owner: str # The rekey's from_user
+
+@app.post("/objects/{cipher_id}/reencrypt")
+def reencrypt_object(cipher_id: str, req: ObjectReEncryptRequest, background_tasks: BackgroundTasks,
+                     x_tenant_id: str = Header(None)):
+    """
+    Shares a stored object with the rekey's recipient. The object's key,
+    wrapped for the owner (see /wrap_key/pre), is the only thing that goes
+    through the proxy; the recipient's copy comes back as `wrapped_key`.
+    The new object shares every segment, and so its key, with the original.
+    """
+    try:
+        obj = objects.load(cipher_id, req.key_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Object not found")
+    try:
+        capsule = pre_wrap(crypto.get_key_from_kms(req.key_id), req.owner)
+    except ValueError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+    try:
+        resp = requests.post(f"{PROXY_URL}/reencrypt", json={"cipher_blob": capsule, "rekey_id": req.rekey_id}, timeout=5)
+    except requests.RequestException as e:
+        raise HTTPException(status_code=502, detail=f"Proxy unavailable: {e!r}")
+    if resp.status_code != 200:
+        raise HTTPException(status_code=resp.status_code, detail="Re-encryption failed")
+    wrapped_key = resp.json()["cipher_re"]
+    if wrapped_key == capsule:
+        # The proxy passed it through: a rekey from before PRE
+        raise HTTPException(status_code=400, detail="Re-Key predates proxy re-encryption; generate a new one")
+    new_id = objects.clone(obj, obj['header'], x_tenant_id)
+
+    background_tasks.add_task(crypto.log_event, x_tenant_id or "unknown", "REENC_OBJECT", cipher_id,
+                              {"rekey_id": req.rekey_id, "cid": new_id})
+    return {"cipher_id": new_id, "key_id": obj['key_id'], "source_id": cipher_id, "wrapped_key": wrapped_key}
+
 class WrapRequest(BaseModel):
     key_id: str
     identity: str
@@ -75,6 +283,33 @@ def wrap_ibe(req: WrapRequest):
     except ValueError:
         raise HTTPException(status_code=404, detail="Key not found")
 
+class PreWrapRequest(BaseModel):
+    key_id: str
+    user_id: str
+
+def pre_wrap(key_bytes: bytes, user_id: str) -> str:
+    return base64.b64encode(pre.encrypt(crypto.pre_public_key(user_id), key_bytes)).decode()
+
+@app.post("/wrap_key/pre")
+def wrap_pre(req: PreWrapRequest):
+    """
+    The data key wrapped for user_id with proxy re-encryption: the proxy
+    can turn it into one for anyone user_id has given a rekey to, and the
+    KMS opens either (/unwrap_key/pre).
+    """
+    try:
+        key_bytes = crypto.get_key_from_kms(req.key_id)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Key not found")
+    try:
+        return {"wrapped": pre_wrap(key_bytes, req.user_id), "key_id": req.key_id}
+    except ValueError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001)
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    serve.add_arguments(parser)
+    args = parser.parse_args()
+    serve.run(app, "services.encryption.main:app", 8001, args.workers)
@@ -0,0 +1,117 @@
+import base64
+import datetime
+import os
+
+from common import tracing
+from services.encryption import crypto, db, packstore, segments
+
+# Stored objects, addressed by cipher_id. A segmented object keeps its
+# container header in the DB and each segment (ciphertext + tag) in the
+# pack store, so reads fetch and decrypt only the segments they cover and
+# a re-encrypted copy shares every segment with its source. Deduplicated
+# uploads are stored as their encrypted manifest (format "dedup").
+
+def new_cipher_id() -> str:
+    return f"c_{base64.urlsafe_b64encode(os.urandom(9)).decode()}"
+
+def _insert(conn, cipher_id: str, key_id: str, fmt: str, header: bytes, manifest: str, size: int,
+            tenant_id: str, source_id: str = None):
+    conn.execute(
+        "INSERT INTO objects (cipher_id, key_id, format, header, manifest, size, tenant_id, source_id, created_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (cipher_id, key_id, fmt, header, manifest, size, tenant_id, source_id, datetime.datetime.now().isoformat()))
+
+def store(cipher_id: str, data: bytes, tenant_id: str = None, key_id: str = None) -> dict:
+    """
+    Encrypts `data` as a segmented container and stores it under `cipher_id`.
+    """
+    if not key_id:
+        key_id = crypto.create_key_in_kms()
+    key = crypto.get_key_from_kms(key_id)
+
+    header = segments.Header(key_id, len(data))
+    src = memoryview(data)
+    blobs = []
+    with tracing.span("aes_gcm.encrypt", bytes=len(data)):
+        for i in range(header.count):
+            start, n = header.plain_span(i)
+            blob = bytearray(n + segments.TAG_SIZE)
+            header.encrypt_segment(key, i, src[start:start + n], memoryview(blob))
+            blobs.append(blob)
+    digests = packstore.store.put_many(blobs)
+
+    conn = db.get_db_connection()
+    try:
+        _insert(conn, cipher_id, key_id, "segmented", header.raw, None, len(data), tenant_id)
+        conn.executemany("INSERT INTO object_segments (cipher_id, idx, digest) VALUES (?, ?, ?)",
+                         [(cipher_id, i, digest) for i, digest in enumerate(digests)])
+        conn.commit()
+    finally:
+        conn.close()
+    return {"cipher_id": cipher_id, "key_id": key_id, "size": len(data), "segments": header.count}
+
+def store_manifest(cipher_id: str, key_id: str, blob: str, size: int, tenant_id: str = None):
+    conn = db.get_db_connection()
+    try:
+        _insert(conn, cipher_id, key_id, "dedup", None, blob, size, tenant_id)
+        conn.commit()
+    finally:
+        conn.close()
+
+def load(cipher_id: str, key_id: str) -> dict:
+    """
+    The object's row. Holding its key_id is what grants access, as for blobs.
+    """
+    conn = db.get_db_connection()
+    row = conn.execute("SELECT * FROM objects WHERE cipher_id = ?", (cipher_id,)).fetchone()
+    conn.close()
+    if row is None or row['key_id'] != key_id:
+        raise KeyError("Object not found")
+    return dict(row)
+
+def segment_digests(cipher_id: str, indices: range) -> list:
+    conn = db.get_db_connection()
+    rows = conn.execute("SELECT idx, digest FROM object_segments WHERE cipher_id = ? AND idx BETWEEN ? AND ? ORDER BY idx",
+                        (cipher_id, indices.start, indices.stop - 1)).fetchall()
+    conn.close()
+    if len(rows) != len(indices):
+        raise ValueError("Object is missing segments")
+    return [row['digest'] for row in rows]
+
+def iter_range(obj: dict, start: int = 0, end: int = None):
+    """
+    Yields plaintext bytes [start, end) of a segmented object, fetching and
+    decrypting only the segments that cover them, a batch at a time.
+    """
+    header = segments.Header.parse(obj['header'])
+    end = header.length if end is None else min(end, header.length)
+    if end <= start:
+        return
+    key = crypto.get_key_from_kms(obj['key_id'])
+
+    def fetch(batch):
+        # Spans can't stay open across yields: a streamed response resumes
+        # the generator in a different context each time
+        with tracing.span("packstore.get", segments=len(batch)):
+            return packstore.store.get_many(segment_digests(obj['cipher_id'], batch))
+
+    yield from segments.iter_range(header, key, fetch, start, end)
+
+def read_range(obj: dict, start: int = 0, end: int = None) -> bytes:
+    return b"".join(iter_range(obj, start, end))
+
+def clone(obj: dict, header: bytes, tenant_id: str = None) -> str:
+    """
+    A new object with the given header that shares all of `obj`'s segments.
+    """
+    cipher_id = new_cipher_id()
+    conn = db.get_db_connection()
+    try:
+        _insert(conn, cipher_id, obj['key_id'], obj['format'], header, obj['manifest'], obj['size'],
+                tenant_id or obj['tenant_id'], obj['cipher_id'])
+        conn.execute("INSERT INTO object_segments (cipher_id, idx, digest) "
+                     "SELECT ?, idx, digest FROM object_segments WHERE cipher_id = ?", (cipher_id, obj['cipher_id']))
+        conn.commit()
+    finally:
+        conn.close()
+    return cipher_id
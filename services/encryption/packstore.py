@@ -0,0 +1,114 @@
+import fcntl
+import hashlib
+import os
+import re
+import threading
+
+from services.encryption import db
+
+# Content-addressed blob store for ciphertext. Blobs are appended to
+# packfiles (objects/pack-<n>.pack) and found through an index in the
+# encryption DB (sha256 -> pack, offset, length), so a store holds a few
+# large files instead of one file per segment, and a blob already present
+# is never written twice. Data is fsynced before its index rows commit,
+# so the index never points past the end of a pack; bytes from a write
+# that crashed before commit are simply unreferenced.
+PACK_DIR = "objects"
+# Start a new packfile past this size
+PACK_SIZE = 256 * 1024 * 1024
+# SQLite variable limit per IN (...) query
+LOOKUP_BATCH = 500
+
+_PACK_NAME = re.compile(r"pack-(\d+)\.pack$")
+
+class PackStore:
+    def __init__(self, root: str = None, pack_size: int = None):
+        self.root = root or PACK_DIR
+        self.pack_size = pack_size or PACK_SIZE
+        # Threads of this process; other workers are kept out by the file lock
+        self._lock = threading.Lock()
+
+    def _path(self, pack: int) -> str:
+        return os.path.join(self.root, f"pack-{pack}.pack")
+
+    def _current_pack(self) -> int:
+        packs = [int(m.group(1)) for m in map(_PACK_NAME.match, os.listdir(self.root)) if m]
+        if not packs:
+            return 0
+        latest = max(packs)
+        return latest + 1 if os.path.getsize(self._path(latest)) >= self.pack_size else latest
+
+    def _lookup(self, conn, digests: list) -> dict:
+        rows = {}
+        for i in range(0, len(digests), LOOKUP_BATCH):
+            batch = digests[i:i + LOOKUP_BATCH]
+            rows.update((row['digest'], (row['pack'], row['offset'], row['length'])) for row in conn.execute(
+                f"SELECT digest, pack, offset, length FROM pack_index WHERE digest IN ({','.join('?' * len(batch))})",
+                batch))
+        return rows
+
+    def put_many(self, blobs: list) -> list:
+        """
+        Stores blobs that aren't stored yet. Returns their digests, in order.
+        """
+        digests = [hashlib.sha256(blob).hexdigest() for blob in blobs]
+        conn = db.get_db_connection()
+        try:
+            known = self._lookup(conn, list(set(digests)))
+            new = {}
+            for digest, blob in zip(digests, blobs):
+                if digest not in known:
+                    new.setdefault(digest, blob)
+            if not new:
+                return digests
+
+            rows = []
+            os.makedirs(self.root, exist_ok=True)
+            with self._lock, open(os.path.join(self.root, "lock"), "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                pack = self._current_pack()
+                with open(self._path(pack), "ab") as f:
+                    offset = f.seek(0, os.SEEK_END)
+                    for digest, blob in new.items():
+                        f.write(blob)
+                        rows.append((digest, pack, offset, len(blob)))
+                        offset += len(blob)
+                    f.flush()
+                    os.fsync(f.fileno())
+            conn.executemany("INSERT OR IGNORE INTO pack_index (digest, pack, offset, length) VALUES (?, ?, ?, ?)", rows)
+            conn.commit()
+            return digests
+        finally:
+            conn.close()
+
+    def get_many(self, digests: list) -> list:
+        """
+        Blobs for `digests`, in order. Raises KeyError for unknown ones.
+        """
+        conn = db.get_db_connection()
+        try:
+            locations = self._lookup(conn, list(set(digests)))
+        finally:
+            conn.close()
+        fds = {}
+        try:
+            blobs = []
+            for digest in digests:
+                if digest not in locations:
+                    raise KeyError(f"Blob {digest} not in the pack index")
+                pack, offset, length = locations[digest]
+                if pack not in fds:
+                    fds[pack] = os.open(self._path(pack), os.O_RDONLY)
+                blobs.append(os.pread(fds[pack], length, offset))
+            return blobs
+        finally:
+            for fd in fds.values():
+                os.close(fd)
+
+    def put(self, blob: bytes) -> str:
+        return self.put_many([blob])[0]
+
+    def get(self, digest: str) -> bytes:
+        return self.get_many([digest])[0]
+
+store = PackStore()
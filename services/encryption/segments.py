@@ -0,0 +1,182 @@
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+from Crypto.Cipher import AES
+
+# Segmented AES-GCM container. The plaintext is split into fixed-size
+# segments that are encrypted and authenticated independently, so any
+# segment can be decrypted (and verified) without touching the others.
+#
+#   header | segment 0 ciphertext | tag | segment 1 ciphertext | tag | ...
+#
+# Segment i uses nonce = nonce_prefix || i (big-endian u32) and the whole
+# header as associated data. The header holds the total length, so dropping
+# or reordering segments fails authentication. Every container has at least
+# one segment, so even an empty one carries a tag.
+MAGIC = b"SGCM"
+VERSION = 1
+TAG_SIZE = 16
+DEFAULT_SEGMENT_SIZE = 64 * 1024
+MAX_SEGMENTS = 2 ** 32
+# Range reads fetch and decrypt this many segments at a time, which bounds
+# their memory; a batch of at least PARALLEL_SEGMENTS is spread over threads
+# (AES-GCM in pycryptodome runs without the GIL)
+READ_BATCH = 32
+PARALLEL_SEGMENTS = 4
+DECRYPT_THREADS = os.cpu_count() or 1
+
+_pool = None
+
+_FIXED = struct.Struct(">4sBIQ8sH") # magic, version, segment_size, length, nonce_prefix, key_id length
+
+class Header:
+    def __init__(self, key_id: str, length: int, segment_size: int = DEFAULT_SEGMENT_SIZE,
+                 nonce_prefix: bytes = None):
+        if segment_size < 1:
+            raise ValueError("Segment size must be positive")
+        self.key_id = key_id
+        self.length = length
+        self.segment_size = segment_size
+        self.nonce_prefix = nonce_prefix or os.urandom(8)
+        if self.count > MAX_SEGMENTS:
+            raise ValueError("Too many segments, use a larger segment size")
+        self.raw = _FIXED.pack(MAGIC, VERSION, segment_size, length, self.nonce_prefix,
+                               len(key_id.encode())) + key_id.encode()
+
+    @classmethod
+    def parse(cls, buf) -> "Header":
+        try:
+            magic, version, segment_size, length, nonce_prefix, key_len = _FIXED.unpack_from(buf)
+        except struct.error:
+            raise ValueError("Truncated container header")
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a segmented AES-GCM container")
+        key_id = bytes(buf[_FIXED.size:_FIXED.size + key_len])
+        if key_len == 0 or len(key_id) != key_len:
+            raise ValueError("Invalid key id in container header")
+        # A non-UTF-8 key id raises UnicodeDecodeError, also a ValueError
+        return cls(key_id.decode(), length, segment_size, nonce_prefix)
+
+    @property
+    def size(self) -> int:
+        return len(self.raw)
+
+    @property
+    def count(self) -> int:
+        return max(1, -(-self.length // self.segment_size))
+
+    @property
+    def container_size(self) -> int:
+        return self.size + self.length + self.count * TAG_SIZE
+
+    def plain_span(self, i: int) -> tuple:
+        """
+        (offset, length) of segment i in the plaintext.
+        """
+        start = i * self.segment_size
+        return start, min(self.segment_size, self.length - start)
+
+    def cipher_offset(self, i: int) -> int:
+        """
+        Offset of segment i (ciphertext then tag) in the container.
+        """
+        return self.size + i * (self.segment_size + TAG_SIZE)
+
+    def segments_for_range(self, start: int, end: int) -> range:
+        """
+        Segments covering plaintext bytes [start, end).
+        """
+        if end <= start:
+            return range(0)
+        return range(start // self.segment_size, (end - 1) // self.segment_size + 1)
+
+    def _cipher(self, key: bytes, i: int):
+        cipher = AES.new(key, AES.MODE_GCM, nonce=self.nonce_prefix + struct.pack(">I", i))
+        cipher.update(self.raw)
+        return cipher
+
+    def encrypt_segment(self, key: bytes, i: int, plaintext, output):
+        """
+        Encrypts segment i from `plaintext` into `output` (a writable buffer of
+        the segment's ciphertext plus tag size).
+        """
+        n = len(plaintext)
+        _, tag = self._cipher(key, i).encrypt_and_digest(plaintext, output=output[:n])
+        output[n:n + TAG_SIZE] = tag
+
+    def decrypt_segment(self, key: bytes, i: int, segment, output=None):
+        """
+        Verifies and decrypts segment i (ciphertext plus tag). Raises ValueError
+        if it was tampered with. Writes into `output` if given.
+        """
+        n = len(segment) - TAG_SIZE
+        return self._cipher(key, i).decrypt_and_verify(segment[:n], segment[n:],
+                                                       output=output[:n] if output is not None else None)
+
+def encrypt(key: bytes, key_id: str, data: bytes, segment_size: int = DEFAULT_SEGMENT_SIZE) -> bytes:
+    header = Header(key_id, len(data), segment_size)
+    out = bytearray(header.container_size)
+    out[:header.size] = header.raw
+    view, src = memoryview(out), memoryview(data)
+    for i in range(header.count):
+        start, n = header.plain_span(i)
+        offset = header.cipher_offset(i)
+        header.encrypt_segment(key, i, src[start:start + n], view[offset:offset + n + TAG_SIZE])
+    return bytes(out)
+
+def is_container(buf) -> bool:
+    # The version byte can't occur in the text of the other blob formats
+    return bytes(buf[:len(MAGIC) + 1]) == MAGIC + bytes([VERSION])
+
+def _decrypt_pool() -> ThreadPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=DECRYPT_THREADS, thread_name_prefix="segments")
+    return _pool
+
+def iter_range(header: Header, key: bytes, fetch, start: int = 0, end: int = None):
+    """
+    Yields plaintext bytes [start, end) in order, one piece per segment,
+    decrypting only the segments that cover them. `fetch(indices)` returns
+    those segments (ciphertext plus tag) for a range of indices.
+    """
+    end = header.length if end is None else min(end, header.length)
+    indices = header.segments_for_range(start, end)
+    for first in range(indices.start, indices.stop, READ_BATCH):
+        batch = range(first, min(first + READ_BATCH, indices.stop))
+        blobs = fetch(batch)
+
+        def decrypt(item):
+            i, blob = item
+            seg_start, _ = header.plain_span(i)
+            return header.decrypt_segment(key, i, blob)[max(0, start - seg_start):end - seg_start]
+
+        items = zip(batch, blobs)
+        if len(batch) >= PARALLEL_SEGMENTS and DECRYPT_THREADS > 1:
+            pieces = list(_decrypt_pool().map(decrypt, items))
+        else:
+            pieces = list(map(decrypt, items))
+        # The whole batch is verified before any of it is handed out
+        yield from pieces
+
+def decrypt_range(key: bytes, container, start: int = 0, end: int = None) -> bytes:
+    """
+    Plaintext bytes [start, end) of a container, decrypting only the segments
+    that cover them.
+    """
+    header = Header.parse(container)
+    return b"".join(iter_range(header, key, lambda batch: container_segments(header, container, batch), start, end))
+
+def container_segments(header: Header, container, indices: range) -> list:
+    """
+    Segments (ciphertext plus tag) at `indices` of an in-memory container.
+    """
+    if len(container) != header.container_size:
+        raise ValueError("Container size doesn't match its header")
+    view = memoryview(container)
+    segments = []
+    for i in indices:
+        offset = header.cipher_offset(i)
+        segments.append(view[offset:offset + header.plain_span(i)[1] + TAG_SIZE])
+    return segments
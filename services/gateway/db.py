@@ -2,10 +2,12 @@ import sqlite3
 import uuid
 import datetime
 
+from common.tracing import TracedConnection
+
 DB_PATH = "saas_gateway.db"
 
 def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(DB_PATH, factory=TracedConnection)
     conn.row_factory = sqlite3.Row
     return conn
 
@@ -21,9 +23,15 @@ def init_db():
             plan TEXT DEFAULT 'starter',
             api_key TEXT,
             status TEXT DEFAULT 'active',
-            created_at TEXT
+            created_at TEXT,
+            dedup INTEGER DEFAULT 0
         )
     ''')
+    try:
+        # Databases created before per-tenant deduplication
+        c.execute("ALTER TABLE tenants ADD COLUMN dedup INTEGER DEFAULT 0")
+    except sqlite3.OperationalError:
+        pass
     
     # SaaS Users Table (Maps to Tenants)
     c.execute('''
@@ -37,24 +45,44 @@ def init_db():
             FOREIGN KEY(tenant_id) REFERENCES tenants(id)
         )
     ''')
-    
+
+    # Per-tenant daily usage, flushed periodically by the rate limiter
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS tenant_usage (
+            tenant_id TEXT,
+            period TEXT,
+            requests INTEGER DEFAULT 0,
+            rejected INTEGER DEFAULT 0,
+            bytes_in INTEGER DEFAULT 0,
+            bytes_out INTEGER DEFAULT 0,
+            PRIMARY KEY (tenant_id, period)
+        )
+    ''')
+
     conn.commit()
     conn.close()
 
-def create_tenant(name: str, plan: str = 'starter') -> dict:
+def create_tenant(name: str, plan: str = 'starter', dedup: bool = False) -> dict:
     tenant_id = f"t_{uuid.uuid4().hex[:8]}"
     api_key = f"sk_{uuid.uuid4().hex}"
     
     conn = get_db_connection()
     c = conn.cursor()
     c.execute(
-        "INSERT INTO tenants (id, name, plan, api_key, created_at) VALUES (?, ?, ?, ?, ?)",
-        (tenant_id, name, plan, api_key, datetime.datetime.now().isoformat())
+        "INSERT INTO tenants (id, name, plan, api_key, created_at, dedup) VALUES (?, ?, ?, ?, ?, ?)",
+        (tenant_id, name, plan, api_key, datetime.datetime.now().isoformat(), int(dedup))
     )
     conn.commit()
     conn.close()
     
-    return {"id": tenant_id, "name": name, "plan": plan, "api_key": api_key}
+    return {"id": tenant_id, "name": name, "plan": plan, "api_key": api_key, "dedup": dedup}
+
+def set_tenant_dedup(tenant_id: str, enabled: bool) -> bool:
+    conn = get_db_connection()
+    updated = conn.execute("UPDATE tenants SET dedup = ? WHERE id = ?", (int(enabled), tenant_id)).rowcount
+    conn.commit()
+    conn.close()
+    return updated > 0
 
 def create_user(tenant_id: str, email: str, role: str = 'user') -> dict:
     user_id = f"u_{uuid.uuid4().hex[:8]}"
@@ -80,3 +108,21 @@ def get_tenant_by_apikey(api_key: str):
     if row:
         return dict(row)
     return None
+
+def load_usage(period: str) -> list:
+    conn = get_db_connection()
+    rows = conn.execute("SELECT * FROM tenant_usage WHERE period = ?", (period,)).fetchall()
+    conn.close()
+    return [dict(row) for row in rows]
+
+def save_usage(rows: list):
+    conn = get_db_connection()
+    # Rows are increments, so several gateway workers can write the same tenant
+    conn.executemany(
+        "INSERT INTO tenant_usage (tenant_id, period, requests, rejected, bytes_in, bytes_out) "
+        "VALUES (?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT(tenant_id, period) DO UPDATE SET "
+        "requests = requests + excluded.requests, rejected = rejected + excluded.rejected, "
+        "bytes_in = bytes_in + excluded.bytes_in, bytes_out = bytes_out + excluded.bytes_out", rows)
+    conn.commit()
+    conn.close()
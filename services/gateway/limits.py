@@ -0,0 +1,183 @@
+import time
+
+from services.gateway import db
+from common import serve
+
+# Per-plan limits. rate/burst are requests per second for the token bucket;
+# bytes_per_day caps request body volume per UTC day (None = unlimited).
+PLAN_LIMITS = {
+    "starter":    {"rate": 5.0,   "burst": 10,   "bytes_per_day": 100 * 1024 * 1024},
+    "pro":        {"rate": 50.0,  "burst": 100,  "bytes_per_day": 10 * 1024 * 1024 * 1024},
+    "enterprise": {"rate": 500.0, "burst": 1000, "bytes_per_day": None}
+}
+DEFAULT_PLAN = "starter"
+# How often usage counters are written to the gateway DB
+PERSIST_INTERVAL = 10
+DAY = 86400
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self, n: float = 1.0) -> float:
+        """
+        Returns 0 if `n` tokens were taken, else the seconds until they will be available.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= n:
+            self.tokens -= n
+            return 0.0
+        return (n - self.tokens) / self.rate
+
+class Usage:
+    __slots__ = ("day", "requests", "rejected", "bytes_in", "bytes_out", "saved")
+
+    def __init__(self, day: int, requests=0, rejected=0, bytes_in=0, bytes_out=0):
+        self.day = day
+        self.requests = requests
+        self.rejected = rejected
+        self.bytes_in = bytes_in
+        self.bytes_out = bytes_out
+        # Counts already in the DB; the rest is still to be written
+        self.saved = (requests, rejected, bytes_in, bytes_out)
+
+    def counts(self) -> tuple:
+        return (self.requests, self.rejected, self.bytes_in, self.bytes_out)
+
+    @property
+    def period(self) -> str:
+        return time.strftime("%Y-%m-%d", time.gmtime(self.day * DAY))
+
+    def to_dict(self) -> dict:
+        return {"period": self.period, "requests": self.requests, "rejected": self.rejected,
+                "bytes_in": self.bytes_in, "bytes_out": self.bytes_out}
+
+def today() -> int:
+    # UTC day number; cheaper to compare on every request than a date string
+    return int(time.time() // DAY)
+
+class TenantLimiter:
+    """
+    Rate limits, byte quotas and usage counters, all in memory.
+    Only called from the gateway's event loop (async endpoints, no await
+    between read and update), so the checks need no lock and are O(1).
+
+    With several gateway workers each one gets an equal share of every
+    bucket, and usage is written to the DB as increments and read back
+    each PERSIST_INTERVAL, so quotas count all workers' traffic (up to one
+    interval late).
+    """
+    def __init__(self, workers: int = 1):
+        self.workers = workers
+        self.buckets = {}
+        self.usage = {}
+        self.dirty = set()
+
+    def limits_for(self, plan: str) -> dict:
+        return PLAN_LIMITS.get(plan, PLAN_LIMITS[DEFAULT_PLAN])
+
+    def _usage(self, tenant_id: str) -> Usage:
+        day = today()
+        usage = self.usage.get(tenant_id)
+        if usage is None or usage.day != day:
+            usage = Usage(day)
+            self.usage[tenant_id] = usage
+        return usage
+
+    def check(self, tenant: dict, body_bytes: int):
+        """
+        Charges one request and `body_bytes` to the tenant.
+        Returns None if allowed, else (reason, retry_after_seconds).
+        """
+        tenant_id = tenant['id']
+        limits = self.limits_for(tenant['plan'])
+        rate = limits["rate"] / self.workers
+        bucket = self.buckets.get(tenant_id)
+        if bucket is None or bucket.rate != rate:
+            bucket = self.buckets[tenant_id] = TokenBucket(rate, max(1, limits["burst"] // self.workers))
+        usage = self._usage(tenant_id)
+        self.dirty.add(tenant_id)
+
+        quota = limits["bytes_per_day"]
+        if quota is not None and usage.bytes_in + body_bytes > quota:
+            usage.rejected += 1
+            return "Daily byte quota exceeded", DAY - time.time() % DAY
+        wait = bucket.take()
+        if wait:
+            usage.rejected += 1
+            return "Rate limit exceeded", wait
+
+        usage.requests += 1
+        usage.bytes_in += body_bytes
+        return None
+
+    def add_bytes_out(self, tenant_id: str, n: int):
+        self._usage(tenant_id).bytes_out += n
+        self.dirty.add(tenant_id)
+
+    def snapshot(self, tenant_id: str = None) -> dict:
+        if tenant_id is not None:
+            usage = self.usage.get(tenant_id)
+            return {tenant_id: usage.to_dict()} if usage else {}
+        return {tid: u.to_dict() for tid, u in list(self.usage.items())}
+
+    # --- Persistence ---
+
+    def period(self) -> str:
+        return Usage(today()).period
+
+    def load(self):
+        self.merge(db.load_usage(self.period()))
+
+    def merge(self, rows: list):
+        """
+        Takes persisted totals (which include other workers' usage) as the
+        new baseline, keeping what this process counted and hasn't written yet.
+        """
+        period = self.period()
+        for row in rows:
+            if row['period'] != period:
+                continue
+            usage = self._usage(row['tenant_id'])
+            totals = (row['requests'], row['rejected'], row['bytes_in'], row['bytes_out'])
+            unsaved = [now - saved for now, saved in zip(usage.counts(), usage.saved)]
+            usage.requests, usage.rejected, usage.bytes_in, usage.bytes_out = [
+                total + n for total, n in zip(totals, unsaved)]
+            usage.saved = totals
+
+    def dirty_rows(self) -> list:
+        """
+        Usage increments since the last call, copied on the event loop so
+        they can be written from another thread.
+        """
+        dirty, self.dirty = self.dirty, set()
+        rows = []
+        for tenant_id in dirty:
+            u = self.usage.get(tenant_id)
+            if u is None:
+                continue
+            counts = u.counts()
+            delta = [now - saved for now, saved in zip(counts, u.saved)]
+            if any(delta):
+                rows.append((tenant_id, u.period, *delta))
+            u.saved = counts
+        return rows
+
+    def requeue(self, rows: list):
+        """
+        Puts back increments from dirty_rows() that failed to be written.
+        """
+        for tenant_id, period, *delta in rows:
+            u = self.usage.get(tenant_id)
+            if u is not None and u.period == period:
+                u.saved = tuple(saved - n for saved, n in zip(u.saved, delta))
+                self.dirty.add(tenant_id)
+
+limiter = TenantLimiter(serve.worker_count())
@@ -1,6 +1,9 @@
 from fastapi import FastAPI, Header, HTTPException, Request, Depends
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
 import httpx
+import asyncio
 import sys
 import os
 
@@ -8,17 +11,39 @@ import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
 
 from services.gateway import db
+from services.gateway.limits import limiter, PERSIST_INTERVAL
+from common import tracing, metrics, profiler, deadline, serve, auth
+from common.kms_router import KMSRouter, parse_shards
 
 app = FastAPI(title="Aegis SaaS Gateway")
+tracing.instrument_app(app, "gateway")
+metrics.instrument_app(app, "gateway")
+profiler.instrument_app(app, "gateway")
+# Each request gets a 10 s budget, shared by every hop below the gateway
+deadline.instrument_app(app, default_budget=10.0)
 
 # Core Service URLs
 ENC_URL = "http://localhost:8001"
 PROXY_URL = "http://localhost:8002"
 ACCESS_URL = "http://localhost:8008"
 AUDIT_URL = "http://localhost:8006"
+KMS_URL = "http://localhost:8005"
+# Users' PRE key pairs are sharded by user id (same KMS_SHARDS layout as the
+# encryption service)
+kms = KMSRouter(parse_shards(os.environ.get("KMS_SHARDS", "")) or [[KMS_URL]])
+
+UPSTREAM_TIMEOUT = httpx.Timeout(10.0, read=60.0)
+# Headers copied between client and upstream; everything else is hop-by-hop or ours
+FORWARD_REQUEST_HEADERS = ("content-type", "content-length", "content-encoding")
+FORWARD_RESPONSE_HEADERS = ("content-type", "content-length", "content-encoding")
+
+# One client for the process so upstream connections are reused
+upstream = None
 
 @app.on_event("startup")
 def startup():
+    global upstream
+    upstream = httpx.AsyncClient(timeout=UPSTREAM_TIMEOUT)
     db.init_db()
     # Ensure default tenant exists for demo
     if not db.get_tenant_by_apikey("sk_demo_tenant"):
@@ -29,6 +54,45 @@ def startup():
         conn.commit()
         conn.close()
 
+@app.on_event("startup")
+async def start_usage_persistence():
+    limiter.load()
+    asyncio.create_task(persist_usage_loop())
+
+async def persist_usage_loop():
+    while True:
+        await asyncio.sleep(PERSIST_INTERVAL)
+        rows = limiter.dirty_rows()
+        try:
+            if rows:
+                await asyncio.to_thread(db.save_usage, rows)
+                rows = []
+            if limiter.workers > 1:
+                # Pick up what the other workers charged
+                limiter.merge(await asyncio.to_thread(db.load_usage, limiter.period()))
+        except Exception:
+            limiter.requeue(rows) # Retry next round
+
+@app.on_event("shutdown")
+async def shutdown():
+    await upstream.aclose()
+    rows = limiter.dirty_rows()
+    if rows:
+        db.save_usage(rows)
+
+# Usage counters for billing, read from the limiter at scrape time
+def usage_values(field: str):
+    return lambda: {(tid,): getattr(u, field) for tid, u in list(limiter.usage.items())}
+
+metrics.counter("gateway_tenant_requests_total", "Admitted requests per tenant (today)", ("tenant",),
+                fn=usage_values("requests"))
+metrics.counter("gateway_tenant_rejected_total", "Requests rejected by rate limit or quota (today)", ("tenant",),
+                fn=usage_values("rejected"))
+metrics.counter("gateway_tenant_bytes_in_total", "Request body bytes per tenant (today)", ("tenant",),
+                fn=usage_values("bytes_in"))
+metrics.counter("gateway_tenant_bytes_out_total", "Response body bytes per tenant (today)", ("tenant",),
+                fn=usage_values("bytes_out"))
+
 @app.get("/health")
 def health():
     return {"status": "gateway_ok", "mode": "saas"}
@@ -48,69 +112,129 @@ async def verify_tenant(x_api_key: str = Header(None)):
         
     return tenant
 
+async def enforce_limits(request: Request, tenant: dict = Depends(verify_tenant)):
+    """
+    Rate limit and byte quota check, before anything is sent upstream.
+    """
+    length = request.headers.get("content-length")
+    if length is None and limiter.limits_for(tenant['plan'])["bytes_per_day"] is not None:
+        # The quota is charged up front, so the size has to be known
+        raise HTTPException(status_code=411, detail="Content-Length required")
+    rejected = limiter.check(tenant, int(length or 0))
+    if rejected:
+        reason, retry_after = rejected
+        raise HTTPException(status_code=429, detail=reason,
+                            headers={"Retry-After": str(max(1, int(retry_after + 0.999)))})
+    return tenant
+
 # --- SaaS Admin APIs ---
 
 class CreateTenantReq(BaseModel):
     name: str
     plan: str = "starter"
+    dedup: bool = False
 
 @app.post("/admin/tenants")
 def register_tenant(req: CreateTenantReq):
-    return db.create_tenant(req.name, req.plan)
+    return db.create_tenant(req.name, req.plan, req.dedup)
+
+class DedupReq(BaseModel):
+    enabled: bool
+
+@app.put("/admin/tenants/{tenant_id}/dedup")
+def set_dedup(tenant_id: str, req: DedupReq):
+    # Opt-in: identical chunks of this tenant's files are stored once
+    if not db.set_tenant_dedup(tenant_id, req.enabled):
+        raise HTTPException(status_code=404, detail="Tenant not found")
+    return {"tenant_id": tenant_id, "dedup": req.enabled}
+
+@app.get("/admin/usage")
+async def tenant_usage(tenant_id: str = None):
+    """
+    Today's per-tenant usage (requests, rejections, bytes in/out) for billing.
+    """
+    return {"usage": limiter.snapshot(tenant_id)}
 
 # --- Proxy Endpoints (The "Gateway" Logic) ---
 
-@app.post("/files/encrypt")
-async def encrypt_file(request: Request, tenant: dict = Depends(verify_tenant)):
-    # 1. Enforce Plan Limits (Mock logic)
-    if tenant['plan'] == 'starter':
-        # Check quota... (skipped for MVP)
-        pass
-
-    # 2. Forward to Internal Encryption Service
-    # We inject tenant_id into metadata
-    body = await request.json()
-    if 'meta' not in body:
-        body['meta'] = {}
-    body['meta']['tenant_id'] = tenant['id']
-    
-    async with httpx.AsyncClient() as client:
+async def stream_to_upstream(request: Request, url: str, tenant: dict, act_as_tenant: bool = False) -> StreamingResponse:
+    """
+    Pipes the client body to `url` and the upstream response back, chunk by
+    chunk, without parsing either. Tenant metadata travels in headers, so
+    gateway memory stays flat whatever the payload size. With act_as_tenant
+    the call carries the service token on behalf of the tenant, for
+    services that only act for the user they are called for.
+    """
+    headers = {h: request.headers[h] for h in FORWARD_REQUEST_HEADERS if h in request.headers}
+    if act_as_tenant:
+        headers.update(auth.service_headers(tenant['id']))
+    headers["x-tenant-id"] = tenant['id']
+    headers["x-tenant-plan"] = tenant['plan']
+    if tenant.get('dedup'):
+        headers["x-tenant-dedup"] = "1"
+
+    upstream_req = upstream.build_request("POST", url, content=request.stream(), headers=headers)
+    try:
+        resp = await upstream.send(upstream_req, stream=True)
+    except httpx.TimeoutException:
+        raise HTTPException(status_code=504, detail="Upstream did not answer within the request deadline")
+    except httpx.RequestError as e:
+        raise HTTPException(status_code=502, detail=f"Upstream unavailable: {e!r}")
+
+    async def body():
+        sent = 0
         try:
-            resp = await client.post(f"{ENC_URL}/encrypt", json=body, timeout=10)
-            return resp.json()
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
+            async for chunk in resp.aiter_raw():
+                sent += len(chunk)
+                yield chunk
+        finally:
+            limiter.add_bytes_out(tenant['id'], sent)
+
+    return StreamingResponse(
+        body(),
+        status_code=resp.status_code,
+        headers={h: resp.headers[h] for h in FORWARD_RESPONSE_HEADERS if h in resp.headers},
+        background=BackgroundTask(resp.aclose)
+    )
+
+@app.post("/files/encrypt")
+async def encrypt_file(request: Request, tenant: dict = Depends(enforce_limits)):
+    # 1. Plan limits (rate + daily bytes) are enforced by enforce_limits
+
+    # 2. Forward to Internal Encryption Service (tenant_id goes in X-Tenant-Id)
+    return await stream_to_upstream(request, f"{ENC_URL}/encrypt", tenant)
 
 @app.post("/files/share")
-async def share_file(request: Request, tenant: dict = Depends(verify_tenant)):
+async def share_file(request: Request, tenant: dict = Depends(enforce_limits)):
     # Forward to Proxy Load Balancer
     # Future: Check if 'recipient' is in same tenant or allowed external
-    body = await request.json()
-    
-    async with httpx.AsyncClient() as client:
-        try:
-            # Re-map: Public API /share -> Internal /gen_rekey
-            # In real app, we'd map emails to user IDs here
-            resp = await client.post(f"{PROXY_URL}/gen_rekey", json=body, timeout=10)
-            return resp.json()
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
+    # Re-map: Public API /share -> Internal /gen_rekey
+    # In real app, we'd map emails to user IDs here. Tenants can only share
+    # their own keys: from_user must be the tenant id
+    return await stream_to_upstream(request, f"{PROXY_URL}/gen_rekey", tenant, act_as_tenant=True)
+
+@app.post("/files/unwrap")
+async def unwrap_file_key(request: Request, tenant: dict = Depends(enforce_limits)):
+    # Opens a data key wrapped for the tenant, or re-encrypted for it by the
+    # proxy; user_id must be the tenant id
+    url = f"{kms.shard_for(tenant['id']).primary}/unwrap_key/pre"
+    return await stream_to_upstream(request, url, tenant, act_as_tenant=True)
 
 @app.post("/files/decrypt")
-async def decrypt_file(request: Request, tenant: dict = Depends(verify_tenant)):
+async def decrypt_file(request: Request, tenant: dict = Depends(enforce_limits)):
     # Forward to Internal Decryption Service
     # In a real SaaS, we'd verify the user owns the key or has permission
-    body = await request.json()
-    
-    async with httpx.AsyncClient() as client:
-        try:
-            resp = await client.post(f"{ENC_URL}/decrypt", json=body, timeout=10)
-            if resp.status_code != 200:
-                raise HTTPException(status_code=resp.status_code, detail=resp.text)
-            return resp.json()
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=str(e))
+    return await stream_to_upstream(request, f"{ENC_URL}/decrypt", tenant)
+
+@app.post("/files/decrypt/batch")
+async def decrypt_files(request: Request, tenant: dict = Depends(enforce_limits)):
+    # Many files in one call; the encryption service fetches all their keys at once
+    return await stream_to_upstream(request, f"{ENC_URL}/decrypt/batch", tenant)
             
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    serve.add_arguments(parser)
+    args = parser.parse_args()
+    serve.run(app, "services.gateway.main:app", 8000, args.workers)
@@ -1,22 +1,85 @@
 import sqlite3
 import os
 
+from common.tracing import TracedConnection
+
 DB_PATH = "keys.db"
 
 def init_db():
     conn = sqlite3.connect(DB_PATH)
     c = conn.cursor()
+    conn.execute("PRAGMA journal_mode=WAL")
+    # Data keys, wrapped with key-encryption key kek_version (0: stored in
+    # the clear by older versions, wrapped by the rotation job)
     c.execute('''
         CREATE TABLE IF NOT EXISTS keys (
             key_id TEXT PRIMARY KEY,
             key_bytes BLOB,
+            created_at TEXT,
+            kek_version INTEGER DEFAULT 0
+        )
+    ''')
+    # Per-tenant master keys that file keys are derived from (HKDF), so a
+    # tenant costs one row per key version instead of one per file
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS master_keys (
+            tenant_id TEXT,
+            version INTEGER,
+            key_bytes BLOB,
+            created_at TEXT,
+            kek_version INTEGER DEFAULT 0,
+            PRIMARY KEY (tenant_id, version)
+        )
+    ''')
+    # Users' proxy re-encryption key pairs (common.pre); the secret
+    # is wrapped like a data key, the public key is stored as is
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS pre_keys (
+            user_id TEXT PRIMARY KEY,
+            key_bytes BLOB,
+            public_key BLOB,
+            created_at TEXT,
+            kek_version INTEGER DEFAULT 0
+        )
+    ''')
+    for table in ("keys", "master_keys", "pre_keys"):
+        try:
+            c.execute(f"ALTER TABLE {table} ADD COLUMN kek_version INTEGER DEFAULT 0")
+        except sqlite3.OperationalError:
+            pass
+        c.execute(f"CREATE INDEX IF NOT EXISTS {table}_kek_version ON {table} (kek_version)")
+    # Key-encryption keys; the highest version wraps new and rotated data keys
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS keks (
+            version INTEGER PRIMARY KEY,
+            key_bytes BLOB,
             created_at TEXT
         )
     ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS rotations (
+            kek_version INTEGER PRIMARY KEY,
+            total INTEGER,
+            started_at TEXT,
+            finished_at TEXT
+        )
+    ''')
+    # Rows the rotation job couldn't re-wrap to kek_version; skipped until
+    # the next rotation instead of being retried forever
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS rotation_failures (
+            tbl TEXT,
+            row_id INTEGER,
+            kek_version INTEGER,
+            error TEXT,
+            failed_at TEXT,
+            PRIMARY KEY (tbl, row_id, kek_version)
+        )
+    ''')
     conn.commit()
     conn.close()
 
 def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(DB_PATH, timeout=10, factory=TracedConnection)
     conn.row_factory = sqlite3.Row
     return conn
@@ -0,0 +1,273 @@
+import datetime
+import os
+import sqlite3
+import threading
+import time
+import traceback
+
+from Crypto.Cipher import AES
+from Crypto.Random import get_random_bytes
+
+from common import metrics, serve
+from services.kms import db
+
+# Versioned key-encryption keys (KEKs). Data keys are stored wrapped
+# (AES-GCM) under a KEK version, so rotating means wrapping every data key
+# again under a new KEK; the ciphertext those keys protect never changes.
+# Rows are re-wrapped lazily when read and by a background job that walks
+# the rest in small, throttled batches. KEKs live in the KMS database here;
+# a production KMS would keep them in an HSM.
+
+# Data key tables -> SQL naming a row, bound into its wrapping as associated
+# data so a wrapped key can't be swapped onto another row
+TABLES = {"keys": "key_id", "master_keys": "tenant_id || ':' || version", "pre_keys": "'pre:' || user_id"}
+NONCE_SIZE = 12
+TAG_SIZE = 16
+# How long a worker trusts its view of the current KEK version
+CURRENT_TTL = 5.0
+
+# Rotation job throttling: rows per transaction, a ceiling on rows per
+# second (split across workers), and a pause while more than
+# ROTATION_MAX_IN_FLIGHT foreground requests are being served
+ROTATION_BATCH = int(os.environ.get("ROTATION_BATCH", 200))
+ROTATION_RATE = int(os.environ.get("ROTATION_RATE", 2000))
+ROTATION_MAX_IN_FLIGHT = int(os.environ.get("ROTATION_MAX_IN_FLIGHT", 2))
+ROTATION_BACKOFF = 0.05
+ROTATION_POLL = 5.0
+
+_keks = {} # version -> key; versions never change
+_current = (None, 0.0) # (version, fetched_at)
+_wake = threading.Event()
+_stop = threading.Event()
+_thread = None
+rate = ROTATION_RATE
+# Read replicas never write; the primary's re-wraps reach them through the log
+read_only = False
+# Last error that stopped a whole batch in this worker's job, for progress()
+job_error = None
+
+REWRAPPED = metrics.counter("kms_keys_rewrapped_total", "Data keys re-wrapped under the current KEK", ("trigger",))
+REWRAP_FAILED = metrics.counter("kms_rewrap_failures_total", "Data keys the rotation job could not re-wrap and skipped")
+IN_FLIGHT = metrics.HTTP_IN_FLIGHT.labels("kms")
+
+def _now() -> str:
+    return datetime.datetime.now().isoformat()
+
+def _kek(conn, version: int) -> bytes:
+    key = _keks.get(version)
+    if key is None:
+        row = conn.execute("SELECT key_bytes FROM keks WHERE version = ?", (version,)).fetchone()
+        if row is None:
+            raise ValueError(f"KEK version {version} not found")
+        key = _keks[version] = row['key_bytes']
+    return key
+
+def current_version(conn) -> int:
+    global _current
+    version, fetched_at = _current
+    if version is None or time.monotonic() - fetched_at > CURRENT_TTL:
+        version = conn.execute("SELECT MAX(version) FROM keks").fetchone()[0]
+        _current = (version, time.monotonic())
+    return version
+
+def init():
+    """
+    Creates KEK version 1 on first start.
+    """
+    global _current
+    conn = db.get_db_connection()
+    try:
+        conn.execute("INSERT OR IGNORE INTO keks (version, key_bytes, created_at) VALUES (1, ?, ?)",
+                     (get_random_bytes(32), _now()))
+        conn.commit()
+    finally:
+        conn.close()
+    _current = (None, 0.0)
+
+def wrap(conn, key_bytes: bytes, name: str) -> tuple:
+    """
+    (kek_version, wrapped) for a data key named `name`.
+    """
+    version = current_version(conn)
+    nonce = get_random_bytes(NONCE_SIZE)
+    cipher = AES.new(_kek(conn, version), AES.MODE_GCM, nonce=nonce)
+    cipher.update(name.encode())
+    ciphertext, tag = cipher.encrypt_and_digest(key_bytes)
+    return version, nonce + ciphertext + tag
+
+def unwrap(conn, kek_version: int, wrapped: bytes, name: str) -> bytes:
+    if kek_version == 0:
+        return wrapped # Never wrapped
+    cipher = AES.new(_kek(conn, kek_version), AES.MODE_GCM, nonce=wrapped[:NONCE_SIZE])
+    cipher.update(name.encode())
+    return cipher.decrypt_and_verify(wrapped[NONCE_SIZE:-TAG_SIZE], wrapped[-TAG_SIZE:])
+
+def load(conn, table: str, row) -> bytes:
+    """
+    Unwraps a data key row (as returned by `select`), re-wrapping it under
+    the current KEK if it's behind.
+    """
+    key_bytes = unwrap(conn, row['kek_version'], row['key_bytes'], row['name'])
+    if not read_only and row['kek_version'] < current_version(conn):
+        version, wrapped = wrap(conn, key_bytes, row['name'])
+        # Only if nobody (the job, another request) got there first
+        updated = conn.execute(f"UPDATE {table} SET key_bytes = ?, kek_version = ? WHERE rowid = ? AND kek_version = ?",
+                               (wrapped, version, row['rowid'], row['kek_version'])).rowcount
+        conn.commit()
+        REWRAPPED.labels("access").inc(updated)
+    return key_bytes
+
+def load_many(conn, table: str, rows: list) -> list:
+    """
+    `load` for many rows, re-wrapping the ones that are behind in one write.
+    """
+    version = current_version(conn)
+    keys, updates = [], []
+    for row in rows:
+        key_bytes = unwrap(conn, row['kek_version'], row['key_bytes'], row['name'])
+        if not read_only and row['kek_version'] < version:
+            updates.append((wrap(conn, key_bytes, row['name'])[1], version, row['rowid'], row['kek_version']))
+        keys.append(key_bytes)
+    if updates:
+        conn.executemany(f"UPDATE {table} SET key_bytes = ?, kek_version = ? WHERE rowid = ? AND kek_version = ?", updates)
+        conn.commit()
+        REWRAPPED.labels("access").inc(len(updates))
+    return keys
+
+def select(table: str) -> str:
+    return f"SELECT rowid, *, {TABLES[table]} AS name FROM {table}"
+
+# --- Rotation ---
+
+def remaining(conn, version: int = None) -> int:
+    version = current_version(conn) if version is None else version
+    return sum(conn.execute(f"SELECT COUNT(*) FROM {table} WHERE kek_version < ?", (version,)).fetchone()[0]
+               for table in TABLES)
+
+def rotate() -> int:
+    """
+    Adds a new KEK version and starts re-wrapping every data key under it.
+    """
+    global _current
+    conn = db.get_db_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        version = conn.execute("SELECT MAX(version) FROM keks").fetchone()[0] + 1
+        conn.execute("INSERT INTO keks (version, key_bytes, created_at) VALUES (?, ?, ?)",
+                     (version, get_random_bytes(32), _now()))
+        conn.execute("INSERT INTO rotations (kek_version, total, started_at) VALUES (?, ?, ?)",
+                     (version, remaining(conn, version), _now()))
+        conn.commit()
+    finally:
+        conn.close()
+    _current = (version, time.monotonic())
+    _wake.set()
+    return version
+
+def rewrap_batch(limit: int) -> int:
+    """
+    Re-wraps up to `limit` data keys that are behind the current KEK. A row
+    that fails to unwrap is recorded in rotation_failures and skipped until
+    the next rotation, so one bad row can't stall the job. Returns how many
+    rows were handled, re-wrapped or skipped.
+    """
+    conn = db.get_db_connection()
+    try:
+        # Serializes workers running the job; rows a lazy read re-wrapped are skipped
+        conn.execute("BEGIN IMMEDIATE")
+        version = current_version(conn)
+        done = failed = 0
+        for table in TABLES:
+            rows = conn.execute(f"{select(table)} WHERE kek_version < ? AND rowid NOT IN "
+                                f"(SELECT row_id FROM rotation_failures WHERE tbl = ? AND kek_version = ?) LIMIT ?",
+                                (version, table, version, limit - done - failed)).fetchall()
+            updates = []
+            for row in rows:
+                try:
+                    key_bytes = unwrap(conn, row['kek_version'], row['key_bytes'], row['name'])
+                except Exception as e:
+                    conn.execute("INSERT OR REPLACE INTO rotation_failures (tbl, row_id, kek_version, error, failed_at) "
+                                 "VALUES (?, ?, ?, ?, ?)", (table, row['rowid'], version, f"{row['name']}: {e!r}", _now()))
+                    failed += 1
+                    continue
+                updates.append((wrap(conn, key_bytes, row['name'])[1], version, row['rowid']))
+            conn.executemany(f"UPDATE {table} SET key_bytes = ?, kek_version = ? WHERE rowid = ?", updates)
+            done += len(updates)
+            if done + failed >= limit:
+                break
+        if done + failed < limit:
+            conn.execute("UPDATE rotations SET finished_at = ? WHERE kek_version <= ? AND finished_at IS NULL",
+                         (_now(), version))
+        conn.commit()
+    finally:
+        conn.close()
+    REWRAPPED.labels("job").inc(done)
+    REWRAP_FAILED.inc(failed)
+    return done + failed
+
+def progress() -> dict:
+    conn = db.get_db_connection()
+    try:
+        version = current_version(conn)
+        row = conn.execute("SELECT * FROM rotations ORDER BY kek_version DESC LIMIT 1").fetchone()
+        left = remaining(conn, version)
+        failed = conn.execute("SELECT COUNT(*) FROM rotation_failures WHERE kek_version = ?", (version,)).fetchone()[0]
+        last_error = conn.execute("SELECT error FROM rotation_failures WHERE kek_version = ? "
+                                  "ORDER BY failed_at DESC LIMIT 1", (version,)).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return {"kek_version": version, "status": "idle", "remaining": left}
+    total = max(row['total'], left)
+    return {
+        "kek_version": version,
+        # Failed rows are left behind on their old KEK and count as remaining
+        "status": ("done" if not failed else "done_with_errors") if row['finished_at'] else "running",
+        "started_at": row['started_at'],
+        "finished_at": row['finished_at'],
+        "total": total,
+        "rewrapped": total - left,
+        "remaining": left,
+        "failed": failed,
+        "last_error": last_error[0] if last_error else None,
+        "job_error": job_error,
+        "rate": rate
+    }
+
+def _run():
+    global job_error
+    while not _stop.is_set():
+        # Foreground requests first
+        if IN_FLIGHT.value() > ROTATION_MAX_IN_FLIGHT:
+            _stop.wait(ROTATION_BACKOFF)
+            continue
+        started = time.monotonic()
+        try:
+            done = rewrap_batch(ROTATION_BATCH)
+            job_error = None
+        except sqlite3.OperationalError as e:
+            done = 0 # Database busy; try again later
+            job_error = repr(e)
+        except Exception as e:
+            # Not a bad row (those are skipped); keep the job alive and say why it stalls
+            traceback.print_exc()
+            done = 0
+            job_error = repr(e)
+        if done == 0:
+            _wake.wait(ROTATION_POLL)
+            _wake.clear()
+            continue
+        # Stay under the rate, counted per worker
+        delay = done * serve.worker_count() / max(rate, 1) - (time.monotonic() - started)
+        if delay > 0:
+            _stop.wait(delay)
+
+def start():
+    global _thread
+    _stop.clear()
+    _thread = threading.Thread(target=_run, daemon=True, name="kek-rotation")
+    _thread.start()
+
+def stop():
+    _stop.set()
+    _wake.set()
@@ -1,22 +1,66 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Depends
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
+from typing import Dict, List, Optional
+import json
 import base64
 import os
 import sys
 import datetime
+import requests
 from Crypto.Random import get_random_bytes
 
 # Add project root to sys.path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
 
-from services.kms import db
+from services.kms import db, keks, replication
+from common import tracing, metrics, profiler, deadline, serve, auth, pre
+from common.kms_router import KMSRouter, parse_shards
+from common.ring import HashRing
 from services.encryption import wrappers # Reuse wrappers for now
 
 app = FastAPI(title="Key Management Service")
+tracing.instrument_app(app, "kms")
+metrics.instrument_app(app, "kms")
+profiler.instrument_app(app, "kms")
+deadline.instrument_app(app)
+
+# Sharding: key ids are partitioned over KMS_SHARD_COUNT shards by a
+# consistent hash (common.ring); this process serves shard KMS_SHARD. With
+# KMS_REPLICA_OF set it is a read-only replica following that primary's
+# changelog. Worker processes get the command-line settings through the
+# environment.
+SHARD = int(os.environ.get("KMS_SHARD", 0))
+SHARD_COUNT = int(os.environ.get("KMS_SHARD_COUNT", 1))
+REPLICA_OF = os.environ.get("KMS_REPLICA_OF") or None
+if "KMS_DB" in os.environ:
+    db.DB_PATH = os.environ["KMS_DB"]
+
+ring = HashRing([str(i) for i in range(SHARD_COUNT)])
+# The whole KMS, in the KMS_SHARDS layout the other services use; only needed
+# to look up PRE public keys of users on other shards
+peers = KMSRouter(parse_shards(os.environ["KMS_SHARDS"])) if os.environ.get("KMS_SHARDS") else None
 
 @app.on_event("startup")
 def startup():
     db.init_db()
+    replication.init()
+    if REPLICA_OF:
+        keks.read_only = True
+        replication.start(REPLICA_OF)
+    else:
+        keks.init()
+        keks.start()
+        replication.start()
+
+@app.on_event("shutdown")
+def shutdown():
+    keks.stop()
+    replication.stop()
+
+def require_primary():
+    if REPLICA_OF:
+        raise HTTPException(status_code=403, detail=f"Read-only replica of {REPLICA_OF}")
 
 @app.get("/health")
 def health():
@@ -30,13 +74,19 @@ class GenerateKeyResponse(BaseModel):
 
 @app.post("/generate_key", response_model=GenerateKeyResponse)
 def generate_key(req: GenerateKeyRequest):
+    require_primary()
     key = get_random_bytes(req.key_len)
-    key_id = f"k_{base64.urlsafe_b64encode(get_random_bytes(6)).decode().strip('=')}"
+    # Draw ids until one hashes to this shard (SHARD_COUNT draws on average)
+    while True:
+        key_id = f"k_{base64.urlsafe_b64encode(get_random_bytes(6)).decode().strip('=')}"
+        if ring.node_for(key_id) == str(SHARD):
+            break
     
     conn = db.get_db_connection()
+    kek_version, wrapped = keks.wrap(conn, key, key_id)
     c = conn.cursor()
-    c.execute("INSERT INTO keys (key_id, key_bytes, created_at) VALUES (?, ?, ?)",
-              (key_id, key, datetime.datetime.now().isoformat()))
+    c.execute("INSERT INTO keys (key_id, key_bytes, created_at, kek_version) VALUES (?, ?, ?, ?)",
+              (key_id, wrapped, datetime.datetime.now().isoformat(), kek_version))
     conn.commit()
     conn.close()
     
@@ -48,16 +98,216 @@ class GetKeyRequest(BaseModel):
 class GetKeyResponse(BaseModel):
     key_bytes_b64: str
 
+def load_key(key_id: str) -> bytes:
+    conn = db.get_db_connection()
+    try:
+        row = conn.execute(f"{keks.select('keys')} WHERE key_id = ?", (key_id,)).fetchone()
+        if not row:
+            raise HTTPException(status_code=404, detail="Key not found")
+        return keks.load(conn, "keys", row)
+    except ValueError:
+        raise HTTPException(status_code=500, detail="Key failed to unwrap")
+    finally:
+        conn.close()
+
 @app.post("/get_key", response_model=GetKeyResponse)
 def get_key(req: GetKeyRequest):
+    return GetKeyResponse(key_bytes_b64=base64.b64encode(load_key(req.key_id)).decode())
+
+class MasterKeyRequest(BaseModel):
+    tenant_id: str
+    version: Optional[int] = None # Latest when None
+
+class MasterKeyResponse(BaseModel):
+    tenant_id: str
+    version: int
+    key_bytes_b64: str
+
+@app.post("/master_key", response_model=MasterKeyResponse)
+def master_key(req: MasterKeyRequest):
+    """
+    A tenant's master key, for deriving file keys locally. Asking for the
+    latest version of a tenant without one creates version 1.
+    """
     conn = db.get_db_connection()
-    row = conn.execute("SELECT key_bytes FROM keys WHERE key_id = ?", (req.key_id,)).fetchone()
-    conn.close()
-    
+    try:
+        query = f"{keks.select('master_keys')} WHERE tenant_id = ?"
+        if req.version is None:
+            row = conn.execute(f"{query} ORDER BY version DESC LIMIT 1", (req.tenant_id,)).fetchone()
+            if row is None:
+                require_primary()
+                # A concurrent first request may win the insert
+                kek_version, wrapped = keks.wrap(conn, get_random_bytes(32), f"{req.tenant_id}:1")
+                conn.execute("INSERT OR IGNORE INTO master_keys (tenant_id, version, key_bytes, created_at, kek_version) "
+                             "VALUES (?, 1, ?, ?, ?)",
+                             (req.tenant_id, wrapped, datetime.datetime.now().isoformat(), kek_version))
+                conn.commit()
+                row = conn.execute(f"{query} AND version = 1", (req.tenant_id,)).fetchone()
+        else:
+            row = conn.execute(f"{query} AND version = ?", (req.tenant_id, req.version)).fetchone()
+        key_bytes = keks.load(conn, "master_keys", row) if row else None
+    finally:
+        conn.close()
+
     if not row:
-        raise HTTPException(status_code=404, detail="Key not found")
-        
-    return GetKeyResponse(key_bytes_b64=base64.b64encode(row['key_bytes']).decode())
+        raise HTTPException(status_code=404, detail="Master key not found")
+    return MasterKeyResponse(tenant_id=req.tenant_id, version=row['version'],
+                             key_bytes_b64=base64.b64encode(key_bytes).decode())
+
+class PreUserRequest(BaseModel):
+    user_id: str
+
+class PrePublicKeyResponse(BaseModel):
+    user_id: str
+    public_key_b64: str
+
+def load_pre_secret(conn, user_id: str) -> int:
+    row = conn.execute(f"{keks.select('pre_keys')} WHERE user_id = ?", (user_id,)).fetchone()
+    if not row:
+        raise HTTPException(status_code=404, detail="PRE key pair not found")
+    return int.from_bytes(keks.load(conn, "pre_keys", row), "big")
+
+def pre_keypair(conn, user_id: str) -> bytes:
+    """
+    user_id's PRE public key, creating the key pair on first use.
+    """
+    row = conn.execute("SELECT public_key FROM pre_keys WHERE user_id = ?", (user_id,)).fetchone()
+    if row is None:
+        require_primary()
+        secret, public = pre.generate_keypair()
+        kek_version, wrapped = keks.wrap(conn, pre.encode_scalar(secret), f"pre:{user_id}")
+        # A concurrent first request may win the insert
+        conn.execute("INSERT OR IGNORE INTO pre_keys (user_id, key_bytes, public_key, created_at, kek_version) "
+                     "VALUES (?, ?, ?, ?, ?)",
+                     (user_id, wrapped, public, datetime.datetime.now().isoformat(), kek_version))
+        conn.commit()
+        row = conn.execute("SELECT public_key FROM pre_keys WHERE user_id = ?", (user_id,)).fetchone()
+    return row['public_key']
+
+def _fetch_public_key(base_url: str, user_id: str) -> bytes:
+    resp = requests.post(f"{base_url}/pre/public_key", json={"user_id": user_id}, timeout=2)
+    resp.raise_for_status()
+    return base64.b64decode(resp.json()["public_key_b64"])
+
+def pre_public_key_of(user_id: str) -> bytes:
+    """
+    user_id's PRE public key from this shard, or from the shard it lives on.
+    """
+    if ring.node_for(user_id) == str(SHARD):
+        conn = db.get_db_connection()
+        try:
+            return pre_keypair(conn, user_id)
+        finally:
+            conn.close()
+    if peers is None:
+        raise HTTPException(status_code=503, detail=f"User {user_id} is on another shard and KMS_SHARDS is not set")
+    try:
+        return peers.read(user_id, lambda base_url: _fetch_public_key(base_url, user_id))
+    except Exception as e:
+        raise HTTPException(status_code=502, detail=f"Failed to fetch public key of {user_id}: {e}")
+
+@app.post("/pre/public_key", response_model=PrePublicKeyResponse)
+def pre_public_key(req: PreUserRequest):
+    """
+    A user's proxy re-encryption public key, creating the key pair on
+    first use. The secret never leaves the KMS.
+    """
+    conn = db.get_db_connection()
+    try:
+        public = pre_keypair(conn, req.user_id)
+    finally:
+        conn.close()
+    return PrePublicKeyResponse(user_id=req.user_id, public_key_b64=base64.b64encode(public).decode())
+
+class PreRekeyRequest(BaseModel):
+    from_user: str
+    to_user: str
+
+# A rekey plus the recipient's secret gives the sender's secret, so rekeys
+# only go to the proxy tier (service token holders), only for the user the
+# call is made for, and only towards a public key the KMS itself looked up
+@app.post("/pre/rekey")
+def pre_rekey(req: PreRekeyRequest, user: str = Depends(auth.caller)):
+    """
+    A rekey from from_user to to_user, for the proxy.
+    """
+    if user != req.from_user:
+        raise HTTPException(status_code=403, detail="Rekeys can only be made for the calling user")
+    to_public = pre_public_key_of(req.to_user)
+    conn = db.get_db_connection()
+    try:
+        pre_keypair(conn, req.from_user)
+        secret = load_pre_secret(conn, req.from_user)
+    except ValueError:
+        raise HTTPException(status_code=500, detail="Key failed to unwrap")
+    finally:
+        conn.close()
+    try:
+        rk = pre.make_rekey(secret, to_public)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"rk_b64": base64.b64encode(rk).decode()}
+
+class PreUnwrapRequest(BaseModel):
+    user_id: str
+    wrapped: str
+
+# Only for the user the call is made for (the gateway's /files/unwrap),
+# otherwise any client could open whatever was shared with anyone
+@app.post("/unwrap_key/pre", response_model=GetKeyResponse)
+def unwrap_pre(req: PreUnwrapRequest, user: str = Depends(auth.caller)):
+    """
+    Opens a data key wrapped for user_id, directly or through a rekey.
+    """
+    if user != req.user_id:
+        raise HTTPException(status_code=403, detail="Keys can only be unwrapped for the calling user")
+    conn = db.get_db_connection()
+    try:
+        secret = load_pre_secret(conn, req.user_id)
+    except ValueError:
+        raise HTTPException(status_code=500, detail="Key failed to unwrap")
+    finally:
+        conn.close()
+    try:
+        key_bytes = pre.decrypt(secret, base64.b64decode(req.wrapped))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Wrapped key is invalid or not for this user")
+    return GetKeyResponse(key_bytes_b64=base64.b64encode(key_bytes).decode())
+
+class RotateRequest(BaseModel):
+    rate: Optional[int] = None # Rows re-wrapped per second; unchanged when None
+
+@app.post("/admin/rotate")
+def rotate(req: RotateRequest = RotateRequest()):
+    """
+    Starts using a new KEK. Data keys are re-wrapped under it in the
+    background and on access; no ciphertext is touched.
+    """
+    require_primary()
+    if req.rate:
+        keks.rate = req.rate
+    version = keks.rotate()
+    return {"kek_version": version, **keks.progress()}
+
+@app.get("/admin/rotation")
+def rotation():
+    return keks.progress()
+
+@app.put("/admin/rotation/rate")
+def rotation_rate(req: RotateRequest):
+    if not req.rate or req.rate < 1:
+        raise HTTPException(status_code=400, detail="rate must be positive")
+    keks.rate = req.rate
+    return keks.progress()
+
+# Carries KEKs and wrapped keys: replicas only
+@app.get("/replication/log", dependencies=[Depends(auth.require_service)])
+def replication_log(after: int = 0, limit: int = replication.REPLICATION_BATCH, replica: Optional[str] = None):
+    return replication.changes(after, min(limit, replication.REPLICATION_BATCH), replica)
+
+@app.get("/replication/status")
+def replication_status():
+    return {"shard": SHARD, "shard_count": SHARD_COUNT, "replica_of": REPLICA_OF, **replication.status()}
 
 @app.get("/debug/keys")
 def debug_keys():
@@ -66,6 +316,68 @@ def debug_keys():
     conn.close()
     return {"keys": [row['key_id'] for row in rows]}
 
+# SQLite variable limit per IN (...) query
+LOOKUP_BATCH = 500
+# Most keys one /get_keys call returns; larger sets use /get_keys/stream
+MAX_KEYS = 5000
+
+class GetKeysRequest(BaseModel):
+    key_ids: List[str]
+
+class GetKeysResponse(BaseModel):
+    keys: Dict[str, str] # key_id -> key_bytes_b64
+    missing: List[str]
+
+def lookup_keys(conn, key_ids: list) -> dict:
+    """
+    key_id -> key bytes for the ones that exist, one query per LOOKUP_BATCH.
+    """
+    found = {}
+    for i in range(0, len(key_ids), LOOKUP_BATCH):
+        batch = key_ids[i:i + LOOKUP_BATCH]
+        rows = conn.execute(f"{keks.select('keys')} WHERE key_id IN ({','.join('?' * len(batch))})", batch).fetchall()
+        found.update(zip((row['key_id'] for row in rows), keks.load_many(conn, "keys", rows)))
+    return found
+
+@app.post("/get_keys", response_model=GetKeysResponse)
+def get_keys(req: GetKeysRequest):
+    key_ids = list(dict.fromkeys(req.key_ids))
+    if len(key_ids) > MAX_KEYS:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_KEYS} keys per call; use /get_keys/stream")
+    conn = db.get_db_connection()
+    try:
+        found = lookup_keys(conn, key_ids)
+    except ValueError:
+        raise HTTPException(status_code=500, detail="Key failed to unwrap")
+    finally:
+        conn.close()
+    return GetKeysResponse(keys={key_id: base64.b64encode(key).decode() for key_id, key in found.items()},
+                           missing=[key_id for key_id in key_ids if key_id not in found])
+
+@app.post("/get_keys/stream")
+def get_keys_stream(req: GetKeysRequest):
+    """
+    /get_keys for any number of keys, as newline-delimited JSON objects
+    ({"key_id", "key_bytes_b64"}, or {"key_id", "missing": true}) sent one
+    lookup batch at a time.
+    """
+    key_ids = list(dict.fromkeys(req.key_ids))
+
+    def lines():
+        for i in range(0, len(key_ids), LOOKUP_BATCH):
+            batch = key_ids[i:i + LOOKUP_BATCH]
+            # Each step may run on a different thread, so no connection outlives one
+            conn = db.get_db_connection()
+            try:
+                found = lookup_keys(conn, batch)
+            finally:
+                conn.close()
+            yield "".join(json.dumps({"key_id": key_id, "key_bytes_b64": base64.b64encode(found[key_id]).decode()}
+                                     if key_id in found else {"key_id": key_id, "missing": True}) + "\n"
+                          for key_id in batch)
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
 class WrapKeyRequest(BaseModel):
     key_id: str
     identity: str
@@ -73,18 +385,33 @@ class WrapKeyRequest(BaseModel):
 @app.post("/wrap_key/ibe")
 def wrap_ibe(req: WrapKeyRequest):
     # Fetch key
-    conn = db.get_db_connection()
-    row = conn.execute("SELECT key_bytes FROM keys WHERE key_id = ?", (req.key_id,)).fetchone()
-    conn.close()
-    
-    if not row:
-        raise HTTPException(status_code=404, detail="Key not found")
+    key_bytes = load_key(req.key_id)
         
     # Wrap
-    wrapped = wrappers.ibe_wrap_key(row['key_bytes'], req.identity)
+    wrapped = wrappers.ibe_wrap_key(key_bytes, req.identity)
     return {"wrapped": wrapped, "key_id": req.key_id}
 
 if __name__ == "__main__":
-    import uvicorn
-    print("Starting KMS on port 8005")
-    uvicorn.run(app, host="0.0.0.0", port=8005)
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8005)
+    parser.add_argument("--db", type=str, default=db.DB_PATH)
+    parser.add_argument("--shard", type=int, default=SHARD, help="Shard this process serves")
+    parser.add_argument("--shard-count", type=int, default=SHARD_COUNT)
+    parser.add_argument("--replica-of", type=str, default=REPLICA_OF, help="Primary URL; runs as a read-only replica")
+    parser.add_argument("--shards", type=str, default=os.environ.get("KMS_SHARDS", ""),
+                        help="All shards, as KMS_SHARDS; needed for rekeys to users on other shards")
+    serve.add_arguments(parser)
+    args = parser.parse_args()
+    os.environ["KMS_DB"] = db.DB_PATH = args.db
+    os.environ["KMS_SHARD"] = str(args.shard)
+    os.environ["KMS_SHARD_COUNT"] = str(args.shard_count)
+    os.environ["KMS_REPLICA_OF"] = args.replica_of or ""
+    os.environ["KMS_SHARDS"] = args.shards
+    SHARD, SHARD_COUNT, REPLICA_OF = args.shard, args.shard_count, args.replica_of
+    ring = HashRing([str(i) for i in range(SHARD_COUNT)])
+    peers = KMSRouter(parse_shards(args.shards)) if args.shards else None
+    role = f"replica of {REPLICA_OF}" if REPLICA_OF else "primary"
+    print(f"Starting KMS on port {args.port} (shard {SHARD}/{SHARD_COUNT}, {role})")
+    serve.run(app, "services.kms.main:app", args.port, args.workers)
@@ -0,0 +1,234 @@
+import json
+import os
+import socket
+import threading
+import time
+
+import requests
+
+from common import auth, metrics
+from services.kms import db
+
+# Log shipping to read replicas. Triggers append a full image of every row
+# written to the replicated tables to `changelog`; a replica pulls entries
+# after the last sequence number it applied and upserts them, in order, in
+# one transaction per batch. Rows are never deleted, so replaying an image
+# is idempotent and a replica that falls behind just catches up.
+#
+# The log carries wrapped keys and the KEKs that unwrap them, so pulling it
+# needs the service token. Each pull names the replica and how far it has
+# applied; the primary compacts entries up to the lowest position among
+# replicas seen within REPLICA_TTL, keeping only the latest image of each
+# row. A replica further behind (or a new one) still converges, because
+# every row's latest image stays in the log.
+TABLES = {
+    "keks": ("version", "key_bytes", "created_at"),
+    "keys": ("key_id", "key_bytes", "created_at", "kek_version"),
+    "master_keys": ("tenant_id", "version", "key_bytes", "created_at", "kek_version"),
+    "pre_keys": ("user_id", "key_bytes", "public_key", "created_at", "kek_version"),
+}
+BLOB_COLUMNS = {"key_bytes", "public_key"}
+# Columns identifying a row, for compaction
+KEYS = {
+    "keks": ("version",),
+    "keys": ("key_id",),
+    "master_keys": ("tenant_id", "version"),
+    "pre_keys": ("user_id",),
+}
+# Entries per pull; a full batch is followed by another pull right away
+REPLICATION_BATCH = 1000
+REPLICATION_INTERVAL = 0.5
+# Replicas that haven't pulled for this long no longer hold back compaction
+REPLICA_TTL = float(os.environ.get("KMS_REPLICA_TTL", 24 * 3600))
+TRUNCATE_INTERVAL = 60.0
+
+_stop = threading.Event()
+_thread = None
+_lag = 0
+
+REPLICATION_LAG = metrics.gauge("kms_replication_lag_entries", "Changelog entries the replica has yet to apply",
+                                fn=lambda: _lag)
+REPLICATION_APPLIED = metrics.counter("kms_replication_applied_total", "Changelog entries applied by the replica")
+TRUNCATED = metrics.counter("kms_changelog_truncated_total", "Superseded changelog entries removed by compaction")
+
+def _image(table: str) -> str:
+    """
+    SQL building the JSON image of NEW (blobs as hex) for a trigger.
+    """
+    return "json_object(" + ", ".join(
+        f"'{col}', hex(NEW.{col})" if col in BLOB_COLUMNS else f"'{col}', NEW.{col}" for col in TABLES[table]) + ")"
+
+def init():
+    """
+    Creates the changelog and its triggers. A database that already holds
+    rows gets them logged once, so a new replica can start from sequence 0.
+    """
+    conn = db.get_db_connection()
+    try:
+        install(conn)
+        conn.commit()
+    finally:
+        conn.close()
+
+def install(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS changelog (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            tbl TEXT,
+            row TEXT
+        )
+    ''')
+    conn.execute("CREATE TABLE IF NOT EXISTS replication_state (id INTEGER PRIMARY KEY CHECK (id = 0), seq INTEGER)")
+    # On a primary: how far each replica has applied, as of its last pull
+    conn.execute("CREATE TABLE IF NOT EXISTS replicas (id TEXT PRIMARY KEY, seq INTEGER, seen_at REAL)")
+    seed = conn.execute("SELECT COUNT(*) FROM changelog").fetchone()[0] == 0
+    for table in TABLES:
+        for event in ("INSERT", "UPDATE"):
+            conn.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS {table}_{event.lower()}_log AFTER {event} ON {table}
+                BEGIN
+                    INSERT INTO changelog (tbl, row) VALUES ('{table}', {_image(table)});
+                END
+            ''')
+        if seed:
+            conn.execute(f"INSERT INTO changelog (tbl, row) SELECT '{table}', {_image(table).replace('NEW.', '')} FROM {table}")
+
+def changes(after: int, limit: int = REPLICATION_BATCH, replica: str = None) -> dict:
+    """
+    Entries after `after`. `replica` names the caller, which has applied
+    everything up to `after`.
+    """
+    conn = db.get_db_connection()
+    try:
+        if replica:
+            conn.execute("INSERT OR REPLACE INTO replicas (id, seq, seen_at) VALUES (?, ?, ?)",
+                         (replica, after, time.time()))
+            conn.commit()
+        rows = conn.execute("SELECT seq, tbl, row FROM changelog WHERE seq > ? ORDER BY seq LIMIT ?",
+                            (after, limit)).fetchall()
+        last = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changelog").fetchone()[0]
+    finally:
+        conn.close()
+    return {"entries": [[row['seq'], row['tbl'], row['row']] for row in rows], "last_seq": last}
+
+def watermark(conn) -> int:
+    """
+    The sequence number every live replica has applied (everything, if none).
+    """
+    return conn.execute("SELECT COALESCE((SELECT MIN(seq) FROM replicas WHERE seen_at > ?), "
+                        "(SELECT MAX(seq) FROM changelog), 0)", (time.time() - REPLICA_TTL,)).fetchone()[0]
+
+def truncate() -> int:
+    """
+    Drops changelog entries up to the watermark that a later entry for the
+    same row, also up to the watermark, supersedes. Returns how many.
+    """
+    conn = db.get_db_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        upto = watermark(conn)
+        conn.execute("DELETE FROM replicas WHERE seen_at <= ?", (time.time() - REPLICA_TTL,))
+        removed = 0
+        for table, keys in KEYS.items():
+            row_id = ", ".join(f"json_extract(row, '$.{col}')" for col in keys)
+            removed += conn.execute(f"""
+                DELETE FROM changelog WHERE tbl = ? AND seq <= ? AND seq NOT IN
+                    (SELECT MAX(seq) FROM changelog WHERE tbl = ? AND seq <= ? GROUP BY {row_id})
+            """, (table, upto, table, upto)).rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    TRUNCATED.inc(removed)
+    return removed
+
+def applied_seq(conn) -> int:
+    row = conn.execute("SELECT seq FROM replication_state WHERE id = 0").fetchone()
+    return row['seq'] if row else 0
+
+def apply(entries: list):
+    """
+    Upserts changelog entries from the primary, recording how far it got.
+    Entries at or before that point are skipped, so an older image never
+    overwrites a newer one.
+    """
+    conn = db.get_db_connection()
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        after = applied_seq(conn)
+        entries = [entry for entry in entries if entry[0] > after]
+        if not entries:
+            conn.rollback()
+            return
+        for seq, table, image in entries:
+            cols = TABLES[table]
+            row = json.loads(image)
+            values = [bytes.fromhex(row[col]) if col in BLOB_COLUMNS and row[col] is not None else row[col] for col in cols]
+            conn.execute(f"INSERT OR REPLACE INTO {table} ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})", values)
+        conn.execute("INSERT OR REPLACE INTO replication_state (id, seq) VALUES (0, ?)", (entries[-1][0],))
+        conn.commit()
+    finally:
+        conn.close()
+    REPLICATION_APPLIED.inc(len(entries))
+
+def pull(primary_url: str) -> int:
+    """
+    Applies one batch from the primary. Returns how many entries it applied.
+    """
+    global _lag
+    conn = db.get_db_connection()
+    try:
+        after = applied_seq(conn)
+    finally:
+        conn.close()
+    resp = requests.get(f"{primary_url}/replication/log", params={"after": after, "limit": REPLICATION_BATCH,
+                                                                  "replica": replica_id()},
+                        headers=auth.service_headers(), timeout=5)
+    resp.raise_for_status()
+    body = resp.json()
+    apply(body["entries"])
+    applied = body["entries"][-1][0] if body["entries"] else after
+    _lag = max(0, body["last_seq"] - applied)
+    return len(body["entries"])
+
+def replica_id() -> str:
+    # Stable across restarts of the same replica
+    return os.environ.get("KMS_REPLICA_ID") or f"{socket.gethostname()}:{os.path.abspath(db.DB_PATH)}"
+
+def status() -> dict:
+    conn = db.get_db_connection()
+    try:
+        replicas = {row['id']: row['seq'] for row in conn.execute("SELECT id, seq FROM replicas")}
+        return {"applied_seq": applied_seq(conn), "lag": _lag, "replicas": replicas}
+    finally:
+        conn.close()
+
+def _follow(primary_url: str):
+    while not _stop.is_set():
+        try:
+            if pull(primary_url) == REPLICATION_BATCH:
+                continue
+        except (requests.RequestException, ValueError):
+            pass # Primary unreachable; serve what we have and keep trying
+        _stop.wait(REPLICATION_INTERVAL)
+
+def _compact():
+    while not _stop.wait(TRUNCATE_INTERVAL):
+        try:
+            truncate()
+        except Exception:
+            pass # Database busy; next round
+
+def start(primary_url: str = None):
+    """
+    Follows `primary_url` as a replica, or keeps this primary's log compacted.
+    """
+    global _thread
+    _stop.clear()
+    if primary_url:
+        _thread = threading.Thread(target=_follow, args=(primary_url,), daemon=True, name="kms-replication")
+    else:
+        _thread = threading.Thread(target=_compact, daemon=True, name="kms-changelog-compaction")
+    _thread.start()
+
+def stop():
+    _stop.set()
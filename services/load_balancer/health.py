@@ -0,0 +1,98 @@
+import statistics
+import time
+from collections import deque
+
+# Circuit breaker tuning
+FAILURE_THRESHOLD = 5          # consecutive failures that open the circuit
+ERROR_WINDOW = 20              # recent requests considered for the error rate
+ERROR_RATE_THRESHOLD = 0.5     # open if at least this share of the window failed
+OPEN_SECONDS = 10.0            # how long an open circuit rejects traffic before probing
+
+# Latency outlier ejection
+SLOW_FACTOR = 3.0              # eject a node this many times slower than its peers' median
+SLOW_FLOOR_MS = 250.0          # ...but never for latencies below this
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+class CircuitBreaker:
+    """
+    Passive health for one node, driven by real request outcomes.
+    closed -> open after too many failures; open -> half_open after OPEN_SECONDS,
+    letting a single probe request through; the probe's outcome closes or reopens it.
+    """
+    def __init__(self):
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.recent = deque(maxlen=ERROR_WINDOW)
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.reason = None
+
+    def available(self) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            return time.monotonic() - self.opened_at >= OPEN_SECONDS
+        return not self.probe_in_flight
+
+    def acquire(self):
+        # Called on the node that was actually picked
+        if self.state != CLOSED:
+            self.state = HALF_OPEN
+            self.probe_in_flight = True
+
+    def on_success(self) -> bool:
+        """
+        Returns True if this success closed a half-open circuit.
+        """
+        self.consecutive_failures = 0
+        self.recent.append(True)
+        if self.state == HALF_OPEN:
+            self.state = CLOSED
+            self.probe_in_flight = False
+            self.recent.clear()
+            self.reason = None
+            return True
+        return False
+
+    def on_failure(self):
+        self.consecutive_failures += 1
+        self.recent.append(False)
+        if self.state == HALF_OPEN:
+            self.trip("probe failed")
+        elif self.consecutive_failures >= FAILURE_THRESHOLD:
+            self.trip(f"{self.consecutive_failures} consecutive failures")
+        elif len(self.recent) == ERROR_WINDOW:
+            error_rate = self.recent.count(False) / ERROR_WINDOW
+            if error_rate >= ERROR_RATE_THRESHOLD:
+                self.trip(f"error rate {error_rate:.0%}")
+
+    def trip(self, reason: str):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.probe_in_flight = False
+        self.reason = reason
+
+    def to_dict(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "reason": self.reason
+        }
+
+def find_latency_outlier(node: str, stats: dict, breakers: dict):
+    """
+    Returns a reason string if `node` is much slower than the other closed nodes.
+    Never ejects the last closed node.
+    """
+    peers = [n for n, b in breakers.items()
+             if n != node and b.state == CLOSED and stats[n].ewma_latency_ms is not None]
+    latency = stats[node].ewma_latency_ms
+    if not peers or latency is None or latency < SLOW_FLOOR_MS:
+        return None
+    median = statistics.median(stats[n].ewma_latency_ms for n in peers)
+    if latency > SLOW_FACTOR * max(median, 1.0):
+        return f"latency outlier ({latency:.0f}ms vs peer median {median:.0f}ms)"
+    return None
@@ -1,6 +1,10 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends, Request
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
 import httpx
 import asyncio
+import json
+import time
 import sys
 import os
 from typing import List
@@ -8,51 +12,174 @@ from typing import List
 # Add project root to sys.path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
 
-from common.schemas import ReEncryptRequest, ReEncryptResponse, ReKeyRequest, ReKeyResponse
+from services.load_balancer.routing import NodeStats, get_strategy
+from services.load_balancer.health import CircuitBreaker, CLOSED, find_latency_outlier
+from common import tracing, metrics, profiler, deadline, serve, auth
+from common.store import LocalStore
+from common.schemas import ReEncryptRequest, ReEncryptResponse, ReKeyRequest, ReKeyResponse, RevokeReKeyRequest, ReEncryptBatchRequest
 
 app = FastAPI(title="Load Balancer Service")
+tracing.instrument_app(app, "load_balancer")
+metrics.instrument_app(app, "load_balancer")
+profiler.instrument_app(app, "load_balancer")
+deadline.instrument_app(app)
 
-# Configuration (In a real app, load from config/env)
+# Seed nodes; more proxies can join at runtime through /admin/nodes/register
 PROXY_NODES = [
     "http://localhost:8003",
     "http://localhost:8004"
 ]
+# Worker processes get the command-line settings through the environment
+if "LB_NODES" in os.environ:
+    PROXY_NODES = [node for node in os.environ["LB_NODES"].split(",") if node]
+
+# One of services.load_balancer.routing.STRATEGIES
+ROUTING_STRATEGY = os.environ.get("LB_STRATEGY", "least_outstanding")
+HEALTH_CHECK_INTERVAL = 5
+HEALTH_CHECK_TIMEOUT = 2.0
+# Extra attempts, each on a different node
+RETRIES = 1
+# Registered nodes that miss heartbeats this long are drained and dropped
+HEARTBEAT_TTL = 15
+# A draining node is dropped once idle, or after this long regardless
+DRAIN_TIMEOUT = 30
 
 class LoadBalancer:
-    def __init__(self, nodes: List[str]):
-        self.nodes = nodes
+    def __init__(self, nodes: List[str], strategy: str = ROUTING_STRATEGY):
+        self.nodes = list(nodes)
         self.healthy_nodes = []
-        self.current_idx = 0
-        self._lock = asyncio.Lock()
+        self.stats = {node: NodeStats() for node in nodes}
+        self.breakers = {node: CircuitBreaker() for node in nodes}
+        # Only nodes that registered themselves are expected to heartbeat
+        self.heartbeats = {}
+        self.draining = {}
+        self.strategy_name = strategy
+        self.strategy = get_strategy(strategy)
+
+    def set_strategy(self, name: str):
+        self.strategy = get_strategy(name)
+        self.strategy_name = name
+
+    async def check_node(self, client: httpx.AsyncClient, node: str) -> bool:
+        try:
+            resp = await client.get(f"{node}/health", timeout=HEALTH_CHECK_TIMEOUT)
+            return resp.status_code == 200
+        except:
+            return False
 
     async def update_health(self):
-        healthy = []
+        nodes = list(self.nodes)
         async with httpx.AsyncClient() as client:
-            for node in self.nodes:
-                try:
-                    resp = await client.get(f"{node}/health", timeout=2.0)
-                    if resp.status_code == 200:
-                        healthy.append(node)
-                except:
-                    pass
+            results = await asyncio.gather(*[self.check_node(client, node) for node in nodes])
         
-        async with self._lock:
-            self.healthy_nodes = healthy
-            # print(f"Healthy nodes: {self.healthy_nodes}")
-
-    async def get_next_node(self):
-        async with self._lock:
-            if not self.healthy_nodes:
-                return None
-            
-            node = self.healthy_nodes[self.current_idx % len(self.healthy_nodes)]
-            self.current_idx += 1
-            return node
+        # Single reference swap, readers always see a complete list.
+        # Skip nodes removed while the checks were in flight.
+        self.healthy_nodes = [node for node, ok in zip(nodes, results) if ok and node in self.stats]
+
+    # --- Membership ---
+
+    def add_node(self, node: str):
+        self.draining.pop(node, None)
+        if node not in self.stats:
+            self.stats[node] = NodeStats()
+            self.breakers[node] = CircuitBreaker()
+            self.nodes = self.nodes + [node]
+        self.heartbeats[node] = time.monotonic()
+
+    def heartbeat(self, node: str) -> bool:
+        """
+        Returns False for unknown or draining nodes, which should re-register.
+        """
+        if node not in self.stats or node in self.draining:
+            return False
+        self.heartbeats[node] = time.monotonic()
+        return True
+
+    def drain_node(self, node: str):
+        # Stop routing new requests; in-flight ones finish before removal
+        if node in self.stats:
+            self.draining.setdefault(node, time.monotonic())
+
+    def remove_node(self, node: str):
+        self.nodes = [n for n in self.nodes if n != node]
+        self.healthy_nodes = [n for n in self.healthy_nodes if n != node]
+        for state in (self.stats, self.breakers, self.heartbeats, self.draining):
+            state.pop(node, None)
+
+    def sweep(self):
+        now = time.monotonic()
+        for node, last_seen in list(self.heartbeats.items()):
+            if now - last_seen > HEARTBEAT_TTL:
+                self.drain_node(node)
+        for node, since in list(self.draining.items()):
+            if self.stats[node].outstanding == 0 or now - since > DRAIN_TIMEOUT:
+                self.remove_node(node)
+
+    def get_next_node(self, exclude=()):
+        """
+        Picks a healthy node not in `exclude` whose circuit admits traffic.
+        """
+        nodes = [n for n in self.healthy_nodes
+                 if n not in exclude and n not in self.draining and self.breakers[n].available()]
+        if not nodes:
+            return None
+        node = self.strategy.pick(nodes, self.stats)
+        self.breakers[node].acquire()
+        return node
+
+    def record(self, node: str, started: float, ok: bool, record_latency: bool = True):
+        if node not in self.stats:
+            return # Removed after a drain timeout
+        stats, breaker = self.stats[node], self.breakers[node]
+        if ok and breaker.on_success():
+            # Node just recovered; don't judge it on latency from before the outage
+            stats.ewma_latency_ms = None
+        stats.finish(started, ok, record_latency)
+        if not ok:
+            breaker.on_failure()
+        elif breaker.state == CLOSED:
+            reason = find_latency_outlier(node, self.stats, self.breakers)
+            if reason:
+                breaker.trip(reason)
 
 lb = LoadBalancer(PROXY_NODES)
 
+# A registration or heartbeat reaches only the worker that took the request.
+# With several workers, membership goes through the shared store (entries
+# expire after HEARTBEAT_TTL) and each worker applies it to its own balancer;
+# health checks and routing stats stay per worker.
+membership = LocalStore("lb_nodes") if serve.worker_count() > 1 else None
+
+def sync_membership():
+    for node, entry in membership.items().items():
+        if entry["draining"]:
+            lb.drain_node(node)
+        elif not lb.heartbeat(node):
+            lb.add_node(node)
+
+# Per-node stats are read from the balancer at scrape time
+def node_values(fn):
+    return lambda: {(node,): fn(node, stats) for node, stats in list(lb.stats.items())}
+
+metrics.counter("lb_node_requests_total", "Requests routed to each node", ("node",),
+                fn=node_values(lambda node, s: s.requests))
+metrics.counter("lb_node_errors_total", "Failed requests per node", ("node",),
+                fn=node_values(lambda node, s: s.errors))
+metrics.gauge("lb_node_outstanding", "In-flight requests per node", ("node",),
+              fn=node_values(lambda node, s: s.outstanding))
+metrics.gauge("lb_node_ewma_latency_ms", "Latency EWMA per node", ("node",),
+              fn=node_values(lambda node, s: s.ewma_latency_ms))
+metrics.gauge("lb_node_p95_latency_ms", "p95 of recent latencies per node", ("node",),
+              fn=node_values(lambda node, s: s.p95_latency_ms()))
+metrics.gauge("lb_node_healthy", "1 when the node passes health checks", ("node",),
+              fn=node_values(lambda node, s: int(node in lb.healthy_nodes)))
+metrics.gauge("lb_node_circuit_closed", "1 when the node's circuit breaker admits all traffic", ("node",),
+              fn=node_values(lambda node, s: int(lb.breakers[node].state == CLOSED)))
+
 @app.on_event("startup")
 async def startup_event():
+    if membership is not None:
+        sync_membership()
     # Initial health check
     await lb.update_health()
     # Start background loop
@@ -60,52 +187,263 @@ async def startup_event():
 
 async def health_check_loop():
     while True:
-        await asyncio.sleep(5)
+        await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+        if membership is not None:
+            sync_membership()
+        lb.sweep()
         await lb.update_health()
 
+# async so it runs on the event loop and never sees membership mid-update
 @app.get("/health")
-def health():
+async def health():
     return {
         "status": "ok", 
         "healthy_upstreams": len(lb.healthy_nodes),
-        "total_upstreams": len(lb.nodes)
+        "total_upstreams": len(lb.nodes),
+        "strategy": lb.strategy_name,
+        "nodes": {node: dict(stats.to_dict(), healthy=node in lb.healthy_nodes,
+                             draining=node in lb.draining,
+                             circuit=lb.breakers[node].to_dict())
+                  for node, stats in lb.stats.items()}
     }
 
+# --- Admin API: dynamic upstream membership ---
+# Changing membership needs the service token, or anyone could add a node
+# and have tenants' re-encryptions routed to it
+
+class NodeRequest(BaseModel):
+    url: str
+
+class DeregisterRequest(BaseModel):
+    url: str
+    drain: bool = True
+
+@app.post("/admin/nodes/register", dependencies=[Depends(auth.require_service)])
+async def register_node(req: NodeRequest):
+    lb.add_node(req.url)
+    if membership is not None:
+        membership.set(req.url, {"draining": False}, ttl=HEARTBEAT_TTL)
+    # Check now so the node takes traffic without waiting for the next health loop
+    async with httpx.AsyncClient() as client:
+        if await lb.check_node(client, req.url) and req.url not in lb.healthy_nodes:
+            lb.healthy_nodes = lb.healthy_nodes + [req.url]
+    return {"status": "registered", "url": req.url, "heartbeat_ttl": HEARTBEAT_TTL}
+
+@app.post("/admin/nodes/heartbeat", dependencies=[Depends(auth.require_service)])
+async def node_heartbeat(req: NodeRequest):
+    if membership is not None:
+        entry = membership.get(req.url)
+        if entry is None or entry["draining"]:
+            raise HTTPException(status_code=404, detail="Node not registered")
+        membership.set(req.url, entry, ttl=HEARTBEAT_TTL)
+        if not lb.heartbeat(req.url):
+            lb.add_node(req.url) # Registered through another worker
+        return {"status": "ok"}
+    if not lb.heartbeat(req.url):
+        raise HTTPException(status_code=404, detail="Node not registered")
+    return {"status": "ok"}
+
+@app.post("/admin/nodes/deregister", dependencies=[Depends(auth.require_service)])
+async def deregister_node(req: DeregisterRequest):
+    shared = membership is not None and membership.get(req.url) is not None
+    if req.url not in lb.stats and not shared:
+        raise HTTPException(status_code=404, detail="Node not registered")
+    if shared:
+        # Other workers drain it on their next sync
+        membership.set(req.url, {"draining": True}, ttl=DRAIN_TIMEOUT)
+    if req.drain:
+        lb.drain_node(req.url)
+        lb.sweep()
+    else:
+        lb.remove_node(req.url)
+    return {"status": "draining" if req.url in lb.draining else "removed", "url": req.url}
+
+@app.get("/admin/nodes")
+async def list_nodes():
+    return {
+        "nodes": lb.nodes,
+        "healthy": lb.healthy_nodes,
+        "draining": list(lb.draining)
+    }
+
+async def forward(path: str, payload: dict, idempotent: bool = True, headers: dict = None):
+    """
+    Forwards to a proxy node. Idempotent calls that fail with a connection
+    error or 5xx are retried on a different node; non-idempotent calls only
+    when the connection was never established.
+    """
+    tried = []
+    last_status = 502
+    while True:
+        if deadline.expired():
+            # No budget left for another attempt
+            raise HTTPException(status_code=504, detail="Request deadline exceeded")
+        node = lb.get_next_node(exclude=tried)
+        if not node:
+            if tried:
+                raise HTTPException(status_code=last_status, detail="Proxy error after retries")
+            raise HTTPException(status_code=503, detail="No healthy proxies available")
+        tried.append(node)
+        can_retry = len(tried) <= RETRIES
+        
+        started = lb.stats[node].start()
+        ok = False
+        async with httpx.AsyncClient() as client:
+            try:
+                # Forward the request
+                resp = await client.post(f"{node}{path}", json=payload, headers=headers)
+                ok = resp.status_code < 500
+                if resp.status_code >= 500 and idempotent and can_retry:
+                    last_status = resp.status_code
+                    continue
+                if resp.status_code != 200:
+                    raise HTTPException(status_code=resp.status_code, detail="Proxy error")
+                return resp.json()
+            except httpx.ConnectError:
+                if can_retry:
+                    continue
+                raise HTTPException(status_code=502, detail="Proxy communication failed")
+            except httpx.RequestError:
+                if idempotent and can_retry:
+                    continue
+                raise HTTPException(status_code=502, detail="Proxy communication failed")
+            finally:
+                lb.record(node, started, ok)
+
 @app.post("/reencrypt", response_model=ReEncryptResponse)
 async def map_reencrypt(req: ReEncryptRequest):
-    node = await lb.get_next_node()
-    if not node:
-        raise HTTPException(status_code=503, detail="No healthy proxies available")
-    
-    async with httpx.AsyncClient() as client:
+    return await forward("/reencrypt", req.dict())
+
+# Batches smaller than this go to a single node
+BATCH_MIN_CHUNK = 256
+
+# A node that sends nothing for this long is treated as failed for the rest of its chunk
+BATCH_READ_TIMEOUT = 30.0
+
+async def stream_batch_chunk(node: str, items: list, indices: list, user: str,
+                             emitted: set, queue: asyncio.Queue):
+    """
+    Streams one sub-batch from `node`. `indices` maps the node's local item
+    index to the batch index. Returns None on success, else an error string.
+    """
+    started = lb.stats[node].start()
+    ok = False
+    try:
+        timeout = httpx.Timeout(5.0, read=BATCH_READ_TIMEOUT)
+        async with httpx.AsyncClient(timeout=timeout) as client:
+            async with client.stream("POST", f"{node}/reencrypt/batch",
+                                     json={"items": items, "user": user}) as resp:
+                if resp.status_code != 200:
+                    return f"Proxy error {resp.status_code}"
+                async for line in resp.aiter_lines():
+                    if not line:
+                        continue
+                    result = json.loads(line)
+                    local_idx = result["index"]
+                    if not 0 <= local_idx < len(indices) or indices[local_idx] in emitted:
+                        continue
+                    emitted.add(indices[local_idx])
+                    result["index"] = indices[local_idx]
+                    await queue.put(json.dumps(result) + "\n")
+        ok = True
+        return None
+    except httpx.RequestError as e:
+        return f"Proxy communication failed: {e!r}"
+    except Exception as e:
+        return f"Invalid proxy response: {e!r}"
+    finally:
+        lb.record(node, started, ok, record_latency=False)
+
+async def forward_batch_chunk(node: str, items: list, user: str, offset: int, queue: asyncio.Queue):
+    emitted = set()
+    tried = []
+    error = None
+    try:
+        # Re-encryption is idempotent, so items a failed node didn't answer
+        # are resent to another node
+        while node:
+            tried.append(node)
+            pending = [i for i in range(offset, offset + len(items)) if i not in emitted]
+            error = await stream_batch_chunk(node, [items[i - offset] for i in pending], pending,
+                                             user, emitted, queue)
+            if len(emitted) == len(items) or len(tried) > RETRIES:
+                break
+            node = lb.get_next_node(exclude=tried)
+    finally:
+        # Every item gets exactly one result line, even if nodes died mid-stream
+        if len(emitted) < len(items):
+            error = error or "Proxy returned no result"
+            for i in range(offset, offset + len(items)):
+                if i not in emitted:
+                    await queue.put(json.dumps({"index": i, "error": error}) + "\n")
+        await queue.put(None)
+
+@app.post("/reencrypt/batch")
+async def map_reencrypt_batch(req: ReEncryptBatchRequest):
+    n_chunks = max(1, min(len(lb.healthy_nodes), -(-len(req.items) // BATCH_MIN_CHUNK)))
+    items = [item.dict() for item in req.items]
+    chunk_size = -(-len(items) // n_chunks) if items else 1
+
+    chunks = []
+    for offset in range(0, len(items), chunk_size):
+        # Spread chunks over distinct nodes while there are enough available
+        node = lb.get_next_node(exclude=[c[0] for c in chunks]) or lb.get_next_node()
+        if not node:
+            raise HTTPException(status_code=503, detail="No healthy proxies available")
+        chunks.append((node, items[offset:offset + chunk_size], offset))
+
+    queue = asyncio.Queue()
+
+    async def merged():
+        # Interleave chunk results in arrival order
+        tasks = [asyncio.create_task(forward_batch_chunk(node, chunk, req.user, offset, queue))
+                 for node, chunk, offset in chunks]
+        remaining = len(tasks)
         try:
-            # Forward the request
-            resp = await client.post(f"{node}/reencrypt", json=req.dict())
-            if resp.status_code != 200:
-                raise HTTPException(status_code=resp.status_code, detail="Proxy error")
-            return resp.json()
-        except httpx.RequestError:
-             raise HTTPException(status_code=502, detail="Proxy communication failed")
+            while remaining:
+                line = await queue.get()
+                if line is None:
+                    remaining -= 1
+                    continue
+                yield line
+        finally:
+            for t in tasks:
+                t.cancel()
+
+    return StreamingResponse(merged(), media_type="application/x-ndjson")
 
 @app.post("/gen_rekey", response_model=ReKeyResponse)
-async def map_genrekey(req: ReKeyRequest):
-    node = await lb.get_next_node()
-    if not node:
-        raise HTTPException(status_code=503, detail="No healthy proxies available")
-    
-    async with httpx.AsyncClient() as client:
-        try:
-            resp = await client.post(f"{node}/gen_rekey", json=req.dict())
-            if resp.status_code != 200:
-                raise HTTPException(status_code=resp.status_code, detail="Proxy error")
-            return resp.json()
-        except httpx.RequestError:
-             raise HTTPException(status_code=502, detail="Proxy communication failed")
+async def map_genrekey(req: ReKeyRequest, request: Request):
+    # Creates a new rekey each call, so not safe to replay after it was sent.
+    # The proxy checks the caller's credentials itself.
+    headers = {h: request.headers[h] for h in (auth.TOKEN_HEADER, auth.USER_HEADER) if h in request.headers}
+    return await forward("/gen_rekey", req.dict(), idempotent=False, headers=headers)
+
+@app.post("/revoke_rekey")
+async def map_revoke_rekey(req: RevokeReKeyRequest):
+    # Any node will do: revocation invalidates the cache shared by all proxies
+    return await forward("/revoke_rekey", req.dict())
 
 if __name__ == "__main__":
-    import uvicorn
+    import argparse
+    
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--strategy", type=str, default=ROUTING_STRATEGY)
+    parser.add_argument("--nodes", type=str, default=",".join(PROXY_NODES),
+                        help="Comma-separated seed nodes; pass '' to rely on registration only")
+    serve.add_arguments(parser)
+    args = parser.parse_args()
+    os.environ["LB_STRATEGY"] = args.strategy
+    os.environ["LB_NODES"] = args.nodes
+    lb.set_strategy(args.strategy)
+    for node in lb.nodes:
+        lb.remove_node(node)
+    for node in filter(None, args.nodes.split(",")):
+        lb.add_node(node)
+        lb.heartbeats.pop(node, None) # Seeds don't heartbeat
+    
     # Load Balancer runs on 8002 (Taking over the original Proxy port? -> No, original used 8002)
     # The Plan said LB runs on separate port? Original demos used 8002 for Proxy.
     # To keep demos compatible, we should run LB on 8002, and move Proxies to 8003/8004.
-    print("Starting Load Balancer on port 8002")
-    uvicorn.run(app, host="0.0.0.0", port=8002)
+    print(f"Starting Load Balancer on port 8002 ({args.strategy} routing)")
+    serve.run(app, "services.load_balancer.main:app", 8002, args.workers)
@@ -0,0 +1,105 @@
+import itertools
+import random
+import time
+from collections import deque
+
+# Weight of the newest sample in the latency EWMA
+EWMA_ALPHA = 0.3
+# Latency charged for a failed request, so a node that fails fast doesn't
+# look like the fastest node
+FAILURE_PENALTY_MS = 1000.0
+# Recent successful latencies kept for the p95 reported to the autoscaler
+LATENCY_WINDOW = 200
+
+class NodeStats:
+    """
+    Per-node counters. The LB runs on a single event loop and these are only
+    touched between awaits, so plain attribute updates need no lock.
+    """
+    def __init__(self):
+        self.outstanding = 0
+        self.requests = 0
+        self.errors = 0
+        self.ewma_latency_ms = None
+        self.recent_latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def start(self) -> float:
+        self.outstanding += 1
+        self.requests += 1
+        return time.perf_counter()
+
+    def finish(self, started: float, ok: bool = True, record_latency: bool = True):
+        """
+        record_latency=False keeps long multi-item calls (batch chunks) out of
+        the per-request latency estimate.
+        """
+        self.outstanding -= 1
+        latency_ms = (time.perf_counter() - started) * 1000
+        if not ok:
+            self.errors += 1
+            latency_ms = max(latency_ms, FAILURE_PENALTY_MS)
+        elif not record_latency:
+            return
+        else:
+            self.recent_latencies.append(latency_ms)
+        if self.ewma_latency_ms is None:
+            self.ewma_latency_ms = latency_ms
+        else:
+            self.ewma_latency_ms += EWMA_ALPHA * (latency_ms - self.ewma_latency_ms)
+
+    def p95_latency_ms(self):
+        if not self.recent_latencies:
+            return None
+        ordered = sorted(self.recent_latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def to_dict(self) -> dict:
+        p95 = self.p95_latency_ms()
+        return {
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "errors": self.errors,
+            "ewma_latency_ms": round(self.ewma_latency_ms, 3) if self.ewma_latency_ms is not None else None,
+            "p95_latency_ms": round(p95, 3) if p95 is not None else None
+        }
+
+class RoundRobin:
+    def __init__(self):
+        self._counter = itertools.count()
+
+    def pick(self, nodes: list, stats: dict) -> str:
+        return nodes[next(self._counter) % len(nodes)]
+
+class LeastOutstanding:
+    def pick(self, nodes: list, stats: dict) -> str:
+        # Random tie-break so idle nodes share the load
+        return min(nodes, key=lambda n: (stats[n].outstanding, random.random()))
+
+class PowerOfTwoChoices:
+    def pick(self, nodes: list, stats: dict) -> str:
+        if len(nodes) == 1:
+            return nodes[0]
+        a, b = random.sample(nodes, 2)
+        return a if stats[a].outstanding <= stats[b].outstanding else b
+
+class EwmaLatency:
+    def pick(self, nodes: list, stats: dict) -> str:
+        # Expected wait = latency estimate x queue length. Nodes without
+        # samples yet score lowest so they get probed.
+        def cost(n):
+            s = stats[n]
+            latency = s.ewma_latency_ms if s.ewma_latency_ms is not None else 0.0
+            return (latency * (s.outstanding + 1), random.random())
+        return min(nodes, key=cost)
+
+STRATEGIES = {
+    "round_robin": RoundRobin,
+    "least_outstanding": LeastOutstanding,
+    "p2c": PowerOfTwoChoices,
+    "ewma": EwmaLatency
+}
+
+def get_strategy(name: str):
+    if name not in STRATEGIES:
+        raise ValueError(f"Unknown routing strategy: {name}. Choose from {list(STRATEGIES)}")
+    return STRATEGIES[name]()
@@ -0,0 +1,122 @@
+import subprocess
+import sys
+import os
+import time
+import requests
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
+
+from common import auth
+
+# Local autoscaler: starts/stops extra proxy processes based on what the LB sees.
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../'))
+PROXY_SCRIPT = os.path.join(PROJECT_ROOT, "services/proxy/main.py")
+
+LB_URL = "http://localhost:8002"
+BASE_PORT = 8010          # managed proxies get ports from here up
+MIN_NODES = 2
+MAX_NODES = 6
+POLL_INTERVAL = 2
+
+# Scale up if either threshold is crossed, down only when both are well below
+SCALE_UP_OUTSTANDING = 8.0     # avg in-flight requests per active node
+SCALE_UP_P95_MS = 500.0
+SCALE_DOWN_OUTSTANDING = 1.0
+SCALE_DOWN_P95_MS = 100.0
+COOLDOWN = 30             # seconds between scaling actions
+DRAIN_TIMEOUT = 30
+
+class Supervisor:
+    def __init__(self, lb_url: str = LB_URL, min_nodes: int = MIN_NODES, max_nodes: int = MAX_NODES):
+        self.lb_url = lb_url
+        self.min_nodes = min_nodes
+        self.max_nodes = max_nodes
+        self.procs = {}      # url -> Popen, only nodes we started
+        self.stopping = {}   # url -> (Popen, drain started at)
+        self.last_action = 0.0
+
+    def load(self):
+        """
+        Returns (active node count, avg outstanding, worst p95) from the LB.
+        """
+        nodes = requests.get(f"{self.lb_url}/health", timeout=2).json()["nodes"]
+        active = [n for n in nodes.values() if n["healthy"] and not n["draining"]]
+        if not active:
+            return 0, 0.0, None
+        outstanding = sum(n["outstanding"] for n in active) / len(active)
+        p95s = [n["p95_latency_ms"] for n in active if n["p95_latency_ms"] is not None]
+        return len(active), outstanding, max(p95s) if p95s else None
+
+    def scale_up(self):
+        used = set(self.procs) | set(self.stopping)
+        port = BASE_PORT
+        while f"http://localhost:{port}" in used:
+            port += 1
+        url = f"http://localhost:{port}"
+        print(f"[supervisor] Scaling up: starting proxy on {port}")
+        self.procs[url] = subprocess.Popen(
+            [sys.executable, PROXY_SCRIPT, "--port", str(port), "--id", f"auto_{port}", "--lb-url", self.lb_url],
+            cwd=PROJECT_ROOT)
+
+    def scale_down(self):
+        # Newest first; the LB drains it before we terminate the process
+        url = list(self.procs)[-1]
+        print(f"[supervisor] Scaling down: draining {url}")
+        proc = self.procs.pop(url)
+        try:
+            requests.post(f"{self.lb_url}/admin/nodes/deregister", json={"url": url, "drain": True},
+                          headers=auth.service_headers(), timeout=2)
+        except requests.exceptions.RequestException:
+            pass
+        self.stopping[url] = (proc, time.monotonic())
+
+    def reap(self):
+        try:
+            registered = set(requests.get(f"{self.lb_url}/admin/nodes", timeout=2).json()["nodes"])
+        except requests.exceptions.RequestException:
+            registered = set()
+        for url, (proc, since) in list(self.stopping.items()):
+            if url not in registered or time.monotonic() - since > DRAIN_TIMEOUT:
+                proc.terminate()
+                del self.stopping[url]
+
+    def step(self):
+        self.reap()
+        active, outstanding, p95 = self.load()
+        if time.monotonic() - self.last_action < COOLDOWN:
+            return
+        overloaded = outstanding > SCALE_UP_OUTSTANDING or (p95 is not None and p95 > SCALE_UP_P95_MS)
+        idle = outstanding < SCALE_DOWN_OUTSTANDING and (p95 is None or p95 < SCALE_DOWN_P95_MS)
+        if (overloaded or active < self.min_nodes) and active < self.max_nodes:
+            self.scale_up()
+            self.last_action = time.monotonic()
+        elif idle and active > self.min_nodes and self.procs:
+            self.scale_down()
+            self.last_action = time.monotonic()
+
+    def run(self):
+        print(f"[supervisor] Watching {self.lb_url} ({self.min_nodes}-{self.max_nodes} nodes)")
+        try:
+            while True:
+                try:
+                    self.step()
+                except requests.exceptions.RequestException:
+                    pass # LB not up yet
+                time.sleep(POLL_INTERVAL)
+        finally:
+            for proc in list(self.procs.values()) + [p for p, _ in self.stopping.values()]:
+                proc.terminate()
+
+if __name__ == "__main__":
+    import argparse
+    
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lb-url", type=str, default=LB_URL)
+    parser.add_argument("--min-nodes", type=int, default=MIN_NODES)
+    parser.add_argument("--max-nodes", type=int, default=MAX_NODES)
+    args = parser.parse_args()
+    
+    try:
+        Supervisor(args.lb_url, args.min_nodes, args.max_nodes).run()
+    except KeyboardInterrupt:
+        pass
@@ -4,26 +4,65 @@ from pydantic import BaseModel
 import pandas as pd
 import joblib
 from sklearn.ensemble import IsolationForest
+import sys
 import os
+import time
+
+# Add project root to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
+
+from common import tracing, metrics, profiler, deadline, serve
 
 app = FastAPI(title="ML Service")
+tracing.instrument_app(app, "ml")
+metrics.instrument_app(app, "ml")
+profiler.instrument_app(app, "ml")
+deadline.instrument_app(app)
+
+SCORE_LATENCY = metrics.histogram("ml_score_duration_seconds", "Model prediction time per scoring call")
+BATCH_SIZE = metrics.histogram("ml_batch_size", "Feature rows per scoring call", buckets=(1, 2, 5, 10, 25, 50, 100, 250, 1000))
+metrics.gauge("ml_model_loaded", "1 when a trained model is loaded", fn=lambda: int(model is not None))
 
 MODEL_PATH = "model.joblib"
 DATA_PATH = "data/activity_logs.csv"
 
+# Workers notice a model retrained by another worker within this many seconds
+MODEL_CHECK_INTERVAL = 1.0
+
 # Global model
 model = None
+model_mtime = None
+model_checked = 0.0
 
 def load_model():
-    global model
+    global model, model_mtime
     if os.path.exists(MODEL_PATH):
         try:
-            model = joblib.load(MODEL_PATH)
+            mtime = os.path.getmtime(MODEL_PATH)
+            # Arrays are memory-mapped from the file, so workers share their pages
+            model = joblib.load(MODEL_PATH, mmap_mode="r")
+            model_mtime = mtime
             print("Model loaded successfully.")
         except:
             print("Failed to load model.")
             model = None
 
+def refresh_model():
+    """
+    Reloads the model if another worker retrained it. Checks the file at most
+    once per MODEL_CHECK_INTERVAL.
+    """
+    global model_checked
+    now = time.monotonic()
+    if now - model_checked < MODEL_CHECK_INTERVAL:
+        return
+    model_checked = now
+    try:
+        if os.path.getmtime(MODEL_PATH) != model_mtime:
+            load_model()
+    except OSError:
+        pass
+
 @app.on_event("startup")
 def startup():
     load_model()
@@ -37,44 +76,53 @@ class TrainRequest(BaseModel):
 
 @app.post("/train")
 def train(req: TrainRequest):
-    global model
     if not os.path.exists(DATA_PATH):
         raise HTTPException(status_code=404, detail="Training data not found. Run generator script.")
     
     df = pd.read_csv(DATA_PATH)
-    features = df[['hour', 'download_mb', 'failed_logins', 'role_mismatch']]
+    features = df[FEATURES]
     
     clf = IsolationForest(contamination=req.contamination, random_state=42)
     clf.fit(features)
     
-    joblib.dump(clf, MODEL_PATH)
-    model = clf
+    # Written aside and renamed in, so other workers never load a partial file
+    joblib.dump(clf, MODEL_PATH + ".tmp")
+    os.replace(MODEL_PATH + ".tmp", MODEL_PATH)
+    load_model()
     
     return {"status": "trained", "n_samples": len(df)}
 
+FEATURES = ['hour', 'download_mb', 'failed_logins', 'role_mismatch']
+
+def build_features_frame(rows: list) -> pd.DataFrame:
+    # Ensure order matches training
+    return pd.DataFrame([{
+        'hour': f.get('hour', 12),
+        'download_mb': f.get('download_mb', 10),
+        'failed_logins': f.get('failed_logins', 0),
+        'role_mismatch': f.get('role_mismatch', 0)
+    } for f in rows], columns=FEATURES)
+
 class ScoreRequest(BaseModel):
     features: dict 
     # expected keys: hour, download_mb, failed_logins, role_mismatch
 
 @app.post("/score")
 def score(req: ScoreRequest):
-    if model is None:
+    refresh_model()
+    clf = model # One model for both calls, even if a reload swaps it meanwhile
+    if clf is None:
         raise HTTPException(status_code=503, detail="Model not trained yet.")
     
     # Extract features in correct order
     try:
-        f = req.features
-        # Ensure order matches training
-        X = pd.DataFrame([{
-            'hour': f.get('hour', 12),
-            'download_mb': f.get('download_mb', 10),
-            'failed_logins': f.get('failed_logins', 0),
-            'role_mismatch': f.get('role_mismatch', 0)
-        }])
+        X = build_features_frame([req.features])
         
         # Predict: 1 for inlier, -1 for outlier
-        pred = model.predict(X)[0]
-        score_val = model.decision_function(X)[0]
+        BATCH_SIZE.observe(len(X))
+        with tracing.span("model.predict"), SCORE_LATENCY.time():
+            pred = clf.predict(X)[0]
+            score_val = clf.decision_function(X)[0]
         
         is_anomaly = True if pred == -1 else False
         
@@ -86,6 +134,10 @@ def score(req: ScoreRequest):
         raise HTTPException(status_code=400, detail=str(e))
 
 if __name__ == "__main__":
-    import uvicorn
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    serve.add_arguments(parser)
+    args = parser.parse_args()
     print("Starting ML Service on port 8007")
-    uvicorn.run(app, host="0.0.0.0", port=8007)
+    serve.run(app, "services.ml.main:app", 8007, args.workers)
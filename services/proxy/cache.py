@@ -0,0 +1,98 @@
+import threading
+import time
+from collections import OrderedDict
+
+from common import metrics
+from common.store import LocalStore
+
+L1_MAX_ENTRIES = 4096
+L2_TTL_SECONDS = 300
+# Revoked rk_ids stay tombstoned in L2 for longer than any cached copy can live
+TOMBSTONE_TTL_SECONDS = 2 * L2_TTL_SECONDS
+# How often a node checks the shared revocation epoch. Bounds how long a
+# rekey revoked on another node can still be served from this node's LRU.
+EPOCH_CHECK_INTERVAL = 1.0
+
+class RekeyCache:
+    """
+    Two-level cache of rekey records.
+    L1: per-process LRU. L2: store shared by every proxy node behind the LB.
+    Revocations bump a shared epoch so other nodes drop their L1.
+    """
+    def __init__(self, max_entries: int = L1_MAX_ENTRIES, store: LocalStore = None):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._store = store or LocalStore("rekeys")
+        self._epoch = None
+        self._epoch_checked_at = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def _sync_epoch(self):
+        now = time.monotonic()
+        if now - self._epoch_checked_at < EPOCH_CHECK_INTERVAL:
+            return
+        self._epoch_checked_at = now
+        epoch = self._store.get("epoch") or 0
+        if epoch != self._epoch:
+            with self._lock:
+                self._entries.clear()
+            self._epoch = epoch
+
+    def get(self, rk_id: str, loader):
+        """
+        Returns the rekey record for rk_id, calling loader(rk_id) on a full miss.
+        """
+        self._sync_epoch()
+        with self._lock:
+            record = self._entries.get(rk_id)
+            if record is not None:
+                self._entries.move_to_end(rk_id)
+                self.hits += 1
+                return record
+
+        self.misses += 1
+        record = self._store.get(rk_id)
+        if record is None:
+            record = loader(rk_id)
+            if record is None:
+                return None
+            # add() loses to a tombstone written by a concurrent revoke, so a
+            # record read just before revocation can't be re-published to L2
+            if not self._store.add(rk_id, record, ttl=L2_TTL_SECONDS):
+                record = self._store.get(rk_id)
+        if record is None or record.get("revoked"):
+            return None
+        self._put(rk_id, record)
+        return record
+
+    def _put(self, rk_id: str, record: dict):
+        with self._lock:
+            self._entries[rk_id] = record
+            self._entries.move_to_end(rk_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *rk_ids: str):
+        if not rk_ids:
+            return
+        with self._lock:
+            for rk_id in rk_ids:
+                self._entries.pop(rk_id, None)
+        for rk_id in rk_ids:
+            self._store.set(rk_id, {"revoked": True}, ttl=TOMBSTONE_TTL_SECONDS)
+        self._epoch = self._store.incr("epoch")
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+rekeys = RekeyCache()
+
+metrics.counter("key_cache_requests_total", "Rekey cache lookups by result", ("result",),
+                fn=lambda: {("hit",): rekeys.hits, ("miss",): rekeys.misses})
+metrics.gauge("key_cache_entries", "Rekeys held in the in-process LRU", fn=lambda: len(rekeys._entries))
@@ -1,6 +1,8 @@
 import sqlite3
 import os
 
+from common.tracing import TracedConnection
+
 DB_PATH = "proxies.db"
 
 def init_db():
@@ -19,6 +21,6 @@ def init_db():
     conn.close()
 
 def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(DB_PATH, factory=TracedConnection)
     conn.row_factory = sqlite3.Row
     return conn
@@ -1,96 +1,150 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Depends
+from fastapi.responses import StreamingResponse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import Counter
+import contextvars
+import json
+import threading
 import sys
 import os
 
 # Add project root to sys.path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../../')))
 
-from common.schemas import ReKeyRequest, ReKeyResponse, ReEncryptRequest, ReEncryptResponse
-from services.proxy import reencryption
+from common.schemas import ReKeyRequest, ReKeyResponse, ReEncryptRequest, ReEncryptResponse, RevokeReKeyRequest, ReEncryptBatchRequest
+from services.proxy import reencryption, registration
+from common import tracing, metrics, profiler, deadline, serve, auth
+from common.hedging import Hedger
 
 app = FastAPI(title="Proxy Service")
+tracing.instrument_app(app, "proxy")
+metrics.instrument_app(app, "proxy")
+profiler.instrument_app(app, "proxy")
+deadline.instrument_app(app)
+
+# Scoring is an idempotent read, hedged across these replicas
+ML_REPLICAS = ["http://localhost:8007"]
+ml_scores = Hedger("ml.score", ML_REPLICAS)
+
+# Set from the command line (through the environment for worker processes);
+# when LB_URL is set the node registers itself
+LB_URL = os.environ.get("PROXY_LB_URL")
+NODE_URL = os.environ.get("PROXY_NODE_URL")
 
 @app.on_event("startup")
 def startup():
     from services.proxy import db
     db.init_db()
+    if LB_URL:
+        registration.start(LB_URL, NODE_URL)
+
+@app.on_event("shutdown")
+def shutdown():
+    if LB_URL:
+        registration.stop(LB_URL, NODE_URL)
 
 @app.get("/health")
 def health():
-    return {"status": "ok"}
+    from services.proxy.cache import rekeys
+    return {"status": "ok", "rekey_cache": rekeys.stats()}
 
 @app.post("/gen_rekey", response_model=ReKeyResponse)
-def gen_rekey(req: ReKeyRequest, background_tasks: BackgroundTasks):
+def gen_rekey(req: ReKeyRequest, background_tasks: BackgroundTasks, user: str = Depends(auth.caller)):
     from services.proxy import reencryption
-    result = reencryption.generate_rekey(req.from_user, req.to_user)
+    if user != req.from_user:
+        raise HTTPException(status_code=403, detail="Rekeys can only be made for the calling user")
+    try:
+        result = reencryption.generate_rekey(req.from_user, req.to_user)
+    except ValueError as e:
+        raise HTTPException(status_code=502, detail=str(e))
     
     background_tasks.add_task(reencryption.log_event, req.from_user, "GEN_REKEY", "na", 
                              {"to": req.to_user, "rk_id": result['rekey_id']})
     
     return result
 
+def screen_reencrypt(user: str) -> dict:
+    """
+    Runs the RBAC check and ML anomaly scoring for a re-encryption.
+    Raises HTTPException(403) if the user is not allowed.
+    """
+    # Phase 5: Access Control Check (RBAC)
+    # Verify if the proxy (acting on behalf of user) is allowed.
+    # In a real system, we'd check the destination user's permission.
+    # MVI: Check if "proxy" role is authorized to reencrypt.
+    import requests
+    try:
+        auth_resp = requests.post("http://localhost:8008/authorize", 
+                                json={"user": user, "action": "reencrypt"}, timeout=1)
+        if auth_resp.status_code == 200 and not auth_resp.json().get("allow"):
+             raise HTTPException(status_code=403, detail="Access Denied: Re-encryption not allowed")
+    except requests.exceptions.ConnectionError:
+        pass # Fail open if Access Service down for MVI/Demo, or Fail Closed? Fail open for robustness.
+
+    # Phase 4: ML Anomaly Check
+    # detailed Mock features for now. In real system, fetch from history.
+    import random
+    
+    # 10% chance of anomaly for demo purposes if not specified
+    hour = 23 if random.random() < 0.1 else 14 
+    download_size = 500 if hour == 23 else 5
+    
+    score_payload = {
+        "features": {
+            "hour": hour,
+            "download_mb": download_size,
+            "failed_logins": 0,
+            "role_mismatch": 0
+        }
+    }
+    
+    def fetch_score(base_url: str) -> dict:
+        resp = requests.post(f"{base_url}/score", json=score_payload, timeout=1)
+        # Only transport failures are worth a second attempt; a non-200 is the answer
+        return resp.json() if resp.status_code == 200 else None
+
+    result = {"is_anomaly": False, "score": None}
+    try:
+        scored = ml_scores.call(fetch_score)
+        if scored:
+            result["is_anomaly"] = scored.get("is_anomaly", False)
+            result["score"] = scored.get("score")
+            
+            # Phase 5: Auto-Revoke Integration
+            if result["is_anomaly"]:
+                # In real flow, revoke the DESTINATION user. 
+                # For MVI demo, we just log revocation call
+                try:
+                    requests.post("http://localhost:8008/revoke", json={"username": "alice@company.com"})
+                except:
+                    pass
+    except:
+        pass # Fail open if ML service down
+    
+    return result
+
+def reenc_log_details(rekey_id: str, screening: dict, count: int = None):
+    action = "PROXY_REENC"
+    details = {"rk_id": rekey_id}
+    if count is not None:
+        details["count"] = count
+    
+    if screening["is_anomaly"]:
+        action = "ANOMALY_DETECTED"
+        details["warning"] = "Suspicious activity detected by ML"
+        details["score"] = screening["score"]
+    return action, details
+
 @app.post("/reencrypt", response_model=ReEncryptResponse)
 def reencrypt_proxy(req: ReEncryptRequest, background_tasks: BackgroundTasks):
     from services.proxy import reencryption
     try:
-        # Phase 5: Access Control Check (RBAC)
-        # Verify if the proxy (acting on behalf of user) is allowed.
-        # In a real system, we'd check the destination user's permission.
-        # MVI: Check if "proxy" role is authorized to reencrypt.
-        import requests
-        try:
-            auth_resp = requests.post("http://localhost:8008/authorize", 
-                                    json={"user": "admin", "action": "reencrypt"}, timeout=1)
-            if auth_resp.status_code == 200 and not auth_resp.json().get("allow"):
-                 raise HTTPException(status_code=403, detail="Access Denied: Re-encryption not allowed")
-        except requests.exceptions.ConnectionError:
-            pass # Fail open if Access Service down for MVI/Demo, or Fail Closed? Fail open for robustness.
-
-        # Phase 4: ML Anomaly Check
-        # detailed Mock features for now. In real system, fetch from history.
-        import random
-        
-        # 10% chance of anomaly for demo purposes if not specified
-        hour = 23 if random.random() < 0.1 else 14 
-        download_size = 500 if hour == 23 else 5
-        
-        score_payload = {
-            "features": {
-                "hour": hour,
-                "download_mb": download_size,
-                "failed_logins": 0,
-                "role_mismatch": 0
-            }
-        }
-        
-        is_anomaly = False
-        try:
-            ml_resp = requests.post("http://localhost:8007/score", json=score_payload, timeout=1)
-            if ml_resp.status_code == 200:
-                is_anomaly = ml_resp.json().get("is_anomaly", False)
-                
-                # Phase 5: Auto-Revoke Integration
-                if is_anomaly:
-                    # In real flow, revoke the DESTINATION user. 
-                    # For MVI demo, we just log revocation call
-                    try:
-                        requests.post("http://localhost:8008/revoke", json={"username": "alice@company.com"})
-                    except:
-                        pass
-        except:
-            pass # Fail open if ML service down
+        screening = screen_reencrypt("admin")
             
         new_cipher = reencryption.reencrypt(req.cipher_blob, req.rekey_id)
         
         # Log event
-        action = "PROXY_REENC"
-        details = {"rk_id": req.rekey_id}
-        
-        if is_anomaly:
-            action = "ANOMALY_DETECTED"
-            details["warning"] = "Suspicious activity detected by ML"
-            details["score"] = ml_resp.json().get("score")
-            
+        action, details = reenc_log_details(req.rekey_id, screening)
         background_tasks.add_task(reencryption.log_event, "proxy", action, "unknown", details)
                                  
         return {"cipher_re": new_cipher}
@@ -101,14 +155,85 @@ def reencrypt_proxy(req: ReEncryptRequest, background_tasks: BackgroundTasks):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+BATCH_WORKERS = 8
+# Shared by every batch request, so concurrent batches queue for the same threads
+batch_pool = ThreadPoolExecutor(max_workers=BATCH_WORKERS, thread_name_prefix="reencrypt-batch")
+
+@app.post("/reencrypt/batch")
+def reencrypt_batch(req: ReEncryptBatchRequest, background_tasks: BackgroundTasks):
+    """
+    Re-encrypts many ciphertexts in one call.
+    Screening runs once per request (it only depends on the user); results
+    are streamed back as NDJSON lines ({"index", "cipher_re"} or
+    {"index", "error"}) in completion order.
+    """
+    screening, denied = None, None
+    try:
+        screening = screen_reencrypt(req.user)
+    except HTTPException as e:
+        denied = e.detail
+    except Exception as e:
+        denied = f"Screening failed: {e}"
+
+    succeeded = Counter()
+    succeeded_lock = threading.Lock()
+
+    def run(index: int, item: ReEncryptRequest) -> dict:
+        if denied is not None:
+            return {"index": index, "error": denied}
+        try:
+            result = {"index": index, "cipher_re": reencryption.reencrypt(item.cipher_blob, item.rekey_id)}
+        except Exception as e:
+            return {"index": index, "error": str(e)}
+        with succeeded_lock:
+            succeeded[item.rekey_id] += 1
+        return result
+
+    def stream():
+        # Each item runs in a copy of the request context so its spans join the trace
+        futures = [batch_pool.submit(contextvars.copy_context().run, run, i, item)
+                   for i, item in enumerate(req.items)]
+        try:
+            for future in as_completed(futures):
+                yield json.dumps(future.result()) + "\n"
+        finally:
+            # Client went away: don't leave its items queued ahead of other batches
+            for future in futures:
+                future.cancel()
+
+    def log_batch():
+        # Runs after the stream has been sent, so counts only cover successes
+        for rekey_id, count in succeeded.items():
+            action, details = reenc_log_details(rekey_id, screening, count)
+            reencryption.log_event("proxy", action, "unknown", details)
+
+    background_tasks.add_task(log_batch)
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@app.post("/revoke_rekey")
+def revoke_rekey(req: RevokeReKeyRequest, background_tasks: BackgroundTasks):
+    from services.proxy import reencryption
+    if not reencryption.revoke_rekey(req.rekey_id):
+        raise HTTPException(status_code=404, detail="Re-Key not found")
+        
+    background_tasks.add_task(reencryption.log_event, "proxy", "REVOKE_REKEY", "na", {"rk_id": req.rekey_id})
+    return {"status": "revoked", "rekey_id": req.rekey_id}
+
 if __name__ == "__main__":
-    import uvicorn
     import argparse
     
     parser = argparse.ArgumentParser()
     parser.add_argument("--port", type=int, default=8002)
     parser.add_argument("--id", type=str, default="proxy_1")
+    parser.add_argument("--lb-url", type=str, default=None,
+                        help="Register with this load balancer, e.g. http://localhost:8002")
+    serve.add_arguments(parser)
     args = parser.parse_args()
+    LB_URL = args.lb_url
+    NODE_URL = f"http://localhost:{args.port}"
+    if LB_URL:
+        os.environ["PROXY_LB_URL"] = LB_URL
+        os.environ["PROXY_NODE_URL"] = NODE_URL
     
     print(f"Starting Proxy Service {args.id} on port {args.port}")
-    uvicorn.run(app, host="0.0.0.0", port=args.port)
+    serve.run(app, "services.proxy.main:app", args.port, args.workers)
@@ -1,10 +1,31 @@
 import base64
+import binascii
+import os
+import threading
 import uuid
 import datetime
+from collections import OrderedDict
 import requests
+from common import metrics, tracing, auth
+from common import pre
+from common.kms_router import KMSRouter, parse_shards
 from services.proxy import db
+from services.proxy.cache import rekeys, L1_MAX_ENTRIES
 
 BLOCKCHAIN_URL = "http://localhost:8006"
+KMS_URL = "http://localhost:8005"
+# Users' PRE key pairs live in the KMS, sharded by user id like key ids
+# (same KMS_SHARDS layout as the encryption service)
+kms = KMSRouter(parse_shards(os.environ.get("KMS_SHARDS", "")) or [[KMS_URL]])
+
+# Parsed rekeys (pre.Rekey), so a rekey's scalar is decoded and recoded
+# once per process rather than on every re-encryption. Only consulted after
+# the rekey cache has said the rekey is live, so revocation still applies.
+_prepared = OrderedDict() # rk_id -> (blob, pre.Rekey)
+_prepared_lock = threading.Lock()
+
+REENCRYPTIONS = metrics.counter("proxy_reencryptions_total",
+                                "Ciphertexts re-encrypted, by scheme (passthrough: not a PRE ciphertext)", ("scheme",))
 
 def log_event(user: str, action: str, file_id: str, details: dict):
     try:
@@ -17,12 +38,31 @@ def log_event(user: str, action: str, file_id: str, details: dict):
     except:
         pass 
 
+def _fetch_rekey(base_url: str, from_user: str, to_user: str) -> str:
+    resp = requests.post(f"{base_url}/pre/rekey", json={"from_user": from_user, "to_user": to_user},
+                         headers=auth.service_headers(from_user), timeout=2)
+    resp.raise_for_status()
+    return resp.json()["rk_b64"]
+
+def create_rekey_in_kms(from_user: str, to_user: str) -> bytes:
+    """
+    A PRE rekey from from_user to to_user, made by from_user's KMS shard
+    (which looks up to_user's public key itself, creating key pairs on
+    first use).
+    """
+    try:
+        return base64.b64decode(kms.read(from_user, lambda base_url: _fetch_rekey(base_url, from_user, to_user)))
+    except Exception as e:
+        raise ValueError(f"Failed to create rekey in KMS: {e}")
+
 def generate_rekey(from_user: str, to_user: str) -> dict:
     """
-    Generates a mock re-encryption key and stores it in SQLite.
+    Generates a re-encryption key and stores it in SQLite. Only its public
+    half (the precursor) is returned; the rekey itself stays with the proxy.
     """
     rk_id = f"rk_{uuid.uuid4().hex[:8]}"
-    blob = base64.b64encode(f"mock_rk_blob_from_{from_user}_to_{to_user}".encode()).decode()
+    rk = create_rekey_in_kms(from_user, to_user)
+    blob = base64.b64encode(rk).decode()
     
     conn = db.get_db_connection()
     c = conn.cursor()
@@ -33,24 +73,64 @@ def generate_rekey(from_user: str, to_user: str) -> dict:
     
     return {
         "rekey_id": rk_id,
-        "rk_blob": blob
+        "rk_blob": base64.b64encode(rk[pre.SCALAR_SIZE:]).decode()
     }
 
+def _load_rekey(rk_id: str):
+    conn = db.get_db_connection()
+    row = conn.execute("SELECT rk_id, from_user, to_user, blob FROM rekeys WHERE rk_id = ?", (rk_id,)).fetchone()
+    conn.close()
+    return dict(row) if row else None
+
+def get_rekey(rk_id: str) -> dict:
+    return rekeys.get(rk_id, _load_rekey)
+
+def prepared_rekey(rk_id: str, blob: str) -> pre.Rekey:
+    with _prepared_lock:
+        entry = _prepared.get(rk_id)
+        if entry and entry[0] == blob:
+            _prepared.move_to_end(rk_id)
+            return entry[1]
+    try:
+        rekey = pre.Rekey(base64.b64decode(blob))
+    except (ValueError, binascii.Error):
+        raise ValueError("Re-Key predates proxy re-encryption; generate a new one")
+    with _prepared_lock:
+        _prepared[rk_id] = (blob, rekey)
+        while len(_prepared) > L1_MAX_ENTRIES:
+            _prepared.popitem(last=False)
+    return rekey
+
 def reencrypt(cipher_blob: str, rekey_id: str) -> str:
     """
-    Simulates re-encryption using state from SQLite.
+    Re-encrypts a PRE ciphertext (base64, as from /wrap_key/pre) for the
+    rekey's recipient. Anything else is passed through unchanged, as
+    before PRE.
     """
-    conn = db.get_db_connection()
-    row = conn.execute("SELECT * FROM rekeys WHERE rk_id = ?", (rekey_id,)).fetchone()
-    conn.close()
-    
-    if not row:
+    record = get_rekey(rekey_id)
+    if not record:
         raise ValueError("Invalid Re-Key ID")
-        
-    # Check validity (mock)
+
     try:
-        raw = base64.b64decode(cipher_blob).decode()
-    except:
-        pass
-        
-    return cipher_blob
+        blob = base64.b64decode(cipher_blob, validate=True)
+    except binascii.Error:
+        blob = None
+    if blob is None or not pre.is_pre(blob):
+        REENCRYPTIONS.labels("passthrough").inc()
+        return cipher_blob
+
+    rekey = prepared_rekey(rekey_id, record["blob"])
+    with tracing.span("pre.reencrypt"):
+        transformed = rekey.reencrypt(blob)
+    REENCRYPTIONS.labels("pre").inc()
+    return base64.b64encode(transformed).decode()
+
+def revoke_rekey(rk_id: str) -> bool:
+    conn = db.get_db_connection()
+    deleted = conn.execute("DELETE FROM rekeys WHERE rk_id = ?", (rk_id,)).rowcount
+    conn.commit()
+    conn.close()
+    rekeys.invalidate(rk_id)
+    with _prepared_lock:
+        _prepared.pop(rk_id, None)
+    return deleted > 0
@@ -0,0 +1,52 @@
+import threading
+import requests
+
+from common import auth
+
+HEARTBEAT_INTERVAL = 5
+
+_stop = threading.Event()
+_thread = None
+
+def _register(lb_url: str, node_url: str) -> bool:
+    try:
+        resp = requests.post(f"{lb_url}/admin/nodes/register", json={"url": node_url},
+                             headers=auth.service_headers(), timeout=2)
+        return resp.status_code == 200
+    except requests.exceptions.RequestException:
+        return False
+
+def _heartbeat_loop(lb_url: str, node_url: str):
+    registered = _register(lb_url, node_url)
+    while not _stop.wait(HEARTBEAT_INTERVAL):
+        if not registered:
+            registered = _register(lb_url, node_url)
+            continue
+        try:
+            resp = requests.post(f"{lb_url}/admin/nodes/heartbeat", json={"url": node_url},
+                                 headers=auth.service_headers(), timeout=2)
+            # 404: the LB restarted or dropped us, join again
+            if resp.status_code == 404:
+                registered = _register(lb_url, node_url)
+        except requests.exceptions.RequestException:
+            pass # LB down; keep trying
+
+def start(lb_url: str, node_url: str):
+    """
+    Registers this proxy with the load balancer and keeps it alive with heartbeats.
+    """
+    global _thread
+    _stop.clear()
+    _thread = threading.Thread(target=_heartbeat_loop, args=(lb_url, node_url), daemon=True)
+    _thread.start()
+
+def stop(lb_url: str, node_url: str):
+    """
+    Stops heartbeating and asks the LB to drain this node.
+    """
+    _stop.set()
+    try:
+        requests.post(f"{lb_url}/admin/nodes/deregister", json={"url": node_url, "drain": True},
+                      headers=auth.service_headers(), timeout=2)
+    except requests.exceptions.RequestException:
+        pass # The LB will drop us once heartbeats stop
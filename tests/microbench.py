@@ -0,0 +1,293 @@
+import base64
+import datetime
+import gc
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+# Add project root to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from Crypto.Random import get_random_bytes
+
+from services.encryption import crypto
+from services.blockchain.ledger import Blockchain
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "..", "metrics", "microbench")
+SCHEMA_VERSION = 1
+
+MIN_TIME = 0.2          # seconds per timed repeat (iterations are calibrated to fill it)
+REPEATS = 5
+PAYLOAD_SWEEP = [64, 1024, 64 * 1024, 1024 * 1024]
+CHAIN_SWEEP = [10, 100, 1000]
+BATCH_SWEEP = [1, 10, 100]
+
+# --- Local stand-ins ---
+
+class LocalKMS:
+    """
+    In-process replacement for the KMS HTTP calls made by crypto.py,
+    so the benchmark measures AES-GCM and encoding, not the network.
+    """
+    def __init__(self):
+        self.keys = {}
+
+    def create_key(self) -> str:
+        key_id = f"k_{base64.urlsafe_b64encode(get_random_bytes(6)).decode().strip('=')}"
+        self.keys[key_id] = get_random_bytes(32)
+        return key_id
+
+    def get_key(self, key_id: str) -> bytes:
+        return self.keys[key_id]
+
+    def install(self):
+        crypto.create_key_in_kms = self.create_key
+        crypto.get_key_from_kms = self.get_key
+
+def make_chain(length: int) -> Blockchain:
+    # The in-process ledger is its own stand-in: no network, mines on add
+    chain = Blockchain()
+    for i in range(length - 1):
+        chain.add_transaction({"user": "bench", "action": "ENC_FILE", "file_id": f"f{i}",
+                               "details": {"key_id": "k_bench", "cid": f"c_{i}"}})
+    return chain
+
+# --- Measurement ---
+
+def time_per_op(fn, min_time: float = None, repeats: int = REPEATS) -> dict:
+    """
+    Calibrates an iteration count that fills min_time, then reports the best
+    and median ns/op over `repeats` timed runs.
+    """
+    min_time = min_time or MIN_TIME
+    fn()  # warm up
+    iterations = 1
+    while True:
+        start = time.perf_counter_ns()
+        for _ in range(iterations):
+            fn()
+        elapsed = time.perf_counter_ns() - start
+        if elapsed >= min_time * 1e9 or iterations >= 1 << 20:
+            break
+        iterations *= 2 if elapsed == 0 else max(2, min(10, int(min_time * 1e9 / elapsed) + 1))
+
+    samples = []
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeats):
+            start = time.perf_counter_ns()
+            for _ in range(iterations):
+                fn()
+            samples.append((time.perf_counter_ns() - start) / iterations)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return {"iterations": iterations, "ns_per_op": min(samples), "ns_per_op_median": statistics.median(samples)}
+
+def allocations_per_op(fn, ops: int = 20) -> dict:
+    """
+    Memory cost per op from tracemalloc (a separate pass, since tracing slows
+    everything down): peak bytes allocated while the op runs on top of what
+    was live before it, and bytes still retained after it returns.
+    """
+    fn()
+    tracemalloc.start()
+    try:
+        peaks = []
+        start_current, _ = tracemalloc.get_traced_memory()
+        for _ in range(ops):
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+            fn()
+            _, peak = tracemalloc.get_traced_memory()
+            peaks.append(peak - before)
+        end_current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "peak_alloc_bytes_per_op": statistics.median(peaks),
+        "retained_bytes_per_op": max(0, end_current - start_current) / ops
+    }
+
+def bench(name: str, param: str, value, fn, bytes_per_op: int = None) -> dict:
+    result = {"bench": name, param: value}
+    result.update(time_per_op(fn))
+    result.update(allocations_per_op(fn))
+    result["ops_per_s"] = 1e9 / result["ns_per_op"] if result["ns_per_op"] else 0.0
+    if bytes_per_op:
+        result["mb_per_s"] = bytes_per_op * result["ops_per_s"] / 1e6
+    line = (f"  {name:<25} {param}={value:<9} {result['ns_per_op']:>14,.0f} ns/op "
+            f"{result['ops_per_s']:>12,.1f} ops/s  {result['peak_alloc_bytes_per_op']:>12,.0f} B/op peak "
+            f"{result['retained_bytes_per_op']:>8,.0f} B/op retained")
+    if bytes_per_op:
+        line += f"  {result['mb_per_s']:>9,.1f} MB/s"
+    print(line)
+    return result
+
+# --- Benchmarks ---
+
+def bench_crypto(kms: LocalKMS) -> list:
+    results = []
+    for size in PAYLOAD_SWEEP:
+        data = os.urandom(size)
+        key_id = kms.create_key()
+        results.append(bench("crypto.encrypt_data", "payload_bytes", size,
+                             lambda: crypto.encrypt_data(data, key_id), size))
+        payload = crypto.encrypt_data(data, key_id)
+        results.append(bench("crypto.decrypt_data", "payload_bytes", size,
+                             lambda: crypto.decrypt_data(payload, key_id), size))
+    return results
+
+def bench_blob(kms: LocalKMS) -> list:
+    from services.encryption.main import pack_cipher_blob, unpack_cipher_blob
+
+    results = []
+    for size in PAYLOAD_SWEEP:
+        result = crypto.encrypt_data(os.urandom(size), kms.create_key())
+        blob = pack_cipher_blob(result)
+        results.append(bench("pack_cipher_blob", "payload_bytes", size, lambda: pack_cipher_blob(result), size))
+        results.append(bench("unpack_cipher_blob", "payload_bytes", size, lambda: unpack_cipher_blob(blob), size))
+    return results
+
+def bench_ledger() -> list:
+    results = []
+    block = make_chain(2).last_block
+    results.append(bench("Block.compute_hash", "tx_per_block", len(block.transactions), block.compute_hash))
+    for length in CHAIN_SWEEP:
+        chain = make_chain(length)
+        results.append(bench("Blockchain.validate_chain", "chain_length", length, chain.validate_chain))
+    return results
+
+def bench_ml() -> list:
+    from services.ml.main import build_features_frame
+
+    results = []
+    row = {"hour": 14, "download_mb": 10, "failed_logins": 0, "role_mismatch": 0}
+    for batch in BATCH_SWEEP:
+        rows = [row] * batch
+        results.append(bench("ml.build_features_frame", "batch_size", batch, lambda: build_features_frame(rows)))
+    return results
+
+def bench_pre(kms: LocalKMS) -> list:
+    """
+    Proxy re-encryption against the mock it replaced (which passed every
+    blob through): the same entry point, with the rekey lookup served from
+    a dict. "cold" parses the rekey on every call, as with no per-rekey cache.
+    """
+    from services.encryption.main import pack_cipher_blob
+    from common import pre
+    from services.proxy import reencryption
+
+    alice, alice_pub = pre.generate_keypair()
+    bob, bob_pub = pre.generate_keypair()
+    records = {"rk_bench": {"rk_id": "rk_bench", "blob": base64.b64encode(pre.make_rekey(alice, bob_pub)).decode()}}
+    reencryption.get_rekey = records.get
+    wrapped = base64.b64encode(pre.encrypt(alice_pub, get_random_bytes(32))).decode()
+    legacy = pack_cipher_blob(crypto.encrypt_data(os.urandom(1024), kms.create_key()))
+    transformed = base64.b64decode(reencryption.reencrypt(wrapped, "rk_bench"))
+
+    def cold():
+        reencryption._prepared.clear()
+        reencryption.reencrypt(wrapped, "rk_bench")
+
+    return [
+        bench("proxy.reencrypt", "mode", "mock", lambda: reencryption.reencrypt(legacy, "rk_bench")),
+        bench("proxy.reencrypt", "mode", "cached", lambda: reencryption.reencrypt(wrapped, "rk_bench")),
+        bench("proxy.reencrypt", "mode", "cold", cold),
+        bench("pre.encrypt", "mode", "wrap_key", lambda: pre.encrypt(alice_pub, b"k" * 32)),
+        bench("pre.decrypt", "mode", "recipient", lambda: pre.decrypt(bob, transformed)),
+    ]
+
+def max_stall_ms(fn, calls: int = 3) -> float:
+    """
+    Longest a thread waking every 1 ms went without running while fn ran:
+    about the call's length if fn holds the GIL, a few ms if it releases it.
+    """
+    import threading
+
+    stop, gaps = threading.Event(), []
+
+    def tick():
+        last = time.perf_counter()
+        while not stop.is_set():
+            time.sleep(0.001)
+            now = time.perf_counter()
+            gaps.append(now - last)
+            last = now
+
+    ticker = threading.Thread(target=tick)
+    ticker.start()
+    try:
+        time.sleep(0.01)
+        for _ in range(calls):
+            fn()
+    finally:
+        stop.set()
+        ticker.join()
+    return max(gaps) * 1000
+
+def bench_offload(kms: LocalKMS) -> list:
+    """
+    Large AES-GCM inline against the offload pool, and how long each keeps
+    other threads off the GIL.
+    """
+    from common import offload
+
+    key, size = get_random_bytes(32), 16 * 1024 * 1024
+    data = os.urandom(size)
+    table = bytes(range(256))[::-1]
+    results = []
+    for mode, threshold in (("inline", 0), ("pool", 1024 * 1024)):
+        offload.OFFLOAD_THRESHOLD = threshold
+        fn = lambda: offload.aes_gcm_encrypt(key, data)
+        result = bench("offload.aes_gcm_encrypt", "mode", mode, fn, size)
+        result["max_stall_ms"] = max_stall_ms(fn)
+        results.append(result)
+    # Reference: a C call of similar length that keeps the GIL
+    results.append({"bench": "bytes.translate", "mode": "holds_gil", "max_stall_ms": max_stall_ms(lambda: data.translate(table))})
+    for result in results:
+        print(f"  {result['bench']:<25} mode={result['mode']:<9} longest stall of another thread {result['max_stall_ms']:>8,.1f} ms")
+    return results
+
+BENCHES = {
+    "crypto": lambda kms: bench_crypto(kms),
+    "blob": lambda kms: bench_blob(kms),
+    "ledger": lambda kms: bench_ledger(),
+    "ml": lambda kms: bench_ml(),
+    "pre": lambda kms: bench_pre(kms),
+    "offload": lambda kms: bench_offload(kms)
+}
+
+def main(argv=None):
+    global MIN_TIME
+    import argparse
+
+    parser = argparse.ArgumentParser(description="In-process microbenchmarks for the service hot paths")
+    parser.add_argument("--benches", default=",".join(BENCHES), help=f"Comma-separated subset of {list(BENCHES)}")
+    parser.add_argument("--min-time", type=float, default=MIN_TIME)
+    parser.add_argument("--save", action="store_true", help=f"Write results under {RESULTS_DIR}")
+    args = parser.parse_args(argv)
+    MIN_TIME = args.min_time
+
+    kms = LocalKMS()
+    kms.install()
+    results = []
+    for name in args.benches.split(","):
+        print(f"{name}:")
+        results.extend(BENCHES[name](kms))
+
+    if args.save:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"{now.strftime('%Y%m%dT%H%M%SZ')}.json")
+        with open(path, "w") as f:
+            json.dump({"schema_version": SCHEMA_VERSION, "started_at": now.isoformat(), "results": results}, f, indent=2)
+        print(f"\nSaved to {os.path.abspath(path)}")
+    return results
+
+if __name__ == "__main__":
+    main()
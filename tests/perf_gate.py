@@ -0,0 +1,189 @@
+import json
+import math
+import os
+import shutil
+import sys
+
+# Add project root to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from common.histogram import Histogram
+
+METRICS_DIR = os.path.join(os.path.dirname(__file__), "..", "metrics")
+RUNS_DIR = os.path.join(METRICS_DIR, "runs")
+BASELINE_PATH = os.path.join(METRICS_DIR, "baseline.json")
+
+# Allowed regression per hot path, in percent, relative to the baseline.
+# A p99 regression also has to be statistically significant (see ALPHA).
+BUDGETS = {
+    "encrypt":   {"p99_pct": 10.0, "throughput_pct": 10.0},
+    "decrypt":   {"p99_pct": 10.0, "throughput_pct": 10.0},
+    "reencrypt": {"p99_pct": 15.0, "throughput_pct": 10.0},
+    "score":     {"p99_pct": 10.0, "throughput_pct": 10.0},
+    "tx":        {"p99_pct": 20.0, "throughput_pct": 15.0}
+}
+DEFAULT_BUDGET = {"p99_pct": 10.0, "throughput_pct": 10.0}
+ALPHA = 0.01            # significance level for the latency shift test
+MIN_SAMPLES = 20        # steps with fewer samples on either side are not judged
+
+def load_run(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+def latest_run() -> str:
+    runs = sorted(f for f in os.listdir(RUNS_DIR) if f.endswith(".json"))
+    if not runs:
+        raise FileNotFoundError(f"No runs in {RUNS_DIR}")
+    return os.path.join(RUNS_DIR, runs[-1])
+
+def step_key(step: dict) -> tuple:
+    load = step.get("concurrency", step.get("rate_rps"))
+    return (step["scenario"], step["mode"], load, step["payload_bytes"])
+
+def mann_whitney_greater(base: Histogram, cand: Histogram) -> float:
+    """
+    One-sided Mann-Whitney U test computed straight from histogram buckets.
+    Returns the p-value for "candidate latencies are stochastically larger".
+    Uses the normal approximation with tie correction (buckets are ties).
+    """
+    n1, n2 = base.total, cand.total
+    if not n1 or not n2:
+        return 1.0
+    b, c = dict(base.values()), dict(cand.values())
+    rank = 0
+    rank_sum_cand = 0.0
+    tie_term = 0
+    for value in sorted(set(b) | set(c)):
+        t = b.get(value, 0) + c.get(value, 0)
+        avg_rank = rank + (t + 1) / 2
+        rank_sum_cand += c.get(value, 0) * avg_rank
+        tie_term += t ** 3 - t
+        rank += t
+    n = n1 + n2
+    u = rank_sum_cand - n2 * (n2 + 1) / 2
+    mean = n1 * n2 / 2
+    var = n1 * n2 / 12 * ((n + 1) - tie_term / (n * (n - 1)))
+    if var <= 0:
+        return 1.0
+    z = (u - mean - 0.5) / math.sqrt(var)  # continuity correction
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+def pct_change(old: float, new: float) -> float:
+    if not old:
+        return 0.0
+    return (new - old) / old * 100
+
+def compare(baseline: dict, candidate: dict, budgets: dict) -> list:
+    """
+    Returns one finding per step present in both runs.
+    """
+    base_steps = {step_key(s): s for s in baseline["results"]}
+    findings = []
+    for step in candidate["results"]:
+        key = step_key(step)
+        base = base_steps.get(key)
+        if not base:
+            continue
+        budget = budgets.get(step["scenario"], DEFAULT_BUDGET)
+        base_h = Histogram.from_dict(base["histogram"])
+        cand_h = Histogram.from_dict(step["histogram"])
+
+        p99_delta = pct_change(base["latency_ms"]["p99"], step["latency_ms"]["p99"])
+        tput_delta = pct_change(base["throughput_rps"], step["throughput_rps"])
+        p_value = mann_whitney_greater(base_h, cand_h)
+        enough = base_h.total >= MIN_SAMPLES and cand_h.total >= MIN_SAMPLES
+
+        reasons = []
+        if enough and p99_delta > budget["p99_pct"] and p_value < ALPHA:
+            reasons.append(f"p99 +{p99_delta:.1f}% (budget {budget['p99_pct']}%, p={p_value:.2g})")
+        # Throughput is one number per step, so it is judged against the budget alone
+        if enough and -tput_delta > budget["throughput_pct"]:
+            reasons.append(f"throughput {tput_delta:.1f}% (budget -{budget['throughput_pct']}%)")
+        findings.append({
+            "key": key,
+            "p99_base_ms": base["latency_ms"]["p99"],
+            "p99_ms": step["latency_ms"]["p99"],
+            "p99_delta_pct": p99_delta,
+            "throughput_delta_pct": tput_delta,
+            "p_value": p_value,
+            "judged": enough,
+            "regressions": reasons
+        })
+    return findings
+
+def load_budgets(path: str = None, threshold: float = None) -> dict:
+    budgets = {name: dict(b) for name, b in BUDGETS.items()}
+    if path:
+        with open(path) as f:
+            for name, b in json.load(f).items():
+                budgets.setdefault(name, dict(DEFAULT_BUDGET)).update(b)
+    if threshold is not None:
+        for b in budgets.values():
+            b["p99_pct"] = b["throughput_pct"] = threshold
+    return budgets
+
+def print_report(baseline: dict, candidate: dict, findings: list):
+    print(f"Baseline:  {baseline['run_id']} @ {(baseline.get('git') or {}).get('commit')}")
+    print(f"Candidate: {candidate['run_id']} @ {(candidate.get('git') or {}).get('commit')}")
+    base_fp = baseline.get("environment", {}).get("fingerprint")
+    cand_fp = candidate.get("environment", {}).get("fingerprint")
+    if base_fp != cand_fp:
+        print(f"WARNING: environment fingerprints differ ({base_fp} vs {cand_fp}); results may not be comparable")
+    print()
+    for f in findings:
+        scenario, mode, load, payload = f["key"]
+        status = "REGRESSED" if f["regressions"] else ("ok" if f["judged"] else "skipped")
+        print(f"  {scenario:<10} {mode:<6} load={load:<5} payload={payload or '-':<8} "
+              f"p99 {f['p99_base_ms']:.2f}->{f['p99_ms']:.2f}ms ({f['p99_delta_pct']:+.1f}%) "
+              f"tput {f['throughput_delta_pct']:+.1f}%  {status}")
+        for reason in f["regressions"]:
+            print(f"      - {reason}")
+
+def main(argv=None) -> int:
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark runs, baselines and the performance regression gate")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    run_p = sub.add_parser("run", help="Run the load generator and gate the result against the baseline")
+    run_p.add_argument("bench_args", nargs=argparse.REMAINDER, help="Passed through to performance_test.py")
+
+    base_p = sub.add_parser("baseline", help="Store a run as the baseline")
+    base_p.add_argument("run", nargs="?", help="Run file (default: latest)")
+
+    cmp_p = sub.add_parser("compare", help="Compare a run against the baseline")
+    cmp_p.add_argument("run", nargs="?", help="Run file (default: latest)")
+    cmp_p.add_argument("--baseline", default=BASELINE_PATH)
+
+    for p in (run_p, cmp_p):
+        p.add_argument("--threshold", type=float, default=None, help="Override every budget, in percent")
+        p.add_argument("--budgets", default=None, help="JSON file of per-scenario budget overrides")
+    args = parser.parse_args(argv)
+
+    if args.command == "baseline":
+        src = args.run or latest_run()
+        shutil.copyfile(src, BASELINE_PATH)
+        print(f"Baseline set to {src}")
+        return 0
+
+    if args.command == "run":
+        import performance_test
+        candidate = performance_test.main([a for a in args.bench_args if a != "--"])
+        if candidate is None:
+            return 2
+        if not os.path.exists(BASELINE_PATH):
+            print("No baseline yet; store one with: python tests/perf_gate.py baseline")
+            return 0
+        baseline = load_run(BASELINE_PATH)
+    else:
+        candidate = load_run(args.run or latest_run())
+        baseline = load_run(args.baseline)
+
+    findings = compare(baseline, candidate, load_budgets(args.budgets, args.threshold))
+    print_report(baseline, candidate, findings)
+    regressed = [f for f in findings if f["regressions"]]
+    print(f"\n{len(regressed)} regression(s) in {len(findings)} comparable step(s)")
+    return 1 if regressed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
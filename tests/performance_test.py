@@ -1,120 +1,292 @@
-import time
-import requests
-import json
+import asyncio
 import base64
-import statistics
+import datetime
+import hashlib
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+import httpx
+
+# Add project root to sys.path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from common import auth
+from common.histogram import Histogram
 
 # Configuration
-ITERATIONS = 20
 ENC_URL = "http://localhost:8001"
 PROXY_URL = "http://localhost:8002"
 ML_URL = "http://localhost:8007"
 CHAIN_URL = "http://localhost:8006"
 
-def measure_encryption():
-    latencies = []
-    payload = {
-        "plaintext": base64.b64encode(b"Performance Test Data Payload " * 10).decode(), # ~300 bytes
-        "meta": {"owner": "perf_test"}
-    }
-    
-    for i in range(ITERATIONS):
-        start = time.time()
-        requests.post(f"{ENC_URL}/encrypt", json=payload, timeout=10)
-        latencies.append((time.time() - start) * 1000)
-        print(".", end="", flush=True)
-    print(" Done!")
-    return latencies
-
-def measure_reencryption():
-    # Setup: Create initial ciphertext and rekey
-    try:
-        pt_payload = {"plaintext": base64.b64encode(b"Re-Enc Test").decode(), "meta": {"owner": "alice"}}
-        enc_res = requests.post(f"{ENC_URL}/encrypt", json=pt_payload, timeout=10).json()
-        cipher_blob = enc_res['cipher']
-        
-        rekey_res = requests.post(f"{PROXY_URL}/gen_rekey", json={"from_user": "alice", "to_user": "bob"}, timeout=10).json()
-        rekey_id = rekey_res['rekey_id']
-    except Exception as e:
-        print(f"\nSetup failed: {e}")
-        return []
-    
-    latencies = []
-    reenc_payload = {"cipher_blob": cipher_blob, "rekey_id": rekey_id}
-    
-    print("Re-Encrypting", end="", flush=True)
-    for i in range(ITERATIONS):
-        start = time.time()
-        requests.post(f"{PROXY_URL}/reencrypt", json=reenc_payload, timeout=10)
-        latencies.append((time.time() - start) * 1000)
-        print(".", end="", flush=True)
-    print(" Done!")
-        
-    return latencies
-
-def measure_ml_score():
-    features = {"features": {"hour": 14, "download_mb": 10, "failed_logins": 0, "role_mismatch": 0}}
-    latencies = []
-    print("Scoring ML", end="", flush=True)
-    for i in range(ITERATIONS):
-        start = time.time()
-        requests.post(f"{ML_URL}/score", json=features, timeout=10)
-        latencies.append((time.time() - start) * 1000)
-        print(".", end="", flush=True)
-    print(" Done!")
-    return latencies
-
-def warmup():
-    print("Warming up services...", end="", flush=True)
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "..", "metrics", "runs")
+SCHEMA_VERSION = 1
+
+DURATION = 10.0                 # seconds per scenario step
+CONCURRENCY_SWEEP = [1, 8, 32]  # closed-loop workers
+RATE_SWEEP = [50, 200]          # open-loop arrivals per second
+PAYLOAD_SWEEP = [300, 64 * 1024, 1024 * 1024]  # encrypt plaintext bytes
+MAX_INFLIGHT = 1000             # open-loop cap; arrivals beyond it count as dropped
+REQUEST_TIMEOUT = 30.0
+
+# --- Scenarios ---
+# Each scenario has an async setup(client, payload_bytes) -> ctx and
+# an async call(client, ctx) that raises on failure.
+
+def random_plaintext(size: int) -> str:
+    return base64.b64encode(os.urandom(size)).decode()
+
+async def post_ok(client: httpx.AsyncClient, url: str, payload: dict, headers: dict = None) -> dict:
+    resp = await client.post(url, json=payload, headers=headers)
+    resp.raise_for_status()
+    return resp.json()
+
+async def setup_encrypt(client, payload_bytes):
+    return {"plaintext": random_plaintext(payload_bytes), "meta": {"owner": "perf_test"}}
+
+async def call_encrypt(client, ctx):
+    await post_ok(client, f"{ENC_URL}/encrypt", ctx)
+
+async def setup_decrypt(client, payload_bytes):
+    enc = await post_ok(client, f"{ENC_URL}/encrypt", await setup_encrypt(client, payload_bytes))
+    return {"cipher": enc["cipher"], "key_id": enc["key_id"]}
+
+async def call_decrypt(client, ctx):
+    await post_ok(client, f"{ENC_URL}/decrypt", ctx)
+
+async def setup_reencrypt(client, payload_bytes):
+    enc = await post_ok(client, f"{ENC_URL}/encrypt", await setup_encrypt(client, 64))
+    rekey = await post_ok(client, f"{PROXY_URL}/gen_rekey", {"from_user": "alice", "to_user": "bob"},
+                          headers=auth.service_headers("alice"))
+    # The proxy transforms the file's data key wrapped for alice, never the file itself
+    wrapped = await post_ok(client, f"{ENC_URL}/wrap_key/pre", {"key_id": enc["key_id"], "user_id": "alice"})
+    return {"cipher_blob": wrapped["wrapped"], "rekey_id": rekey["rekey_id"]}
+
+async def call_reencrypt(client, ctx):
+    await post_ok(client, f"{PROXY_URL}/reencrypt", ctx)
+
+async def setup_score(client, payload_bytes):
+    return {"features": {"hour": 14, "download_mb": 10, "failed_logins": 0, "role_mismatch": 0}}
+
+async def call_score(client, ctx):
+    await post_ok(client, f"{ML_URL}/score", ctx)
+
+async def setup_tx(client, payload_bytes):
+    return {"user": "perf_test", "action": "PERF", "file_id": "na", "details": {}}
+
+async def call_tx(client, ctx):
+    await post_ok(client, f"{CHAIN_URL}/tx", ctx)
+
+SCENARIOS = {
+    "encrypt": (setup_encrypt, call_encrypt),
+    "decrypt": (setup_decrypt, call_decrypt),
+    "reencrypt": (setup_reencrypt, call_reencrypt),
+    "score": (setup_score, call_score),
+    "tx": (setup_tx, call_tx)
+}
+# Only these scenarios vary with payload size
+PAYLOAD_SCENARIOS = {"encrypt", "decrypt"}
+
+# --- Load generation ---
+
+class StepResult:
+    def __init__(self):
+        self.histogram = Histogram()
+        self.errors = 0
+        self.dropped = 0
+
+    def observe(self, latency_s: float, ok: bool):
+        if ok:
+            self.histogram.record(latency_s * 1_000_000)
+        else:
+            self.errors += 1
+
+async def timed_call(call, client, ctx, result: StepResult, intended_start: float = None):
+    # Open loop measures from the scheduled send time, so queueing delay in the
+    # generator is charged to the system (no coordinated omission)
+    start = intended_start if intended_start is not None else time.perf_counter()
     try:
-        requests.get(f"{ENC_URL}/health", timeout=5)
-        requests.get(f"{PROXY_URL}/health", timeout=5)
-        requests.get(f"{ML_URL}/health", timeout=5)
-        print(" Done!")
-    except Exception as e:
-        print(f"\nWarmup failed: {e}")
-
-def run_benchmarks():
-    warmup()
-    print(f"Running benchmarks ({ITERATIONS} iterations)...")
-    
+        await call(client, ctx)
+        ok = True
+    except Exception:
+        ok = False
+    result.observe(time.perf_counter() - start, ok)
+
+async def run_closed_loop(call, client, ctx, concurrency: int, duration: float) -> StepResult:
+    """
+    `concurrency` workers, each sending its next request as soon as the previous one returns.
+    """
+    result = StepResult()
+    deadline = time.perf_counter() + duration
+
+    async def worker():
+        while time.perf_counter() < deadline:
+            await timed_call(call, client, ctx, result)
+
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return result
+
+async def run_open_loop(call, client, ctx, rate: float, duration: float, poisson: bool = True) -> StepResult:
+    """
+    Requests arrive at `rate`/s regardless of how fast the system answers.
+    """
+    result = StepResult()
+    inflight = set()
+    start = time.perf_counter()
+    next_at = start
+    while next_at < start + duration:
+        delay = next_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if len(inflight) >= MAX_INFLIGHT:
+            result.dropped += 1
+        else:
+            task = asyncio.create_task(timed_call(call, client, ctx, result, intended_start=next_at))
+            inflight.add(task)
+            task.add_done_callback(inflight.discard)
+        next_at += random.expovariate(rate) if poisson else 1.0 / rate
+    if inflight:
+        await asyncio.gather(*inflight)
+    return result
+
+def summarize(name: str, mode: str, load: float, payload_bytes, result: StepResult, elapsed: float) -> dict:
+    h = result.histogram
+    return {
+        "scenario": name,
+        "mode": mode,
+        "concurrency" if mode == "closed" else "rate_rps": load,
+        "payload_bytes": payload_bytes,
+        "requests": h.total + result.errors,
+        "errors": result.errors,
+        "dropped": result.dropped,
+        "duration_s": round(elapsed, 3),
+        "throughput_rps": round(h.total / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": h.summary_ms(),
+        "histogram": h.to_dict()
+    }
+
+async def run_scenario(client, name: str, modes: list, duration: float) -> list:
+    setup, call = SCENARIOS[name]
+    payloads = PAYLOAD_SWEEP if name in PAYLOAD_SCENARIOS else [None]
+    steps = []
+    for payload_bytes in payloads:
+        try:
+            ctx = await setup(client, payload_bytes or 0)
+        except Exception as e:
+            print(f"  {name}: setup failed ({e}), skipping")
+            break
+        # Warm connections and caches before measuring
+        await run_closed_loop(call, client, ctx, 1, min(1.0, duration))
+        for mode in modes:
+            for load in (CONCURRENCY_SWEEP if mode == "closed" else RATE_SWEEP):
+                started = time.perf_counter()
+                if mode == "closed":
+                    result = await run_closed_loop(call, client, ctx, load, duration)
+                else:
+                    result = await run_open_loop(call, client, ctx, load, duration)
+                step = summarize(name, mode, load, payload_bytes, result, time.perf_counter() - started)
+                lat = step["latency_ms"]
+                print(f"  {name:<10} {mode:<6} load={load:<5} payload={payload_bytes or '-':<8} "
+                      f"{step['throughput_rps']:>8.1f} req/s  p50={lat['p50']:.2f}ms "
+                      f"p99={lat['p99']:.2f}ms p999={lat['p999']:.2f}ms errors={step['errors']}")
+                steps.append(step)
+    return steps
+
+def git_commit() -> dict:
+    root = os.path.join(os.path.dirname(__file__), "..")
     try:
-        # Check health first
-        requests.get(f"{ENC_URL}/health", timeout=5)
-    except:
-        print("Error: Services not running? Cannot connect.")
-        return
-
-    enc_times = measure_encryption()
-    reenc_times = measure_reencryption()
-    ml_times = measure_ml_score()
-    
-    metrics = {
-        "encryption_ms": {
-            "avg": statistics.mean(enc_times),
-            "p95": statistics.quantiles(enc_times, n=20)[-1] if len(enc_times) >= 20 else max(enc_times),
-            "min": min(enc_times),
-            "max": max(enc_times)
-        },
-        "reencryption_ms": {
-            "avg": statistics.mean(reenc_times),
-            "p95": statistics.quantiles(reenc_times, n=20)[-1] if len(reenc_times) >= 20 else max(reenc_times),
-            "note": "Includes ML Anomaly Check overhead"
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=root, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=root,
+                                    capture_output=True, text=True).stdout.strip())
+        return {"commit": commit, "dirty": dirty}
+    except (OSError, subprocess.CalledProcessError):
+        return {"commit": None, "dirty": None}
+
+def environment() -> dict:
+    env = {
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count()
+    }
+    from importlib import metadata
+    env["packages"] = {}
+    for pkg in ("fastapi", "uvicorn", "httpx", "pycryptodome", "scikit-learn", "pandas", "numpy"):
+        try:
+            env["packages"][pkg] = metadata.version(pkg)
+        except metadata.PackageNotFoundError:
+            env["packages"][pkg] = None
+    # Runs are only strictly comparable when this matches
+    env["fingerprint"] = hashlib.sha256(json.dumps(env, sort_keys=True).encode()).hexdigest()[:16]
+    return env
+
+def save_run(run: dict) -> str:
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{run['run_id']}.json")
+    with open(path, "w") as f:
+        json.dump(run, f, indent=2)
+    return os.path.abspath(path)
+
+async def run_benchmarks(scenarios: list, modes: list, duration: float) -> dict:
+    max_conn = max(CONCURRENCY_SWEEP + [MAX_INFLIGHT])
+    limits = httpx.Limits(max_connections=max_conn, max_keepalive_connections=max(CONCURRENCY_SWEEP))
+    started_at = datetime.datetime.now(datetime.timezone.utc)
+    run = {
+        "schema_version": SCHEMA_VERSION,
+        "run_id": started_at.strftime("%Y%m%dT%H%M%SZ"),
+        "started_at": started_at.isoformat(),
+        "config": {
+            "scenarios": scenarios, "modes": modes, "duration_s": duration,
+            "concurrency_sweep": CONCURRENCY_SWEEP, "rate_sweep": RATE_SWEEP,
+            "payload_sweep": PAYLOAD_SWEEP
         },
-        "ml_scoring_ms": {
-            "avg": statistics.mean(ml_times),
-            "max": max(ml_times)
-        }
+        "git": git_commit(),
+        "environment": environment(),
+        "results": []
     }
-    
-    print("\n=== Performance Metrics ===")
-    print(json.dumps(metrics, indent=2))
-    
-    import os
-    os.makedirs("metrics", exist_ok=True)
-    with open("metrics/metrics.json", "w") as f:
-        json.dump(metrics, f, indent=2)
-    print("\nSaved to metrics/metrics.json")
+    async with httpx.AsyncClient(limits=limits, timeout=REQUEST_TIMEOUT) as client:
+        try:
+            await client.get(f"{ENC_URL}/health", timeout=5)
+        except httpx.RequestError:
+            print("Error: Services not running? Cannot connect.")
+            return None
+        for name in scenarios:
+            print(f"Scenario: {name}")
+            run["results"].extend(await run_scenario(client, name, modes, duration))
+    return run
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Concurrent load generator for the service hot paths")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"Comma-separated subset of {list(SCENARIOS)}")
+    parser.add_argument("--modes", default="closed,open", help="closed, open or both")
+    parser.add_argument("--duration", type=float, default=DURATION)
+    parser.add_argument("--concurrency", default=None, help="Override closed-loop sweep, e.g. 1,16,64")
+    parser.add_argument("--rates", default=None, help="Override open-loop sweep in req/s, e.g. 100,500")
+    parser.add_argument("--payloads", default=None, help="Override payload sweep in bytes")
+    args = parser.parse_args(argv)
+
+    global CONCURRENCY_SWEEP, RATE_SWEEP, PAYLOAD_SWEEP
+    if args.concurrency:
+        CONCURRENCY_SWEEP = [int(x) for x in args.concurrency.split(",")]
+    if args.rates:
+        RATE_SWEEP = [float(x) for x in args.rates.split(",")]
+    if args.payloads:
+        PAYLOAD_SWEEP = [int(x) for x in args.payloads.split(",")]
+
+    run = asyncio.run(run_benchmarks(args.scenarios.split(","), args.modes.split(","), args.duration))
+    if run:
+        print(f"\nSaved to {save_run(run)}")
+    return run
 
 if __name__ == "__main__":
-    run_benchmarks()
+    main()
@@ -0,0 +1,73 @@
+import sys
+import os
+import base64
+import json
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import pytest
+from fastapi.testclient import TestClient
+
+from services.encryption import crypto, db as enc_db, main as enc_main, packstore
+from services.kms import db as kms_db, keks, main as kms_main
+
+@pytest.fixture
+def kms(tmp_path, monkeypatch):
+    monkeypatch.setattr(kms_db, "DB_PATH", str(tmp_path / "keys.db"))
+    monkeypatch.setattr(keks, "_keks", {})
+    monkeypatch.setattr(keks, "start", lambda: None)
+    with TestClient(kms_main.app) as client:
+        yield client
+
+def test_get_keys_resolves_a_set_in_batches(kms, monkeypatch):
+    monkeypatch.setattr(kms_main, "LOOKUP_BATCH", 2)
+    key_ids = [kms.post("/generate_key", json={}).json()["key_id"] for _ in range(5)]
+    single = {key_id: kms.post("/get_key", json={"key_id": key_id}).json()["key_bytes_b64"] for key_id in key_ids}
+
+    resp = kms.post("/get_keys", json={"key_ids": key_ids + ["k_missing", key_ids[0]]}).json()
+    assert resp["keys"] == single and resp["missing"] == ["k_missing"]
+
+    resp = kms.post("/get_keys/stream", json={"key_ids": ["k_missing"] + key_ids})
+    lines = [json.loads(line) for line in resp.text.splitlines()]
+    assert lines[0] == {"key_id": "k_missing", "missing": True}
+    assert {line["key_id"]: line["key_bytes_b64"] for line in lines[1:]} == single
+
+    monkeypatch.setattr(kms_main, "MAX_KEYS", 3)
+    assert kms.post("/get_keys", json={"key_ids": key_ids}).status_code == 413
+
+def test_batch_decrypt_fetches_keys_once(kms, tmp_path, monkeypatch):
+    monkeypatch.setattr(enc_db, "DB_PATH", str(tmp_path / "encryption.db"))
+    monkeypatch.setattr(packstore, "store", packstore.PackStore(str(tmp_path / "objects")))
+    monkeypatch.setattr(crypto, "log_event", lambda *args: None)
+    monkeypatch.setattr(crypto, "create_key_in_kms", lambda: kms.post("/generate_key", json={}).json()["key_id"])
+    single, batched = [], []
+
+    def fetch_key(base_url, key_id):
+        single.append(key_id)
+        return kms.post("/get_key", json={"key_id": key_id}).json()["key_bytes_b64"]
+
+    def fetch_keys(base_url, key_ids):
+        batched.append(key_ids)
+        body = kms.post("/get_keys", json={"key_ids": key_ids}).json()
+        return {**body["keys"], **dict.fromkeys(body["missing"])}
+
+    monkeypatch.setattr(crypto, "_fetch_key", fetch_key)
+    monkeypatch.setattr(crypto, "_fetch_keys", fetch_keys)
+
+    with TestClient(enc_main.app) as enc:
+        files = [os.urandom(1000 + i) for i in range(6)]
+        items = []
+        for i, data in enumerate(files):
+            body = enc.post("/encrypt", json={"plaintext": base64.b64encode(data).decode(), "store": i % 2 == 0}).json()
+            items.append({"cipher_id": body["cipher_id"]} if i % 2 == 0 else {"cipher": body["cipher"]})
+            items[-1]["key_id"] = body["key_id"]
+        items.append({**items[1], "key_id": "k_missing"})
+
+        single.clear()
+        resp = enc.post("/decrypt/batch", json={"items": items})
+        results = resp.json()["results"]
+
+    assert [base64.b64decode(r["plaintext"]) for r in results[:-1]] == files
+    assert results[-1]["plaintext"] is None and results[-1]["error"]
+    # One KMS round trip for the whole batch
+    assert len(batched) == 1 and len(batched[0]) == 7 and single == []
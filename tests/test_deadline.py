@@ -0,0 +1,90 @@
+import sys
+import os
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import httpx
+import pytest
+from fastapi import FastAPI, BackgroundTasks
+from fastapi.testclient import TestClient
+
+from common import deadline, hedging
+
+def test_outgoing_calls_carry_and_respect_the_budget():
+    deadline.instrument_http_clients()
+    seen = []
+    client = httpx.Client(transport=httpx.MockTransport(lambda r: seen.append(r) or httpx.Response(200)),
+                          timeout=30)
+
+    token = deadline.set_budget(2.0)
+    try:
+        client.get("http://kms/get_key")
+    finally:
+        deadline.reset(token)
+
+    assert 1500 < int(seen[0].headers[deadline.HEADER]) <= 2000
+    assert seen[0].extensions["timeout"]["read"] <= 2.0
+
+def test_expired_budget_fails_before_sending():
+    deadline.instrument_http_clients()
+    client = httpx.Client(transport=httpx.MockTransport(lambda r: httpx.Response(200)))
+    token = deadline.set_budget(0.0)
+    try:
+        with pytest.raises(httpx.TimeoutException):
+            client.get("http://kms/get_key")
+    finally:
+        deadline.reset(token)
+
+def test_middleware_rejects_spent_budget_and_frees_background_tasks():
+    app = FastAPI()
+    deadline.instrument_app(app, default_budget=5.0)
+    background_budget = []
+
+    @app.get("/work")
+    def work(background_tasks: BackgroundTasks):
+        background_tasks.add_task(lambda: background_budget.append(deadline.remaining()))
+        return {"remaining": deadline.remaining()}
+
+    client = TestClient(app)
+    assert client.get("/work", headers={deadline.HEADER: "0"}).status_code == 504
+    assert 0 < client.get("/work", headers={deadline.HEADER: "800"}).json()["remaining"] <= 0.8
+    assert 4 < client.get("/work").json()["remaining"] <= 5.0
+    # Audit logging after the response isn't cut off by the request budget
+    assert background_budget == [None, None]
+
+def test_hedge_goes_to_next_replica_when_first_is_slow(monkeypatch):
+    monkeypatch.setattr(hedging, "DEFAULT_HEDGE_DELAY", 0.02)
+    hedger = hedging.Hedger("test", ["slow", "fast"])
+
+    def call(replica):
+        if replica == "slow":
+            time.sleep(0.5)
+        return replica
+
+    started = time.perf_counter()
+    assert hedger.call(call) == "fast"
+    assert time.perf_counter() - started < 0.3
+
+def test_failed_attempt_falls_back_to_backup():
+    hedger = hedging.Hedger("test_fail", ["down", "up"])
+
+    def call(replica):
+        if replica == "down":
+            raise ConnectionError("refused")
+        return replica
+
+    assert hedger.call(call) == "up"
+
+def test_single_replica_is_never_hedged(monkeypatch):
+    monkeypatch.setattr(hedging, "DEFAULT_HEDGE_DELAY", 0.01)
+    hedger = hedging.Hedger("test_single", ["only"])
+    calls = []
+
+    def call(replica):
+        calls.append(replica)
+        time.sleep(0.05)
+        return replica
+
+    assert hedger.call(call) == "only"
+    assert calls == ["only"] and hedger._sent.value() == 0
@@ -0,0 +1,87 @@
+import sys
+import os
+import base64
+import random
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import pytest
+from fastapi.testclient import TestClient
+
+from services.encryption import crypto, db, dedup, main, packstore
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "encryption.db"))
+    monkeypatch.setattr(packstore, "store", packstore.PackStore(str(tmp_path / "objects")))
+    monkeypatch.setattr(dedup, "_tenant_keys", {})
+    kms = {}
+
+    def create_key():
+        key_id = f"k_{len(kms)}"
+        kms[key_id] = os.urandom(32)
+        return key_id
+
+    monkeypatch.setattr(crypto, "create_key_in_kms", create_key)
+    monkeypatch.setattr(crypto, "get_key_from_kms", lambda key_id: kms[key_id])
+    monkeypatch.setattr(crypto, "log_event", lambda *args: None)
+    with TestClient(main.app) as client:
+        yield client, kms
+
+def upload(client, data: bytes, tenant: str):
+    resp = client.post("/encrypt", json={"plaintext": base64.b64encode(data).decode()},
+                       headers={"x-tenant-id": tenant, "x-tenant-dedup": "1"})
+    assert resp.status_code == 200
+    return resp.json()
+
+def stored_bytes(tenant: str) -> int:
+    conn = db.get_db_connection()
+    total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM chunks WHERE tenant_id = ?", (tenant,)).fetchone()[0]
+    conn.close()
+    return total
+
+def test_cut_points_follow_content_not_offsets():
+    keys = dedup.TenantKeys("k", b"s" * 32)
+    data = random.Random(1).randbytes(512 * 1024)
+    ends = dedup.chunk_boundaries(data, keys.gear)
+    sizes = [b - a for a, b in zip([0] + ends, ends)]
+    assert ends[-1] == len(data)
+    assert all(dedup.MIN_CHUNK <= s <= dedup.MAX_CHUNK for s in sizes[:-1])
+
+    # An insert at the front only changes the first chunk(s)
+    shifted = dedup.chunk_boundaries(b"x" * 100 + data, keys.gear)
+    assert len(set(e - 100 for e in shifted) & set(ends)) >= len(ends) - 2
+
+    # Another tenant's secret cuts elsewhere
+    assert dedup.chunk_boundaries(data, dedup.TenantKeys("k2", b"t" * 32).gear) != ends
+
+def test_repeated_uploads_store_chunks_once(client):
+    client, kms = client
+    document = random.Random(2).randbytes(300 * 1024)
+    first = upload(client, document, "t_a")
+    edited = document[:100000] + b"an edit" + document[100000:]
+    second = upload(client, edited, "t_a")
+
+    assert first["key_id"] == second["key_id"] and len(kms) == 1 # One key per tenant, not per upload
+    assert stored_bytes("t_a") < len(document) + 80 * 1024
+    for resp, data in ((first, document), (second, edited)):
+        dec = client.post("/decrypt", json={"cipher": resp["cipher"], "key_id": resp["key_id"]})
+        assert base64.b64decode(dec.json()["plaintext"]) == data
+
+def test_tenants_do_not_share_chunks(client):
+    client, kms = client
+    document = random.Random(3).randbytes(64 * 1024)
+    a, b = upload(client, document, "t_a"), upload(client, document, "t_b")
+    assert a["key_id"] != b["key_id"]
+    assert stored_bytes("t_a") == stored_bytes("t_b") == len(document)
+
+    # The other tenant's key can't open the manifest
+    dec = client.post("/decrypt", json={"cipher": a["cipher"], "key_id": b["key_id"]})
+    assert dec.status_code == 400
+
+def test_uploads_without_opt_in_are_unchanged(client):
+    client, kms = client
+    resp = client.post("/encrypt", json={"plaintext": base64.b64encode(b"hello").decode()},
+                       headers={"x-tenant-id": "t_a"})
+    assert main.unpack_cipher_blob(resp.json()["cipher"])["prefix"] is None
+    assert stored_bytes("t_a") == 0
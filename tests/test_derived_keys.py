@@ -0,0 +1,74 @@
+import sys
+import os
+import base64
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import pytest
+from fastapi.testclient import TestClient
+
+from services.encryption import crypto, db as enc_db, main as enc_main, packstore
+from services.kms import db as kms_db, main as kms_main
+
+@pytest.fixture
+def kms(tmp_path, monkeypatch):
+    monkeypatch.setattr(kms_db, "DB_PATH", str(tmp_path / "keys.db"))
+    monkeypatch.setattr(crypto, "DERIVE_FILE_KEYS", True)
+    monkeypatch.setattr(crypto, "_master_keys", {})
+    monkeypatch.setattr(crypto, "_latest_versions", {})
+    monkeypatch.setattr(crypto, "create_key_in_kms", lambda: pytest.fail("no per-file KMS keys"))
+    with TestClient(kms_main.app) as client:
+        calls = []
+
+        def fetch(base_url, tenant_id, version=None):
+            calls.append((tenant_id, version))
+            resp = client.post("/master_key", json={"tenant_id": tenant_id, "version": version})
+            resp.raise_for_status()
+            return resp.json()
+
+        monkeypatch.setattr(crypto, "_fetch_master_key", fetch)
+        yield client, calls
+
+def test_master_key_versions(kms):
+    client, _ = kms
+    first = client.post("/master_key", json={"tenant_id": "t_1"}).json()
+    assert first["version"] == 1
+    assert client.post("/master_key", json={"tenant_id": "t_1"}).json() == first
+    assert client.post("/master_key", json={"tenant_id": "t_1", "version": 1}).json() == first
+    assert client.post("/master_key", json={"tenant_id": "t_1", "version": 2}).status_code == 404
+    assert client.post("/master_key", json={"tenant_id": "t_2"}).json()["key_bytes_b64"] != first["key_bytes_b64"]
+
+def test_file_keys_are_derived_locally(kms):
+    _, calls = kms
+    key_id = crypto.create_file_key("t_a.b")
+    tenant_id, version, file_id = crypto.parse_derived_key_id(key_id)
+    assert (tenant_id, version) == ("t_a.b", 1)
+
+    key = crypto.get_key_from_kms(key_id)
+    assert len(key) == 32 and crypto.get_key_from_kms(key_id) == key
+    assert crypto.get_key_from_kms(crypto.create_file_key("t_a.b")) != key
+    # One KMS round trip for the tenant; everything after is cached
+    assert calls == [("t_a.b", None)]
+    assert crypto.parse_derived_key_id("k_abc") is None
+
+def test_encrypt_with_derived_keys(kms, tmp_path, monkeypatch):
+    client, _ = kms
+    monkeypatch.setattr(enc_db, "DB_PATH", str(tmp_path / "encryption.db"))
+    monkeypatch.setattr(packstore, "store", packstore.PackStore(str(tmp_path / "objects")))
+    monkeypatch.setattr(crypto, "log_event", lambda *args: None)
+    data = os.urandom(200 * 1024)
+    with TestClient(enc_main.app) as enc:
+        for body in ({}, {"store": True}, {"segmented": True}):
+            resp = enc.post("/encrypt", json={"plaintext": base64.b64encode(data).decode(), **body},
+                            headers={"x-tenant-id": "t_1"})
+            result = resp.json()
+            assert result["key_id"].startswith("dk.1.")
+            source = {"cipher_id": result["cipher_id"]} if body.get("store") else {"cipher": result["cipher"]}
+            resp = enc.post("/decrypt", json={**source, "key_id": result["key_id"]})
+            assert base64.b64decode(resp.json()["plaintext"]) == data
+
+    # The KMS holds the tenant's master key and nothing per file
+    conn = kms_db.get_db_connection()
+    assert conn.execute("SELECT COUNT(*) FROM master_keys").fetchone()[0] == 1
+    assert conn.execute("SELECT COUNT(*) FROM keys").fetchone()[0] == 0
+    conn.close()
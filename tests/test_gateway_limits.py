@@ -0,0 +1,80 @@
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+from common import auth
+from services.gateway import db, limits, main
+
+@pytest.fixture
+def gateway(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "gateway.db"))
+    monkeypatch.setattr(limits, "PLAN_LIMITS", {
+        "starter": {"rate": 0.001, "burst": 3, "bytes_per_day": 1000},
+        "enterprise": {"rate": 1000.0, "burst": 1000, "bytes_per_day": None}
+    })
+    monkeypatch.setattr(main, "limiter", limits.TenantLimiter())
+    upstream_calls = []
+
+    class Upstream(httpx.AsyncBaseTransport):
+        # Unlike MockTransport, leaves the response body unread so the gateway can stream it
+        async def handle_async_request(self, request):
+            await request.aread()
+            upstream_calls.append(request)
+            return httpx.Response(200, headers={"content-type": "application/json"},
+                                  stream=httpx.ByteStream(b'{"ok": true}'))
+
+    with TestClient(main.app) as client:
+        main.upstream = httpx.AsyncClient(transport=Upstream())
+        tenant = db.create_tenant("Noisy", "starter")
+        yield client, tenant, upstream_calls
+
+def test_rate_limit_rejects_before_upstream(gateway):
+    client, tenant, upstream_calls = gateway
+    headers = {"X-API-Key": tenant["api_key"]}
+    statuses = [client.post("/files/encrypt", json={"plaintext": "aGk="}, headers=headers).status_code
+                for _ in range(5)]
+
+    assert statuses == [200, 200, 200, 429, 429]
+    assert len(upstream_calls) == 3
+    assert upstream_calls[0].headers["x-tenant-plan"] == "starter"
+
+    usage = client.get("/admin/usage", params={"tenant_id": tenant["id"]}).json()["usage"][tenant["id"]]
+    assert usage["requests"] == 3 and usage["rejected"] == 2
+    assert usage["bytes_out"] > 0
+
+def test_key_calls_act_for_the_tenant(gateway):
+    client, tenant, upstream_calls = gateway
+    headers = {"X-API-Key": tenant["api_key"]}
+    client.post("/files/share", json={"from_user": tenant["id"], "to_user": "bob"}, headers=headers)
+    client.post("/files/unwrap", json={"user_id": tenant["id"], "wrapped": "w"}, headers=headers)
+    client.post("/files/encrypt", json={"plaintext": "aGk="}, headers=headers)
+
+    share, unwrap, encrypt = upstream_calls
+    assert unwrap.url.path == "/unwrap_key/pre"
+    for call in (share, unwrap):
+        assert call.headers[auth.TOKEN_HEADER] == auth.service_token()
+        assert call.headers[auth.USER_HEADER] == tenant["id"]
+    # Services that don't act for a user never see the token
+    assert auth.TOKEN_HEADER not in encrypt.headers
+
+def test_byte_quota_rejects_oversized_body(gateway):
+    client, tenant, upstream_calls = gateway
+    resp = client.post("/files/encrypt", content=b"x" * 2000,
+                       headers={"X-API-Key": tenant["api_key"], "content-type": "application/json"})
+    assert resp.status_code == 429
+    assert resp.json()["detail"] == "Daily byte quota exceeded"
+    assert upstream_calls == []
+
+def test_usage_survives_restart(gateway):
+    client, tenant, _ = gateway
+    client.post("/files/encrypt", json={"plaintext": "aGk="}, headers={"X-API-Key": tenant["api_key"]})
+    db.save_usage(main.limiter.dirty_rows())
+
+    restarted = limits.TenantLimiter()
+    restarted.load()
+    assert restarted.snapshot(tenant["id"])[tenant["id"]]["requests"] == 1
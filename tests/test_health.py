@@ -0,0 +1,93 @@
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import pytest
+
+from services.load_balancer import health, main, routing
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(health.time, "monotonic", lambda: now[0])
+    return now
+
+def test_consecutive_failures_open_the_circuit(clock):
+    breaker = health.CircuitBreaker()
+    for _ in range(health.FAILURE_THRESHOLD - 1):
+        breaker.on_failure()
+    assert breaker.state == health.CLOSED and breaker.available()
+    breaker.on_failure()
+    assert breaker.state == health.OPEN and not breaker.available()
+    assert breaker.reason == f"{health.FAILURE_THRESHOLD} consecutive failures"
+
+def test_error_rate_opens_the_circuit(clock):
+    breaker = health.CircuitBreaker()
+    for i in range(health.ERROR_WINDOW - 1):
+        breaker.on_success() if i % 2 else breaker.on_failure()
+    assert breaker.state == health.CLOSED
+    breaker.on_failure()
+    assert breaker.state == health.OPEN and breaker.reason.startswith("error rate")
+
+def test_half_open_lets_a_single_probe_through(clock):
+    breaker = health.CircuitBreaker()
+    breaker.trip("test")
+    clock[0] += health.OPEN_SECONDS - 0.1
+    assert not breaker.available()
+    clock[0] += 0.1
+    assert breaker.available()
+
+    breaker.acquire()
+    assert breaker.state == health.HALF_OPEN
+    # The probe is in flight; nobody else gets through
+    assert not breaker.available()
+    breaker.on_failure()
+    assert breaker.state == health.OPEN and breaker.reason == "probe failed"
+    assert not breaker.available()
+
+    clock[0] += health.OPEN_SECONDS
+    breaker.acquire()
+    assert breaker.on_success()
+    assert breaker.state == health.CLOSED and breaker.reason is None and breaker.available()
+    # A closed circuit doesn't report recoveries
+    assert not breaker.on_success()
+
+def test_balancer_sends_one_probe_to_a_recovering_node(clock):
+    lb = main.LoadBalancer(["a"])
+    lb.healthy_nodes = ["a"]
+    lb.breakers["a"].trip("test")
+    assert lb.get_next_node() is None
+    clock[0] += health.OPEN_SECONDS
+    assert lb.get_next_node() == "a"
+    assert lb.get_next_node() is None
+    lb.stats["a"].ewma_latency_ms = 5000.0
+    lb.record("a", lb.stats["a"].start(), ok=True)
+    # Recovered, with latency from before the outage forgotten
+    assert lb.breakers["a"].state == health.CLOSED
+    assert lb.stats["a"].ewma_latency_ms < 5000.0
+    assert lb.get_next_node() == "a"
+
+def latencies(**values) -> tuple:
+    stats, breakers = {}, {}
+    for node, latency in values.items():
+        stats[node] = routing.NodeStats()
+        stats[node].ewma_latency_ms = latency
+        breakers[node] = health.CircuitBreaker()
+    return stats, breakers
+
+def test_latency_outlier_against_peer_median():
+    stats, breakers = latencies(a=100.0, b=120.0, c=90.0, slow=400.0)
+    assert health.find_latency_outlier("slow", stats, breakers).startswith("latency outlier")
+    assert health.find_latency_outlier("a", stats, breakers) is None
+
+    # Slow relative to peers, but under the floor
+    stats, breakers = latencies(a=10.0, b=12.0, slow=200.0)
+    assert health.find_latency_outlier("slow", stats, breakers) is None
+
+def test_latency_outlier_needs_closed_peers_with_samples():
+    stats, breakers = latencies(a=100.0, b=None, slow=1000.0)
+    breakers["a"].trip("test")
+    # The only other closed node has no samples: never eject the last one
+    assert health.find_latency_outlier("slow", stats, breakers) is None
+    assert health.find_latency_outlier("slow", *latencies(slow=1000.0)) is None
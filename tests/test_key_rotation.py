@@ -0,0 +1,119 @@
+import sys
+import os
+import base64
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import pytest
+from fastapi.testclient import TestClient
+
+from services.kms import db, keks, main
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "keys.db"))
+    monkeypatch.setattr(keks, "_keks", {})
+    # Rotation is driven by hand here
+    monkeypatch.setattr(keks, "start", lambda: None)
+    with TestClient(main.app) as client:
+        yield client
+
+def get_key(client, key_id: str) -> bytes:
+    resp = client.post("/get_key", json={"key_id": key_id})
+    assert resp.status_code == 200
+    return base64.b64decode(resp.json()["key_bytes_b64"])
+
+def kek_versions(table: str = "keys") -> list:
+    conn = db.get_db_connection()
+    versions = [row[0] for row in conn.execute(f"SELECT kek_version FROM {table} ORDER BY rowid")]
+    conn.close()
+    return versions
+
+def test_keys_are_stored_wrapped(client):
+    key_id = client.post("/generate_key", json={}).json()["key_id"]
+    key = get_key(client, key_id)
+    conn = db.get_db_connection()
+    row = conn.execute("SELECT key_bytes, kek_version FROM keys WHERE key_id = ?", (key_id,)).fetchone()
+    conn.close()
+    assert row['kek_version'] == 1 and key not in row['key_bytes']
+
+    # A wrapped key moved onto another row doesn't unwrap
+    conn = db.get_db_connection()
+    conn.execute("INSERT INTO keys (key_id, key_bytes, created_at, kek_version) VALUES ('k_copy', ?, '', 1)",
+                 (row['key_bytes'],))
+    conn.commit()
+    conn.close()
+    assert client.post("/get_key", json={"key_id": "k_copy"}).status_code == 500
+
+def test_rotation_rewraps_in_batches_and_on_access(client):
+    key_ids = [client.post("/generate_key", json={}).json()["key_id"] for _ in range(7)]
+    keys = [get_key(client, key_id) for key_id in key_ids]
+    master = client.post("/master_key", json={"tenant_id": "t_1"}).json()
+
+    progress = client.post("/admin/rotate", json={}).json()
+    assert progress["kek_version"] == 2
+    assert progress["status"] == "running" and progress["total"] == 8 and progress["remaining"] == 8
+
+    # Reading a key re-wraps it
+    assert get_key(client, key_ids[0]) == keys[0]
+    assert kek_versions()[0] == 2
+
+    assert keks.rewrap_batch(3) == 3
+    assert client.get("/admin/rotation").json()["remaining"] == 4
+    while keks.rewrap_batch(3):
+        pass
+    progress = client.get("/admin/rotation").json()
+    assert progress["status"] == "done" and progress["rewrapped"] == 8
+    assert set(kek_versions()) == {2} and kek_versions("master_keys") == [2]
+
+    assert [get_key(client, key_id) for key_id in key_ids] == keys
+    assert client.post("/master_key", json={"tenant_id": "t_1", "version": 1}).json() == master
+
+def test_unwrapped_rows_from_older_versions_are_migrated(client):
+    conn = db.get_db_connection()
+    conn.execute("INSERT INTO keys (key_id, key_bytes, created_at, kek_version) VALUES ('k_old', ?, '', 0)", (b"x" * 32,))
+    conn.commit()
+    conn.close()
+    assert keks.rewrap_batch(10) == 1
+    assert kek_versions() == [1]
+    assert get_key(client, "k_old") == b"x" * 32
+
+def test_rotation_job_yields_to_foreground_traffic(client, monkeypatch):
+    calls = []
+    monkeypatch.setattr(keks, "rewrap_batch", lambda limit: calls.append(limit) or 0)
+    monkeypatch.setattr(keks, "ROTATION_MAX_IN_FLIGHT", 0)
+    keks.IN_FLIGHT.inc()
+    try:
+        keks._stop.clear()
+        thread = keks.threading.Thread(target=keks._run, daemon=True)
+        thread.start()
+        keks._stop.wait(0.2)
+        assert calls == []
+    finally:
+        keks.IN_FLIGHT.dec()
+    keks._stop.wait(0.2)
+    keks.stop()
+    thread.join(1)
+    assert calls
+
+def test_bad_rows_are_skipped_and_reported(client):
+    key_ids = [client.post("/generate_key", json={}).json()["key_id"] for _ in range(5)]
+    conn = db.get_db_connection()
+    # Two rows whose wrapping no longer verifies
+    conn.execute("UPDATE keys SET key_bytes = ? WHERE key_id IN (?, ?)", (b"\0" * 60, key_ids[0], key_ids[1]))
+    conn.commit()
+    conn.close()
+    client.post("/admin/rotate", json={})
+
+    # Batches smaller than the bad rows still move on
+    handled = [keks.rewrap_batch(2) for _ in range(4)]
+    assert handled == [2, 2, 1, 0]
+    assert kek_versions() == [1, 1, 2, 2, 2]
+    progress = client.get("/admin/rotation").json()
+    assert progress["status"] == "done_with_errors" and progress["failed"] == 2 and progress["remaining"] == 2
+    assert key_ids[0] in progress["last_error"] or key_ids[1] in progress["last_error"]
+
+    # The next rotation tries them again
+    client.post("/admin/rotate", json={})
+    assert keks.rewrap_batch(10) == 5
+    assert client.get("/admin/rotation").json()["failed"] == 2
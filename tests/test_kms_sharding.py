@@ -0,0 +1,181 @@
+import sys
+import os
+import base64
+import threading
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import pytest
+from fastapi.testclient import TestClient
+
+from common import auth, deadline, kms_router
+from common.ring import HashRing
+from services.kms import db, keks, main, replication
+
+def test_ring_spreads_keys_and_moves_few_on_resize():
+    keys = [f"k_{i}" for i in range(20000)]
+    ring = HashRing(["0", "1", "2", "3"])
+    owners = {key: ring.node_for(key) for key in keys}
+    counts = [list(owners.values()).count(node) for node in ring.nodes]
+    assert min(counts) > 0.7 * len(keys) / 4
+
+    grown = HashRing(["0", "1", "2", "3", "4"])
+    moved = sum(owners[key] != grown.node_for(key) for key in keys)
+    assert moved < 0.3 * len(keys)
+    assert all(grown.node_for(key) == "4" for key in keys if owners[key] != grown.node_for(key))
+
+@pytest.fixture
+def kms(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "primary.db"))
+    monkeypatch.setattr(keks, "_keks", {})
+    monkeypatch.setattr(keks, "start", lambda: None)
+    monkeypatch.setattr(main, "SHARD", 1)
+    monkeypatch.setattr(main, "ring", HashRing(["0", "1", "2"]))
+    with TestClient(main.app) as client:
+        yield client
+
+def test_shard_only_mints_keys_it_owns(kms):
+    key_ids = [kms.post("/generate_key", json={}).json()["key_id"] for _ in range(20)]
+    assert {main.ring.node_for(key_id) for key_id in key_ids} == {"1"}
+
+def test_replica_follows_the_primary_log(kms, tmp_path, monkeypatch):
+    key_ids = [kms.post("/generate_key", json={}).json()["key_id"] for _ in range(5)]
+    keys = {key_id: kms.post("/get_key", json={"key_id": key_id}).json()["key_bytes_b64"] for key_id in key_ids}
+    kms.post("/master_key", json={"tenant_id": "t_1"})
+    kms.post("/admin/rotate", json={})
+    keks.rewrap_batch(100)
+    assert kms.get("/replication/log", params={"after": 0}).status_code == 401
+    log = kms.get("/replication/log", params={"after": 0}, headers=auth.service_headers()).json()
+    assert log["last_seq"] == log["entries"][-1][0]
+
+    # Become the replica: its own database, read-only, fed from the primary's log in two batches
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "replica.db"))
+    monkeypatch.setattr(keks, "_keks", {})
+    monkeypatch.setattr(keks, "read_only", True)
+    monkeypatch.setattr(main, "REPLICA_OF", "http://primary")
+    db.init_db()
+    replication.init()
+    replication.apply(log["entries"][:4])
+    replication.apply(log["entries"][4:])
+    replication.apply(log["entries"][2:6]) # Replays are harmless
+
+    assert {key_id: kms.post("/get_key", json={"key_id": key_id}).json()["key_bytes_b64"] for key_id in key_ids} == keys
+    assert kms.post("/master_key", json={"tenant_id": "t_1"}).status_code == 200
+    assert kms.post("/generate_key", json={}).status_code == 403
+    assert kms.post("/master_key", json={"tenant_id": "t_new"}).status_code == 403
+    assert kms.get("/replication/status").json()["applied_seq"] == log["last_seq"]
+    # Reads don't re-wrap on a replica
+    conn = db.get_db_connection()
+    changes = conn.execute("SELECT COUNT(*) FROM changelog").fetchone()[0]
+    conn.close()
+    kms.post("/get_key", json={"key_id": key_ids[0]})
+    conn = db.get_db_connection()
+    assert conn.execute("SELECT COUNT(*) FROM changelog").fetchone()[0] == changes
+    conn.close()
+
+def primary_keys() -> dict:
+    conn = db.get_db_connection()
+    rows = {row['key_id']: (row['key_bytes'], row['kek_version']) for row in conn.execute("SELECT * FROM keys")}
+    conn.close()
+    return rows
+
+def test_changelog_is_compacted_up_to_the_slowest_replica(kms, tmp_path, monkeypatch):
+    for _ in range(5):
+        kms.post("/generate_key", json={})
+    seen = replication.changes(0, replica="r_slow")["last_seq"]
+    # Every key is re-wrapped twice after the slow replica's position
+    for _ in range(2):
+        kms.post("/admin/rotate", json={})
+        keks.rewrap_batch(100)
+    log = replication.changes(0)["entries"]
+    replication.changes(log[-1][0], replica="r_fast")
+    assert replication.truncate() == 0 # Nothing superseded up to the slowest replica
+
+    replication.changes(log[-1][0], replica="r_slow")
+    assert replication.truncate() == 10
+    compacted = replication.changes(0)["entries"]
+    assert len(compacted) == len(log) - 10
+    assert replication.status()["replicas"] == {"r_slow": log[-1][0], "r_fast": log[-1][0]}
+
+    # Replicas not heard from in REPLICA_TTL stop counting and are forgotten
+    monkeypatch.setattr(replication, "REPLICA_TTL", -1)
+    replication.truncate()
+    assert replication.status()["replicas"] == {}
+
+    # A new replica rebuilds the same rows from the compacted log
+    expected = primary_keys()
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "fresh.db"))
+    db.init_db()
+    replication.init()
+    replication.apply(compacted)
+    assert primary_keys() == expected
+
+def test_router_isolates_a_busy_shard(monkeypatch):
+    monkeypatch.setattr(kms_router, "SHARD_QUEUE_TIMEOUT", 0.01)
+    router = kms_router.KMSRouter([["http://s0"], ["http://s1", "http://s1r"], ["http://s2"]])
+    key_ids = [f"k_{i}" for i in range(60)]
+    calls = []
+
+    def fetch(base_url, shard_keys):
+        calls.append(base_url)
+        if base_url == "http://s1r":
+            raise ValueError("replica behind")
+        return {key_id: base_url for key_id in shard_keys}
+
+    found = router.read_many(key_ids, fetch)
+    assert all(found[key_id].startswith(router.shard_for(key_id).primary) for key_id in key_ids)
+
+    # Shard 2 has no free slots: its keys are missing, everyone else's aren't
+    router.shards[2]._slots = threading.BoundedSemaphore(1)
+    router.shards[2]._slots.acquire()
+    found = router.read_many(key_ids, fetch)
+    assert set(found) == {key_id for key_id in key_ids if router.shard_for(key_id).index != 2}
+    busy = next(key_id for key_id in key_ids if router.shard_for(key_id).index == 2)
+    with pytest.raises(kms_router.ShardBusy):
+        router.read(busy, lambda base_url: "key")
+
+    # Minting skips a shard that can't take the call
+    created = {router.create(lambda base_url: base_url) for _ in range(6)}
+    assert created == {"http://s0", "http://s1"}
+
+def test_router_queues_bursts_over_the_cap(monkeypatch):
+    monkeypatch.setattr(kms_router, "SHARD_MAX_IN_FLIGHT", 4)
+    router = kms_router.KMSRouter([["http://s0"], ["http://s1"]])
+    key_id = "k_1"
+    results, errors = [], []
+
+    def read():
+        try:
+            results.append(router.read(key_id, lambda base_url: time.sleep(0.02) or base_url))
+        except Exception as e:
+            errors.append(e)
+
+    # Five times the cap at once: the rest wait for a slot instead of failing
+    threads = [threading.Thread(target=read) for _ in range(20)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == [] and len(results) == 20
+
+def test_router_gives_up_by_the_deadline(monkeypatch):
+    monkeypatch.setattr(kms_router, "SHARD_QUEUE_TIMEOUT", 5.0)
+    router = kms_router.KMSRouter([["http://s0"], ["http://s1"]])
+    shard = router.shard_for("k_1")
+    shard._slots = threading.BoundedSemaphore(1)
+    shard._slots.acquire()
+    token = deadline.set_budget(0.1)
+    try:
+        started = time.monotonic()
+        with pytest.raises(kms_router.ShardBusy):
+            router.read("k_1", lambda base_url: "key")
+        assert time.monotonic() - started < 1.0
+    finally:
+        deadline.reset(token)
+
+def test_single_shard_is_not_capped(monkeypatch):
+    monkeypatch.setattr(kms_router, "SHARD_MAX_IN_FLIGHT", 1)
+    router = kms_router.KMSRouter([["http://s0"]])
+    assert router.shards[0]._slots is None
+    assert router.read("k_1", lambda base_url: router.read("k_2", lambda inner: inner)) == "http://s0"
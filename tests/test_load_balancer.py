@@ -0,0 +1,332 @@
+import sys
+import os
+import asyncio
+import json
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import httpx
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+from common import auth
+from services.load_balancer import main, routing, supervisor
+
+NODES = ["http://n1", "http://n2", "http://n3"]
+
+@pytest.fixture
+def lb(monkeypatch):
+    """
+    A balancer over NODES whose upstream calls go to `handlers[node]`.
+    """
+    balancer = main.LoadBalancer(NODES)
+    balancer.healthy_nodes = list(NODES)
+    monkeypatch.setattr(main, "lb", balancer)
+    handlers = {}
+
+    def route(request: httpx.Request) -> httpx.Response:
+        node = f"{request.url.scheme}://{request.url.host}"
+        return handlers[node](request)
+
+    real_client = httpx.AsyncClient
+    monkeypatch.setattr(httpx, "AsyncClient",
+                        lambda *args, **kwargs: real_client(*args, transport=httpx.MockTransport(route), **kwargs))
+    return balancer, handlers
+
+def batch_node(name: str):
+    def handle(request):
+        items = json.loads(request.content)["items"]
+        lines = [json.dumps({"index": i, "cipher_re": f"{name}:{item['cipher_blob']}"}) for i, item in enumerate(items)]
+        return httpx.Response(200, text="\n".join(lines) + "\n")
+    return handle
+
+def failing_node(request):
+    return httpx.Response(500)
+
+def batch(items: int) -> dict:
+    return {"items": [{"cipher_blob": f"c{i}", "rekey_id": "rk_1"} for i in range(items)], "user": "alice"}
+
+def merged(resp) -> dict:
+    lines = [json.loads(line) for line in resp.text.splitlines()]
+    by_index = {line["index"]: line for line in lines}
+    assert len(by_index) == len(lines) # One line per item
+    return by_index
+
+def test_batch_fans_out_and_merges(lb, monkeypatch):
+    balancer, handlers = lb
+    monkeypatch.setattr(main, "BATCH_MIN_CHUNK", 2)
+    for node in NODES:
+        handlers[node] = batch_node(node)
+
+    by_index = merged(TestClient(main.app).post("/reencrypt/batch", json=batch(7)))
+    assert sorted(by_index) == list(range(7))
+    # Local indices were mapped back onto the batch, and each chunk went to its own node
+    assert all(by_index[i]["cipher_re"].endswith(f":c{i}") for i in range(7))
+    assert {by_index[i]["cipher_re"].split(":c")[0] for i in range(7)} == set(NODES)
+    assert all(balancer.stats[node].outstanding == 0 for node in NODES)
+
+def test_batch_resends_a_failed_chunk_elsewhere(lb, monkeypatch):
+    _, handlers = lb
+    monkeypatch.setattr(main, "BATCH_MIN_CHUNK", 3)
+    handlers["http://n1"] = failing_node
+    handlers["http://n2"] = batch_node("http://n2")
+    handlers["http://n3"] = batch_node("http://n3")
+
+    by_index = merged(TestClient(main.app).post("/reencrypt/batch", json=batch(6)))
+    assert sorted(by_index) == list(range(6))
+    assert all("cipher_re" in line and not line["cipher_re"].startswith("http://n1") for line in by_index.values())
+
+def test_batch_reports_items_no_node_answered(lb, monkeypatch):
+    _, handlers = lb
+    for node in NODES:
+        handlers[node] = failing_node
+
+    by_index = merged(TestClient(main.app).post("/reencrypt/batch", json=batch(4)))
+    assert sorted(by_index) == list(range(4))
+    assert all(line["error"] == "Proxy error 500" for line in by_index.values())
+
+def test_gen_rekey_passes_the_caller_through(lb):
+    _, handlers = lb
+    seen = []
+
+    def node(request):
+        seen.append((request.headers.get(auth.TOKEN_HEADER), request.headers.get(auth.USER_HEADER)))
+        return httpx.Response(200, json={"rekey_id": "rk_1", "rk_blob": "b"})
+
+    for name in NODES:
+        handlers[name] = node
+    resp = TestClient(main.app).post("/gen_rekey", json={"from_user": "alice", "to_user": "bob"},
+                                     headers=auth.service_headers("alice"))
+    assert resp.status_code == 200
+    assert seen == [(auth.service_token(), "alice")]
+
+def recording(calls: list, name: str, respond):
+    def handle(request):
+        calls.append(name)
+        return respond(request)
+    return handle
+
+def answer(status: int):
+    return lambda request: httpx.Response(status, json={"cipher_re": "x"})
+
+def refuse(request):
+    raise httpx.ConnectError("refused", request=request)
+
+def time_out(request):
+    raise httpx.ReadTimeout("timed out", request=request)
+
+def forward(idempotent: bool):
+    return asyncio.run(main.forward("/reencrypt", {"cipher_blob": "c", "rekey_id": "rk_1"}, idempotent))
+
+@pytest.mark.parametrize("idempotent", [True, False])
+def test_forward_retries_refused_connections_on_another_node(lb, idempotent):
+    balancer, handlers = lb
+    calls = []
+    handlers[NODES[0]] = recording(calls, NODES[0], answer(200))
+    handlers[NODES[1]] = recording(calls, NODES[1], refuse)
+
+    # The refusing node is picked first
+    balancer.healthy_nodes = [NODES[1], NODES[0]]
+    balancer.strategy = routing.RoundRobin()
+    assert forward(idempotent) == {"cipher_re": "x"}
+    assert calls == [NODES[1], NODES[0]]
+
+@pytest.mark.parametrize("idempotent, attempts", [(True, 2), (False, 1)])
+def test_forward_retries_server_errors_only_when_idempotent(lb, idempotent, attempts):
+    balancer, handlers = lb
+    calls = []
+    for node in NODES:
+        handlers[node] = recording(calls, node, answer(503))
+    with pytest.raises(HTTPException) as err:
+        forward(idempotent)
+    assert err.value.status_code == 503
+    # At most RETRIES extra attempts, each on a node not tried yet
+    assert len(calls) == attempts == len(set(calls))
+    assert sum(balancer.stats[n].errors for n in NODES) == attempts
+
+@pytest.mark.parametrize("idempotent, attempts", [(True, 2), (False, 1)])
+def test_forward_retries_timeouts_only_when_idempotent(lb, idempotent, attempts):
+    _, handlers = lb
+    calls = []
+    for node in NODES:
+        handlers[node] = recording(calls, node, time_out)
+    with pytest.raises(HTTPException) as err:
+        forward(idempotent)
+    assert err.value.status_code == 502
+    assert len(calls) == attempts
+
+def test_forward_does_not_retry_client_errors(lb):
+    _, handlers = lb
+    calls = []
+    for node in NODES:
+        handlers[node] = recording(calls, node, answer(400))
+    with pytest.raises(HTTPException) as err:
+        forward(True)
+    assert err.value.status_code == 400 and len(calls) == 1
+
+def test_forward_without_healthy_nodes(lb):
+    balancer, _ = lb
+    balancer.healthy_nodes = []
+    with pytest.raises(HTTPException) as err:
+        forward(True)
+    assert err.value.status_code == 503
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: now[0])
+    return now
+
+def healthy(request):
+    return httpx.Response(200, json={"status": "ok"})
+
+def test_membership_needs_the_service_token(lb):
+    balancer, handlers = lb
+    handlers["http://n4"] = healthy
+    client = TestClient(main.app)
+    for headers in ({}, {auth.TOKEN_HEADER: "guess"}):
+        assert client.post("/admin/nodes/register", json={"url": "http://n4"}, headers=headers).status_code == 401
+        assert client.post("/admin/nodes/deregister", json={"url": NODES[0]}, headers=headers).status_code == 401
+        assert client.post("/admin/nodes/heartbeat", json={"url": NODES[0]}, headers=headers).status_code == 401
+    assert balancer.nodes == NODES and not balancer.draining
+
+def test_register_heartbeat_and_drain(lb, clock):
+    balancer, handlers = lb
+    handlers["http://n4"] = healthy
+    client = TestClient(main.app)
+    headers = auth.service_headers()
+
+    resp = client.post("/admin/nodes/register", json={"url": "http://n4"}, headers=headers)
+    assert resp.json()["heartbeat_ttl"] == main.HEARTBEAT_TTL
+    # Health-checked on the spot, so it takes traffic right away
+    assert "http://n4" in balancer.healthy_nodes
+    assert client.post("/admin/nodes/heartbeat", json={"url": "http://n4"}, headers=headers).status_code == 200
+    assert client.post("/admin/nodes/heartbeat", json={"url": "http://n5"}, headers=headers).status_code == 404
+
+    started = balancer.stats["http://n4"].start()
+    resp = client.post("/admin/nodes/deregister", json={"url": "http://n4"}, headers=headers)
+    assert resp.json()["status"] == "draining"
+    assert all(balancer.get_next_node() != "http://n4" for _ in range(20))
+    # A draining node has to register again
+    assert client.post("/admin/nodes/heartbeat", json={"url": "http://n4"}, headers=headers).status_code == 404
+
+    # Removed once its last request finishes
+    balancer.record("http://n4", started, ok=True)
+    balancer.sweep()
+    assert "http://n4" not in balancer.nodes and "http://n4" not in balancer.stats
+    assert client.post("/admin/nodes/deregister", json={"url": "http://n4"}, headers=headers).status_code == 404
+
+def test_deregister_without_drain_removes_at_once(lb):
+    balancer, _ = lb
+    balancer.stats[NODES[0]].start()
+    resp = TestClient(main.app).post("/admin/nodes/deregister", json={"url": NODES[0], "drain": False},
+                                     headers=auth.service_headers())
+    assert resp.json()["status"] == "removed" and NODES[0] not in balancer.nodes
+
+def test_sweep_drops_nodes_that_stop_heartbeating(clock):
+    balancer = main.LoadBalancer(["seed"])
+    balancer.add_node("idle")
+    balancer.add_node("busy")
+    balancer.stats["busy"].start()
+
+    clock[0] += main.HEARTBEAT_TTL
+    balancer.sweep()
+    assert not balancer.draining
+
+    clock[0] += 1
+    balancer.sweep()
+    # Idle nodes go straight away; seeds never heartbeat and are kept
+    assert balancer.nodes == ["seed", "busy"] and list(balancer.draining) == ["busy"]
+
+    clock[0] += main.DRAIN_TIMEOUT
+    balancer.sweep()
+    assert "busy" in balancer.nodes
+    clock[0] += 1
+    balancer.sweep()
+    assert balancer.nodes == ["seed"]
+
+    # A drained node that comes back rejoins as new
+    balancer.add_node("busy")
+    assert balancer.heartbeat("busy") and not balancer.draining
+
+@pytest.fixture
+def sup(monkeypatch, clock):
+    monkeypatch.setattr(supervisor.time, "monotonic", lambda: clock[0])
+    s = supervisor.Supervisor("http://lb", min_nodes=2, max_nodes=4)
+    actions = []
+    monkeypatch.setattr(s, "reap", lambda: None)
+    monkeypatch.setattr(s, "scale_up", lambda: actions.append("up"))
+    monkeypatch.setattr(s, "scale_down", lambda: actions.append("down"))
+    clock[0] += supervisor.COOLDOWN
+    return s, actions
+
+@pytest.mark.parametrize("load, ours, action", [
+    ((1, 0.0, None), 0, "up"),                        # below the minimum
+    ((2, supervisor.SCALE_UP_OUTSTANDING + 1, 50.0), 0, "up"),
+    ((2, 2.0, supervisor.SCALE_UP_P95_MS + 1), 0, "up"),
+    ((4, supervisor.SCALE_UP_OUTSTANDING + 1, None), 2, None), # at the maximum
+    ((3, 0.5, 50.0), 1, "down"),
+    ((3, 0.5, None), 1, "down"),
+    ((3, 0.5, 50.0), 0, None),                        # only nodes we started are stopped
+    ((2, 0.5, 50.0), 1, None),                        # at the minimum
+    ((3, 0.5, supervisor.SCALE_DOWN_P95_MS + 1), 1, None),
+    ((3, 4.0, 200.0), 1, None),                       # neither busy nor idle
+])
+def test_supervisor_scaling_decisions(sup, monkeypatch, load, ours, action):
+    s, actions = sup
+    monkeypatch.setattr(s, "load", lambda: load)
+    s.procs = {f"http://localhost:{9000 + i}": None for i in range(ours)}
+    s.step()
+    assert actions == ([action] if action else [])
+
+def test_supervisor_waits_out_the_cooldown(sup, monkeypatch, clock):
+    s, actions = sup
+    monkeypatch.setattr(s, "load", lambda: (1, 0.0, None))
+    s.step()
+    clock[0] += supervisor.COOLDOWN - 1
+    s.step()
+    assert actions == ["up"]
+    clock[0] += 1
+    s.step()
+    assert actions == ["up", "up"]
+
+class FakeProc:
+    def __init__(self):
+        self.terminated = False
+
+    def terminate(self):
+        self.terminated = True
+
+def test_supervisor_drains_then_reaps(monkeypatch, clock):
+    monkeypatch.setattr(supervisor.time, "monotonic", lambda: clock[0])
+    s = supervisor.Supervisor("http://lb")
+    old, new = FakeProc(), FakeProc()
+    s.procs = {"http://localhost:8010": old, "http://localhost:8011": new}
+    posts = []
+    monkeypatch.setattr(supervisor.requests, "post", lambda url, json=None, headers=None, timeout=None:
+                        posts.append((url, json, headers)))
+    registered = {"nodes": ["http://localhost:8010", "http://localhost:8011"]}
+    monkeypatch.setattr(supervisor.requests, "get", lambda url, timeout=None:
+                        type("Resp", (), {"json": lambda self: registered})())
+
+    s.scale_down()
+    # Newest first, deregistered with the service token
+    assert posts == [("http://lb/admin/nodes/deregister", {"url": "http://localhost:8011", "drain": True},
+                      auth.service_headers())]
+    s.reap()
+    assert not new.terminated
+    registered["nodes"] = ["http://localhost:8010"]
+    s.reap()
+    assert new.terminated and not s.stopping and not old.terminated
+
+def test_supervisor_load_counts_active_nodes(monkeypatch):
+    nodes = {
+        "a": {"healthy": True, "draining": False, "outstanding": 4, "p95_latency_ms": 80.0},
+        "b": {"healthy": True, "draining": False, "outstanding": 2, "p95_latency_ms": None},
+        "c": {"healthy": False, "draining": False, "outstanding": 9, "p95_latency_ms": 900.0},
+        "d": {"healthy": True, "draining": True, "outstanding": 9, "p95_latency_ms": 900.0},
+    }
+    monkeypatch.setattr(supervisor.requests, "get", lambda url, timeout=None:
+                        type("Resp", (), {"json": lambda self: {"nodes": nodes}})())
+    assert supervisor.Supervisor("http://lb").load() == (2, 3.0, 80.0)
@@ -0,0 +1,55 @@
+import sys
+import os
+import threading
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from common import metrics
+
+def test_histogram_sums_thread_shards():
+    h = metrics.Histogram("test_latency_seconds", "test", ("route",), buckets=(0.1, 1.0))
+    child = h.labels("/x")
+
+    def work():
+        for _ in range(1000):
+            child.observe(0.05)
+        child.observe(5.0)
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    lines = h.render()
+    assert 'test_latency_seconds_bucket{route="/x",le="0.1"} 4000' in lines
+    assert 'test_latency_seconds_bucket{route="/x",le="1"} 4000' in lines
+    assert 'test_latency_seconds_bucket{route="/x",le="+Inf"} 4004' in lines
+    assert 'test_latency_seconds_count{route="/x"} 4004' in lines
+
+def test_callback_metrics_read_at_scrape_time():
+    state = {"n": 1}
+    g = metrics.Gauge("test_height", "test", fn=lambda: state["n"])
+    state["n"] = 7
+    assert g.render()[-1] == "test_height 7"
+
+    c = metrics.Counter("test_node_requests_total", "test", ("node",), fn=lambda: {("a",): 3, ("b",): None})
+    assert c.render()[2:] == ['test_node_requests_total{node="a"} 3']
+
+def test_exited_threads_fold_into_the_total():
+    c = metrics.Counter("test_short_lived_total", "test")
+    child = c.labels()
+    child.inc(2)
+
+    def work():
+        child.inc(3)
+
+    for _ in range(50):
+        t = threading.Thread(target=work)
+        t.start()
+        t.join()
+
+    shards, retired = child._shards._state
+    # Only this thread's shard is left; the others' counts were kept
+    assert len(shards) == 1 and retired == [150.0]
+    assert child.value() == 152.0
@@ -0,0 +1,75 @@
+import sys
+import os
+import multiprocessing
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from common.store import LocalStore
+from services.blockchain.ledger import SharedLedger
+from services.gateway import db, limits
+
+def append_blocks(path, worker, n):
+    ledger = SharedLedger(path)
+    for i in range(n):
+        ledger.add_transaction({"user": worker, "action": "encrypt", "file_id": str(i)})
+
+def test_workers_append_to_one_chain(tmp_path):
+    path = str(tmp_path / "ledger.db")
+    SharedLedger.reset(path)
+    ctx = multiprocessing.get_context("fork")
+    workers = [ctx.Process(target=append_blocks, args=(path, f"w{i}", 20)) for i in range(3)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+
+    ledger = SharedLedger(path)
+    assert len(ledger.chain) == 61
+    assert [b.index for b in ledger.chain] == list(range(61))
+    assert ledger.validate_chain()
+
+def test_worker_sees_blocks_written_by_another(tmp_path):
+    path = str(tmp_path / "ledger.db")
+    first, second = SharedLedger(path), SharedLedger(path)
+    assert first.chain[0].hash == second.chain[0].hash # One genesis block
+
+    block = first.add_transaction({"user": "alice"})
+    assert second.last_block.hash == block.hash
+    assert second.add_transaction({"user": "bob"}).prev_hash == block.hash
+
+def test_gateway_workers_share_quota_usage(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "gateway.db"))
+    db.init_db()
+    tenant = {"id": "t_1", "plan": "starter"}
+    a, b = limits.TenantLimiter(workers=2), limits.TenantLimiter(workers=2)
+
+    assert a.check(tenant, 100) is None
+    assert b.check(tenant, 300) is None
+    db.save_usage(a.dirty_rows())
+    db.save_usage(b.dirty_rows())
+    assert b.check(tenant, 50) is None # Not yet written
+
+    b.merge(db.load_usage(b.period()))
+    usage = b.snapshot("t_1")["t_1"]
+    assert usage["requests"] == 3 and usage["bytes_in"] == 450
+
+    db.save_usage(b.dirty_rows())
+    a.merge(db.load_usage(a.period()))
+    assert a.snapshot("t_1")["t_1"]["bytes_in"] == 450
+
+def test_lb_workers_share_registrations(tmp_path, monkeypatch):
+    from services.load_balancer import main
+
+    store = LocalStore("lb_nodes", path=str(tmp_path / "store.db"))
+    monkeypatch.setattr(main, "membership", store)
+    monkeypatch.setattr(main, "lb", main.LoadBalancer([]))
+    LocalStore("other", path=store.path).set("http://x", {"draining": False})
+
+    # Registered through another worker
+    store.set("http://localhost:9001", {"draining": False}, ttl=main.HEARTBEAT_TTL)
+    main.sync_membership()
+    assert main.lb.nodes == ["http://localhost:9001"]
+
+    store.set("http://localhost:9001", {"draining": True}, ttl=main.DRAIN_TIMEOUT)
+    main.sync_membership()
+    assert "http://localhost:9001" in main.lb.draining
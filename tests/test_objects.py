@@ -0,0 +1,147 @@
+import sys
+import os
+import random
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import base64
+import pytest
+from fastapi.testclient import TestClient
+
+from common import pre
+from services.encryption import crypto, db, main, objects, packstore, segments
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "encryption.db"))
+    monkeypatch.setattr(packstore, "store", packstore.PackStore(str(tmp_path / "objects"), pack_size=256 * 1024))
+    kms = {}
+
+    def create_key():
+        key_id = f"k_{len(kms)}"
+        kms[key_id] = os.urandom(32)
+        return key_id
+
+    monkeypatch.setattr(crypto, "create_key_in_kms", create_key)
+    monkeypatch.setattr(crypto, "get_key_from_kms", lambda key_id: kms[key_id])
+    monkeypatch.setattr(crypto, "log_event", lambda *args: None)
+    with TestClient(main.app) as client:
+        yield client
+
+def store(client, data: bytes, **headers):
+    resp = client.post("/encrypt", json={"plaintext": base64.b64encode(data).decode(), "store": True}, headers=headers)
+    assert resp.status_code == 200
+    body = resp.json()
+    assert body["cipher"] is None
+    return body
+
+def test_stored_object_round_trip(client):
+    data = random.Random(1).randbytes(3 * segments.DEFAULT_SEGMENT_SIZE + 123)
+    body = store(client, data)
+
+    resp = client.post("/decrypt", json={"cipher_id": body["cipher_id"], "key_id": body["key_id"]})
+    assert resp.status_code == 200
+    assert base64.b64decode(resp.json()["plaintext"]) == data
+
+    # Holding the key_id is what grants access
+    resp = client.post("/decrypt", json={"cipher_id": body["cipher_id"], "key_id": "k_other"})
+    assert resp.status_code == 404
+
+def test_range_reads_only_fetch_covering_segments(client, monkeypatch):
+    size = segments.DEFAULT_SEGMENT_SIZE
+    data = random.Random(2).randbytes(10 * size)
+    body = store(client, data)
+
+    fetched = []
+    get_many = packstore.store.get_many
+    monkeypatch.setattr(packstore.store, "get_many", lambda digests: fetched.append(len(digests)) or get_many(digests))
+
+    url = f"/objects/{body['cipher_id']}?key_id={body['key_id']}"
+    start, end = 4 * size - 10, 5 * size + 9
+    resp = client.get(url, headers={"range": f"bytes={start}-{end}"})
+    assert resp.status_code == 206
+    assert resp.content == data[start:end + 1]
+    assert resp.headers["content-range"] == f"bytes {start}-{end}/{len(data)}"
+    assert fetched == [3]
+
+    resp = client.get(url, headers={"range": "bytes=-100"})
+    assert resp.content == data[-100:]
+    assert client.get(url, headers={"range": f"bytes={len(data)}-"}).status_code == 416
+    assert client.get(url).content == data
+
+def test_decrypt_accepts_a_byte_range(client):
+    size = segments.DEFAULT_SEGMENT_SIZE
+    data = random.Random(4).randbytes(5 * size + 17)
+    stored = store(client, data)
+    resp = client.post("/encrypt", json={"plaintext": base64.b64encode(data).decode(), "segmented": True})
+    blob = resp.json()
+
+    for source in ({"cipher_id": stored["cipher_id"], "key_id": stored["key_id"]},
+                   {"cipher": blob["cipher"], "key_id": blob["key_id"]}):
+        resp = client.post("/decrypt", json={**source, "offset": 2 * size - 3, "length": size})
+        assert base64.b64decode(resp.json()["plaintext"]) == data[2 * size - 3:3 * size - 3]
+        resp = client.post("/decrypt", json={**source, "offset": size, "stream": True})
+        assert resp.headers["content-type"] == "application/octet-stream"
+        assert resp.content == data[size:]
+
+    # Single-shot blobs are decrypted whole, then sliced
+    resp = client.post("/encrypt", json={"plaintext": base64.b64encode(data).decode()})
+    body = resp.json()
+    resp = client.post("/decrypt", json={"cipher": body["cipher"], "key_id": body["key_id"], "offset": 10, "length": 5})
+    assert base64.b64decode(resp.json()["plaintext"]) == data[10:15]
+    assert client.post("/decrypt", json={"cipher": body["cipher"], "key_id": body["key_id"], "offset": -1}).status_code == 400
+
+def test_reencrypted_object_shares_segments(client, monkeypatch):
+    data = random.Random(3).randbytes(segments.DEFAULT_SEGMENT_SIZE * 2)
+    body = store(client, data)
+    owner, recipient = 3, 5
+    rekey = pre.Rekey(pre.make_rekey(owner, pre.public_key(recipient)))
+    monkeypatch.setattr(crypto, "pre_public_key", lambda user_id: pre.public_key(owner))
+    sent = []
+
+    class ProxyResponse:
+        status_code = 200
+
+        def __init__(self, cipher_re):
+            self.cipher_re = cipher_re
+
+        def json(self):
+            return {"cipher_re": self.cipher_re}
+
+    def post(url, json, timeout):
+        sent.append(json["cipher_blob"])
+        return ProxyResponse(base64.b64encode(rekey.reencrypt(base64.b64decode(json["cipher_blob"]))).decode())
+
+    monkeypatch.setattr(main.requests, "post", post)
+    conn = db.get_db_connection()
+    blobs = conn.execute("SELECT COUNT(*) FROM pack_index").fetchone()[0]
+    conn.close()
+
+    request = {"key_id": body["key_id"], "rekey_id": "rk_1", "owner": "alice"}
+    resp = client.post(f"/objects/{body['cipher_id']}/reencrypt", json=request)
+    assert resp.status_code == 200
+    clone_id = resp.json()["cipher_id"]
+    # Only the wrapped key went through the proxy, and only the recipient can open the result
+    assert len(sent) == 1 and len(base64.b64decode(sent[0])) < 200
+    assert pre.decrypt(recipient, base64.b64decode(resp.json()["wrapped_key"])) == crypto.get_key_from_kms(body["key_id"])
+    # No segment was written again
+    conn = db.get_db_connection()
+    assert conn.execute("SELECT COUNT(*) FROM pack_index").fetchone()[0] == blobs
+    conn.close()
+    assert objects.read_range(objects.load(clone_id, body["key_id"])) == data
+
+    # Without an owner there is nothing to re-encrypt, and a proxy that
+    # passes the key through (a rekey from before PRE) shares nothing
+    assert client.post(f"/objects/{body['cipher_id']}/reencrypt",
+                       json={"key_id": body["key_id"], "rekey_id": "rk_1"}).status_code == 422
+    monkeypatch.setattr(main.requests, "post", lambda url, json, timeout: ProxyResponse(json["cipher_blob"]))
+    assert client.post(f"/objects/{body['cipher_id']}/reencrypt", json=request).status_code == 400
+
+def test_packs_roll_over_and_stay_readable(client):
+    blobs = [random.Random(i).randbytes(100 * 1024) for i in range(6)]
+    digests = packstore.store.put_many(blobs[:3]) + packstore.store.put_many(blobs[3:] + blobs[:1])
+    assert digests[-1] == digests[0]
+    assert len([f for f in os.listdir(packstore.store.root) if f.endswith(".pack")]) > 1
+    assert packstore.store.get_many(digests) == blobs + blobs[:1]
+    with pytest.raises(KeyError):
+        packstore.store.get("0" * 64)
@@ -0,0 +1,64 @@
+import sys
+import os
+import hashlib
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import pytest
+
+from common import offload
+
+KEY = b"k" * 32
+
+def test_large_payloads_round_trip_through_the_pool(monkeypatch):
+    monkeypatch.setattr(offload, "OFFLOAD_THRESHOLD", 1024)
+    data = os.urandom(256 * 1024)
+
+    nonce, ciphertext, tag = offload.aes_gcm_encrypt(KEY, data)
+    assert len(ciphertext) == len(data) and ciphertext != data
+    assert offload.aes_gcm_decrypt(KEY, nonce, ciphertext, tag) == data
+    assert offload.sha256_hex(data) == hashlib.sha256(data).hexdigest()
+    assert offload.OFFLOADED.labels("aes_gcm.encrypt").value() >= 1
+    assert offload.queue_depth() == 0 and offload._pending == 0
+
+    # Interchangeable with the inline path
+    monkeypatch.setattr(offload, "OFFLOAD_THRESHOLD", len(data) + 1)
+    assert offload.aes_gcm_decrypt(KEY, nonce, ciphertext, tag) == data
+
+def test_tampered_ciphertext_fails_in_the_pool(monkeypatch):
+    monkeypatch.setattr(offload, "OFFLOAD_THRESHOLD", 1024)
+    nonce, ciphertext, tag = offload.aes_gcm_encrypt(KEY, b"x" * 4096)
+    with pytest.raises(ValueError):
+        offload.aes_gcm_decrypt(KEY, nonce, b"y" + ciphertext[1:], tag)
+
+def test_payloads_run_inline_by_default(monkeypatch):
+    monkeypatch.setattr(offload, "OFFLOAD_THRESHOLD", 0)
+    before = offload.OFFLOADED.labels("aes_gcm.encrypt").value()
+    nonce, ciphertext, tag = offload.aes_gcm_encrypt(KEY, os.urandom(4 * 1024 * 1024))
+    assert offload.OFFLOADED.labels("aes_gcm.encrypt").value() == before
+
+class BrokenPool:
+    def __init__(self):
+        self.shut_down = False
+
+    def submit(self, *args):
+        future = Future()
+        future.set_exception(BrokenProcessPool("worker died"))
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.shut_down = True
+
+def test_broken_pool_is_shut_down_and_replaced(monkeypatch):
+    monkeypatch.setattr(offload, "OFFLOAD_THRESHOLD", 1024)
+    broken = BrokenPool()
+    monkeypatch.setattr(offload, "_pool", broken)
+    with pytest.raises(BrokenProcessPool):
+        offload.aes_gcm_encrypt(KEY, b"x" * 4096)
+    assert broken.shut_down and offload._pool is None and offload._pending == 0
+
+    # The next call gets a working pool
+    nonce, ciphertext, tag = offload.aes_gcm_encrypt(KEY, b"x" * 4096)
+    assert offload.aes_gcm_decrypt(KEY, nonce, ciphertext, tag) == b"x" * 4096
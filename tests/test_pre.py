@@ -0,0 +1,181 @@
+import sys
+import os
+import base64
+import random
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import pytest
+import requests
+from fastapi.testclient import TestClient
+
+from common import auth, pre
+from common.store import LocalStore
+from services.encryption import crypto, db as enc_db, main as enc_main
+from services.kms import db as kms_db, keks, main as kms_main
+from services.proxy import cache, db as proxy_db, main as proxy_main, reencryption
+
+def naive_mul(k, point):
+    result = None
+    addend = (point[0], point[1], 1)
+    while k:
+        if k & 1:
+            result = pre._add(result, addend)
+        addend = pre._double(addend)
+        k >>= 1
+    return pre._affine(result)
+
+def test_scalar_multiplication_matches_double_and_add():
+    rng = random.Random(7)
+    other = naive_mul(rng.randrange(1, pre.N), pre.G)
+    for _ in range(10):
+        k = rng.randrange(1, pre.N)
+        k1, k2 = pre.split(k)
+        assert (k1 + k2 * pre.LAMBDA - k) % pre.N == 0
+        assert max(abs(k1), abs(k2)) < 2 ** 129
+        assert pre.base_mul(k) == naive_mul(k, pre.G)
+        assert pre.mul(k, other) == naive_mul(k, other)
+
+def test_reencrypted_blob_opens_only_for_recipient():
+    alice, alice_pub = pre.generate_keypair()
+    bob, bob_pub = pre.generate_keypair()
+    carol, _ = pre.generate_keypair()
+    blob = pre.encrypt(alice_pub, b"data key")
+    assert pre.decrypt(alice, blob) == b"data key"
+    with pytest.raises(ValueError):
+        pre.decrypt(bob, blob)
+
+    rekey = pre.Rekey(pre.make_rekey(alice, bob_pub))
+    transformed = rekey.reencrypt(blob)
+    assert pre.decrypt(bob, transformed) == b"data key"
+    with pytest.raises(ValueError):
+        pre.decrypt(carol, transformed)
+    with pytest.raises(ValueError):
+        rekey.reencrypt(transformed)
+
+    # A capsule that fails its check is refused before any transformation
+    tampered = bytearray(blob)
+    tampered[pre.HEADER_SIZE - 1] ^= 1
+    with pytest.raises(ValueError):
+        rekey.reencrypt(bytes(tampered))
+
+def unwrap(kms, user_id: str, wrapped: str):
+    return kms.post("/unwrap_key/pre", json={"user_id": user_id, "wrapped": wrapped}, headers=auth.service_headers(user_id))
+
+@pytest.fixture
+def services(tmp_path, monkeypatch):
+    monkeypatch.setattr(kms_db, "DB_PATH", str(tmp_path / "keys.db"))
+    monkeypatch.setattr(keks, "_keks", {})
+    monkeypatch.setattr(keks, "start", lambda: None)
+    monkeypatch.setattr(enc_db, "DB_PATH", str(tmp_path / "encryption.db"))
+    monkeypatch.setattr(proxy_db, "DB_PATH", str(tmp_path / "proxies.db"))
+    monkeypatch.setattr(reencryption, "rekeys", cache.RekeyCache(store=LocalStore("rekeys", path=str(tmp_path / "store.db"))))
+    monkeypatch.setattr(reencryption, "_prepared", type(reencryption._prepared)())
+    monkeypatch.setattr(reencryption, "log_event", lambda *args, **kwargs: None)
+    monkeypatch.setattr(crypto, "log_event", lambda *args, **kwargs: None)
+    monkeypatch.setattr(crypto, "_pre_public_keys", {})
+
+    with TestClient(kms_main.app) as kms, TestClient(enc_main.app) as enc, TestClient(proxy_main.app) as proxy:
+        def post(url, json=None, timeout=None, headers=None, **kwargs):
+            # Only the KMS is up; screening and logging see it as unreachable
+            if url.startswith(reencryption.KMS_URL):
+                return kms.post(url[len(reencryption.KMS_URL):], json=json, headers=headers)
+            raise requests.ConnectionError(url)
+
+        monkeypatch.setattr(requests, "post", post)
+        yield kms, enc, proxy
+
+def test_share_flow_through_kms_and_proxy(services, monkeypatch):
+    kms, enc, proxy = services
+    key = os.urandom(32)
+    monkeypatch.setattr(crypto, "get_key_from_kms", lambda key_id: key)
+
+    resp = proxy.post("/gen_rekey", json={"from_user": "alice", "to_user": "bob"}, headers=auth.service_headers("alice"))
+    assert resp.status_code == 200
+    rekey_id = resp.json()["rekey_id"]
+    # Only the precursor is handed out, never the rekey
+    assert len(base64.b64decode(resp.json()["rk_blob"])) == pre.POINT_SIZE
+
+    wrapped = enc.post("/wrap_key/pre", json={"key_id": "k_1", "user_id": "alice"}).json()["wrapped"]
+    assert unwrap(kms, "alice", wrapped).json()["key_bytes_b64"] == \
+        base64.b64encode(key).decode()
+
+    cipher_re = proxy.post("/reencrypt", json={"cipher_blob": wrapped, "rekey_id": rekey_id}).json()["cipher_re"]
+    prepared = reencryption._prepared[rekey_id][1]
+    again = proxy.post("/reencrypt", json={"cipher_blob": wrapped, "rekey_id": rekey_id}).json()["cipher_re"]
+    assert reencryption._prepared[rekey_id][1] is prepared
+    # Deterministic: the capsule and the rekey fix the result
+    assert again == cipher_re
+
+    resp = unwrap(kms, "bob", cipher_re)
+    assert base64.b64decode(resp.json()["key_bytes_b64"]) == key
+    # Only bob, through a service, can open what was shared with him
+    request = {"user_id": "bob", "wrapped": cipher_re}
+    assert kms.post("/unwrap_key/pre", json=request).status_code == 401
+    assert kms.post("/unwrap_key/pre", json=request, headers=auth.service_headers("carol")).status_code == 403
+    kms.post("/pre/public_key", json={"user_id": "carol"})
+    assert unwrap(kms, "carol", cipher_re).status_code == 400
+
+    # Key pairs are wrapped under the KEKs like data keys
+    kms.post("/admin/rotate", json={})
+    keks.rewrap_batch(100)
+    assert kms.get("/admin/rotation").json()["remaining"] == 0
+    resp = unwrap(kms, "bob", cipher_re)
+    assert base64.b64decode(resp.json()["key_bytes_b64"]) == key
+
+    # Ciphertexts from before PRE pass through as they used to
+    assert proxy.post("/reencrypt", json={"cipher_blob": "n|c|t", "rekey_id": rekey_id}).json()["cipher_re"] == "n|c|t"
+
+    assert proxy.post("/revoke_rekey", json={"rekey_id": rekey_id}).status_code == 200
+    assert rekey_id not in reencryption._prepared
+    assert proxy.post("/reencrypt", json={"cipher_blob": wrapped, "rekey_id": rekey_id}).status_code == 400
+
+def test_rekey_fails_cleanly_without_kms(services, monkeypatch):
+    _, _, proxy = services
+
+    def post(url, **kwargs):
+        raise requests.ConnectionError(url)
+
+    monkeypatch.setattr(requests, "post", post)
+    assert proxy.post("/gen_rekey", json={"from_user": "alice", "to_user": "bob"},
+                      headers=auth.service_headers("alice")).status_code == 502
+
+def test_rekeys_only_for_the_calling_user(services):
+    kms, _, proxy = services
+    rekey = {"from_user": "alice", "to_user": "mallory"}
+    assert proxy.post("/gen_rekey", json=rekey).status_code == 401
+    assert proxy.post("/gen_rekey", json=rekey, headers=auth.service_headers("mallory")).status_code == 403
+    assert kms.post("/pre/rekey", json=rekey).status_code == 401
+    assert kms.post("/pre/rekey", json=rekey, headers={auth.USER_HEADER: "alice"}).status_code == 401
+    assert kms.post("/pre/rekey", json=rekey, headers=auth.service_headers("mallory")).status_code == 403
+    # The recipient's public key is the KMS's own, never one the caller supplies
+    resp = kms.post("/pre/rekey", json={**rekey, "to_public_key_b64": base64.b64encode(pre.public_key(5)).decode()},
+                    headers=auth.service_headers("alice"))
+    assert resp.status_code == 200
+    alice = base64.b64decode(kms.post("/pre/public_key", json={"user_id": "alice"}).json()["public_key_b64"])
+    transformed = pre.Rekey(base64.b64decode(resp.json()["rk_b64"])).reencrypt(pre.encrypt(alice, b"data key"))
+    with pytest.raises(ValueError):
+        pre.decrypt(5, transformed)
+
+def test_rekey_to_a_user_on_another_shard(services, monkeypatch):
+    kms, _, _ = services
+    monkeypatch.setattr(kms_main, "ring", kms_main.HashRing(["0", "1"]))
+    local = next(u for u in (f"user{i}" for i in range(100)) if kms_main.ring.node_for(u) == "0")
+    remote = next(u for u in (f"user{i}" for i in range(100)) if kms_main.ring.node_for(u) == "1")
+    rekey = {"from_user": local, "to_user": remote}
+    assert kms.post("/pre/rekey", json=rekey, headers=auth.service_headers(local)).status_code == 503
+
+    secret, public = pre.generate_keypair()
+    fetched = []
+
+    class Peers:
+        def read(self, user_id, fn):
+            fetched.append(user_id)
+            return public
+
+    monkeypatch.setattr(kms_main, "peers", Peers())
+    resp = kms.post("/pre/rekey", json=rekey, headers=auth.service_headers(local))
+    assert resp.status_code == 200 and fetched == [remote]
+    owner = base64.b64decode(kms.post("/pre/public_key", json={"user_id": local}).json()["public_key_b64"])
+    transformed = pre.Rekey(base64.b64decode(resp.json()["rk_b64"])).reencrypt(pre.encrypt(owner, b"data key"))
+    assert pre.decrypt(secret, transformed) == b"data key"
@@ -0,0 +1,65 @@
+import sys
+import os
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from common import auth, profiler, tracing
+
+ADMIN = auth.admin_headers()
+
+def make_app():
+    app = FastAPI()
+    tracing.instrument_app(app, "test")
+    profiler.instrument_app(app, "test")
+
+    @app.get("/slow")
+    def slow():
+        with tracing.span("work"):
+            busy_until = time.perf_counter() + 0.05
+            while time.perf_counter() < busy_until:
+                pass
+        return {"ok": True}
+
+    @app.get("/fast")
+    def fast():
+        return {"ok": True}
+
+    return app
+
+def test_slow_requests_keep_spans_and_stacks(monkeypatch):
+    monkeypatch.setattr(profiler, "slow_log", profiler.deque(maxlen=10))
+    client = TestClient(make_app())
+    client.post("/admin/profiler/slowlog", json={"threshold_ms": 20}, headers=ADMIN)
+    try:
+        client.get("/fast")
+        client.get("/slow")
+        entries = client.get("/admin/profiler/slowlog", headers=ADMIN).json()["requests"]
+    finally:
+        client.post("/admin/profiler/slowlog", json={"threshold_ms": 0}, headers=ADMIN)
+
+    assert [e["path"] for e in entries] == ["/slow"]
+    assert {"GET /slow", "work"} <= {s["name"] for s in entries[0]["spans"]}
+    assert any("slow (test_profiler.py" in stack for stack in entries[0]["stacks"])
+
+def test_profiler_returns_folded_stacks(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiler, "PROFILE_DIR", str(tmp_path))
+    client = TestClient(make_app())
+    client.post("/admin/profiler/start", json={"interval_ms": 1}, headers=ADMIN)
+    client.get("/slow")
+    resp = client.post("/admin/profiler/stop", headers=ADMIN)
+
+    lines = resp.text.splitlines()
+    assert lines and all(line.rsplit(" ", 1)[1].isdigit() for line in lines)
+    assert os.path.exists(resp.headers["x-profile-path"])
+
+def test_profiler_needs_the_admin_token():
+    client = TestClient(make_app())
+    for headers in ({}, {auth.ADMIN_HEADER: "guess"}):
+        assert client.get("/admin/profiler/slowlog", headers=headers).status_code == 401
+        assert client.post("/admin/profiler/start", json={}, headers=headers).status_code == 401
+    assert not profiler.sampler.profiling
+    assert client.get("/admin/profiler/status", headers=ADMIN).status_code == 200
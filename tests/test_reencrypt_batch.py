@@ -0,0 +1,76 @@
+import sys
+import os
+import base64
+import json
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+from common import auth, pre
+from common.store import LocalStore
+from services.proxy import cache, db, main, reencryption
+
+OWNER, RECIPIENT = 3, 5
+
+@pytest.fixture
+def proxy(tmp_path, monkeypatch):
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "proxies.db"))
+    monkeypatch.setattr(reencryption, "rekeys", cache.RekeyCache(store=LocalStore("rekeys", path=str(tmp_path / "store.db"))))
+    monkeypatch.setattr(reencryption, "_prepared", type(reencryption._prepared)())
+    monkeypatch.setattr(reencryption, "create_rekey_in_kms",
+                        lambda from_user, to_user: pre.make_rekey(OWNER, pre.public_key(RECIPIENT)))
+    events = []
+    monkeypatch.setattr(reencryption, "log_event", lambda *args: events.append(args))
+    screenings = []
+
+    def screen(user):
+        screenings.append(user)
+        return {"is_anomaly": False, "score": None}
+
+    monkeypatch.setattr(main, "screen_reencrypt", screen)
+    with TestClient(main.app) as client:
+        yield client, screenings, events
+
+def results(resp) -> dict:
+    return {line["index"]: line for line in map(json.loads, resp.text.splitlines())}
+
+def test_batch_screens_once_and_answers_every_item(proxy):
+    client, screenings, events = proxy
+    rekey_ids = [client.post("/gen_rekey", json={"from_user": "alice", "to_user": "bob"},
+                             headers=auth.service_headers("alice")).json()["rekey_id"]
+                 for _ in range(3)]
+    blobs = [pre.encrypt(pre.public_key(OWNER), f"key {i}".encode()) for i in range(6)]
+    items = [{"cipher_blob": base64.b64encode(blob).decode(), "rekey_id": rekey_ids[i % 3]}
+             for i, blob in enumerate(blobs)]
+    items.append({"cipher_blob": items[0]["cipher_blob"], "rekey_id": "rk_missing"})
+    events.clear()
+
+    resp = client.post("/reencrypt/batch", json={"items": items, "user": "alice"})
+    assert resp.status_code == 200
+    by_index = results(resp)
+    assert sorted(by_index) == list(range(7))
+    # One screening for the whole batch, however many rekeys it uses
+    assert screenings == ["alice"]
+    for i in range(6):
+        assert pre.decrypt(RECIPIENT, base64.b64decode(by_index[i]["cipher_re"])) == f"key {i}".encode()
+    assert "error" in by_index[6]
+    # One audit event per rekey that succeeded, with its count
+    assert sorted((event[1], event[3]["count"]) for event in events) == [("PROXY_REENC", 2)] * 3
+
+def test_denied_batch_fails_every_item(proxy, monkeypatch):
+    client, _, events = proxy
+
+    def deny(user):
+        raise HTTPException(status_code=403, detail="Access Denied")
+
+    monkeypatch.setattr(main, "screen_reencrypt", deny)
+    rekey_id = client.post("/gen_rekey", json={"from_user": "alice", "to_user": "bob"},
+                           headers=auth.service_headers("alice")).json()["rekey_id"]
+    items = [{"cipher_blob": "blob", "rekey_id": rekey_id}] * 3
+    events.clear()
+    by_index = results(client.post("/reencrypt/batch", json={"items": items, "user": "mallory"}))
+    assert [by_index[i]["error"] for i in range(3)] == ["Access Denied"] * 3
+    assert events == []
@@ -0,0 +1,81 @@
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import pytest
+from fastapi.testclient import TestClient
+
+from common import auth, pre
+from common.store import LocalStore
+from services.proxy import cache, db, main, reencryption
+
+@pytest.fixture
+def store_path(tmp_path):
+    return str(tmp_path / "store.db")
+
+def make_cache(store_path, **kwargs):
+    return cache.RekeyCache(store=LocalStore("rekeys", path=store_path), **kwargs)
+
+def test_lru_evicts_least_recently_used(store_path):
+    rc = make_cache(store_path, max_entries=2)
+    loads = []
+    def loader(rk_id):
+        loads.append(rk_id)
+        return {"rk_id": rk_id}
+
+    rc.get("a", loader)
+    rc.get("b", loader)
+    rc.get("a", loader)      # a becomes most recent
+    rc.get("c", loader)      # evicts b
+    assert list(rc._entries) == ["a", "c"]
+    assert rc.hits == 1
+    # b falls back to L2, not the loader
+    rc.get("b", loader)
+    assert loads == ["a", "b", "c"]
+
+def test_revocation_on_other_node_clears_lru(store_path, monkeypatch):
+    monkeypatch.setattr(cache, "EPOCH_CHECK_INTERVAL", 0)
+    node_a = make_cache(store_path)
+    node_b = make_cache(store_path)
+    rows = {"rk_1": {"rk_id": "rk_1"}}
+    loader = rows.get
+
+    assert node_a.get("rk_1", loader)
+    assert node_b.get("rk_1", loader)
+    del rows["rk_1"]
+    node_b.invalidate("rk_1")
+
+    assert node_a.get("rk_1", loader) is None
+    assert node_b.get("rk_1", loader) is None
+
+def test_stale_load_cannot_repopulate_after_revoke(store_path):
+    node_a = make_cache(store_path)
+    node_b = make_cache(store_path)
+
+    # Node A reads the row, then node B revokes before A publishes to L2
+    def racing_loader(rk_id):
+        node_b.invalidate(rk_id)
+        return {"rk_id": rk_id}
+
+    assert node_a.get("rk_1", racing_loader) is None
+    assert node_b.get("rk_1", lambda rk_id: {"rk_id": rk_id}) is None
+
+def test_revoke_endpoint(tmp_path, store_path, monkeypatch):
+    monkeypatch.setattr(db, "DB_PATH", str(tmp_path / "proxies.db"))
+    monkeypatch.setattr(reencryption, "rekeys", make_cache(store_path))
+    monkeypatch.setattr(reencryption, "log_event", lambda *args, **kwargs: None)
+    monkeypatch.setattr(reencryption, "create_rekey_in_kms",
+                        lambda from_user, to_user: pre.make_rekey(1, pre.public_key(2)))
+
+    with TestClient(main.app) as client:
+        rk_id = client.post("/gen_rekey", json={"from_user": "alice", "to_user": "bob"},
+                            headers=auth.service_headers("alice")).json()["rekey_id"]
+        assert reencryption.reencrypt("blob", rk_id) == "blob"
+
+        resp = client.post("/revoke_rekey", json={"rekey_id": rk_id})
+        assert resp.status_code == 200
+        with pytest.raises(ValueError):
+            reencryption.reencrypt("blob", rk_id)
+
+        assert client.post("/revoke_rekey", json={"rekey_id": rk_id}).status_code == 404
@@ -0,0 +1,79 @@
+import sys
+import os
+import random
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import pytest
+
+from services.load_balancer import main, routing
+
+NODES = ["a", "b", "c"]
+
+def stats_with(**fields) -> dict:
+    stats = {n: routing.NodeStats() for n in NODES}
+    for field, values in fields.items():
+        for node, value in zip(NODES, values):
+            setattr(stats[node], field, value)
+    return stats
+
+def test_least_outstanding_picks_the_shortest_queue():
+    stats = stats_with(outstanding=[3, 1, 2])
+    strategy = routing.LeastOutstanding()
+    assert {strategy.pick(NODES, stats) for _ in range(20)} == {"b"}
+    # Ties are broken at random rather than always landing on the first node
+    stats["a"].outstanding = 1
+    assert {strategy.pick(NODES, stats) for _ in range(100)} == {"a", "b"}
+
+def test_power_of_two_choices_never_picks_the_busiest():
+    stats = stats_with(outstanding=[5, 0, 2])
+    strategy = routing.PowerOfTwoChoices()
+    picks = {strategy.pick(NODES, stats) for _ in range(200)}
+    assert "a" not in picks and picks == {"b", "c"}
+    assert strategy.pick(["a"], stats) == "a"
+
+def test_ewma_weighs_latency_by_queue_and_probes_new_nodes():
+    stats = stats_with(ewma_latency_ms=[10.0, 50.0, 20.0], outstanding=[4, 0, 1])
+    strategy = routing.EwmaLatency()
+    # Expected waits: a 50, b 50, c 40
+    assert strategy.pick(NODES, stats) == "c"
+    stats["b"].ewma_latency_ms = None
+    assert strategy.pick(NODES, stats) == "b"
+
+def test_failure_is_charged_the_penalty():
+    stats = stats_with(ewma_latency_ms=[10.0, 10.0, 10.0])
+    stats["a"].outstanding = 1
+    stats["a"].finish(stats["a"].start() - 0.001, ok=False)
+    assert stats["a"].errors == 1 and stats["a"].outstanding == 1
+    assert stats["a"].ewma_latency_ms == pytest.approx(10.0 + routing.EWMA_ALPHA * (routing.FAILURE_PENALTY_MS - 10.0), rel=0.01)
+    # Failures feed the estimate but not the latency window the autoscaler reads
+    assert stats["a"].p95_latency_ms() is None
+    assert routing.EwmaLatency().pick(NODES, stats) != "a"
+
+def test_record_latency_keeps_batch_chunks_out_of_the_estimate():
+    stats = routing.NodeStats()
+    stats.finish(stats.start() - 0.020)
+    assert stats.ewma_latency_ms == pytest.approx(20.0, abs=5.0)
+    stats.finish(stats.start() - 2.0, record_latency=False)
+    assert stats.ewma_latency_ms == pytest.approx(20.0, abs=5.0)
+    assert len(stats.recent_latencies) == 1 and stats.requests == 2 and stats.outstanding == 0
+
+def test_p95_over_the_window():
+    stats = routing.NodeStats()
+    stats.recent_latencies.extend(range(1, 101))
+    assert stats.p95_latency_ms() == 96
+    stats.recent_latencies.extend([0] * routing.LATENCY_WINDOW)
+    assert stats.p95_latency_ms() == 0
+
+@pytest.mark.parametrize("strategy", sorted(routing.STRATEGIES))
+def test_every_strategy_honours_exclusion(strategy):
+    random.seed(1)
+    lb = main.LoadBalancer(NODES, strategy=strategy)
+    lb.healthy_nodes = list(NODES)
+    for _ in range(30):
+        assert lb.get_next_node(exclude={"a", "c"}) == "b"
+    assert lb.get_next_node(exclude=set(NODES)) is None
+
+def test_unknown_strategy_is_rejected():
+    with pytest.raises(ValueError):
+        routing.get_strategy("fastest")
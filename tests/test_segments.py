@@ -0,0 +1,84 @@
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import pytest
+
+from services.encryption import bulk, crypto, segments
+
+KEY = b"k" * 32
+
+def test_range_decrypts_only_covering_segments():
+    data = os.urandom(10 * 1000 + 7)
+    container = segments.encrypt(KEY, "key_1", data, segment_size=1000)
+    header = segments.Header.parse(container)
+
+    assert header.count == 11 and header.key_id == "key_1"
+    assert list(header.segments_for_range(1500, 3001)) == [1, 2, 3]
+    assert segments.decrypt_range(KEY, container, 1500, 3001) == data[1500:3001]
+    assert segments.decrypt_range(KEY, container) == data
+    assert segments.decrypt_range(KEY, segments.encrypt(KEY, "key_1", b"")) == b""
+
+def test_tampered_or_reordered_segments_fail():
+    container = bytearray(segments.encrypt(KEY, "key_1", b"a" * 3000, segment_size=1000))
+    header = segments.Header.parse(container)
+    seg = 1000 + segments.TAG_SIZE
+
+    tampered = bytearray(container)
+    tampered[header.cipher_offset(2)] ^= 1
+    assert segments.decrypt_range(KEY, tampered, 0, 1000) == b"a" * 1000 # Other segments still readable
+    with pytest.raises(ValueError):
+        segments.decrypt_range(KEY, tampered, 2000, 2001)
+
+    swapped = bytearray(container)
+    first, second = header.cipher_offset(0), header.cipher_offset(1)
+    swapped[first:first + seg], swapped[second:second + seg] = container[second:second + seg], container[first:first + seg]
+    with pytest.raises(ValueError):
+        segments.decrypt_range(KEY, swapped, 0, 10)
+
+@pytest.mark.parametrize("segment_size, key_len, tail", [
+    (0, 5, b"key_1"),       # would divide by zero
+    (1000, 0, b""),         # no key id
+    (1000, 40, b"key_1"),   # key id runs past the buffer
+    (1000, 2, b"\xff\xfe"),  # not UTF-8
+])
+def test_malformed_headers_are_rejected(segment_size, key_len, tail):
+    raw = segments._FIXED.pack(segments.MAGIC, segments.VERSION, segment_size, 100, b"n" * 8, key_len) + tail
+    with pytest.raises(ValueError):
+        segments.Header.parse(raw)
+    with pytest.raises(ValueError):
+        segments.decrypt_range(KEY, raw)
+
+def test_parallel_range_reads_keep_order_and_batch_fetches(monkeypatch):
+    monkeypatch.setattr(segments, "READ_BATCH", 8)
+    monkeypatch.setattr(segments, "DECRYPT_THREADS", 4)
+    data = os.urandom(100 * 1000)
+    container = segments.encrypt(KEY, "key_1", data, segment_size=1000)
+    header = segments.Header.parse(container)
+    fetched = []
+
+    def fetch(batch):
+        fetched.append(list(batch))
+        return segments.container_segments(header, container, batch)
+
+    assert b"".join(segments.iter_range(header, KEY, fetch, 2500, 30001)) == data[2500:30001]
+    assert [len(batch) for batch in fetched] == [8, 8, 8, 5]
+    assert fetched[0][0] == 2 and fetched[-1][-1] == 30
+    assert segments.is_container(container) and not segments.is_container(b"SGCMx|abc")
+
+@pytest.mark.parametrize("size", [0, 1, 300 * 1024 + 5])
+def test_bulk_file_round_trip(tmp_path, monkeypatch, size):
+    monkeypatch.setattr(crypto, "create_key_in_kms", lambda: "key_bulk")
+    fetched = []
+    monkeypatch.setattr(crypto, "get_key_from_kms", lambda key_id: fetched.append(key_id) or KEY)
+    src, enc, dec = tmp_path / "export.bin", tmp_path / "export.sgcm", tmp_path / "export.out"
+    src.write_bytes(os.urandom(size))
+
+    header = bulk.encrypt_file(str(src), str(enc), segment_size=16 * 1024, threads=4)
+    assert enc.stat().st_size == header.container_size
+    bulk.decrypt_file(str(enc), str(dec), threads=4)
+
+    assert dec.read_bytes() == src.read_bytes()
+    assert fetched == ["key_bulk", "key_bulk"] # Once per file
+    assert segments.decrypt_range(KEY, enc.read_bytes(), 5, 20) == src.read_bytes()[5:20]
@@ -0,0 +1,57 @@
+import sys
+import os
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from common import tracing
+from scripts import trace_report
+
+def test_server_span_continues_caller_trace(monkeypatch):
+    exported = []
+    monkeypatch.setattr(tracing, "TRACE_EXPORT", "file")
+    monkeypatch.setattr(tracing._exporter, "submit", exported.append)
+
+    app = FastAPI()
+    tracing.instrument_app(app, "test")
+
+    @app.get("/ping")
+    def ping():
+        with tracing.span("inner"):
+            pass
+        return {"ok": True}
+
+    parent = "00-" + "a" * 32 + "-" + "b" * 16 + "-01"
+    resp = TestClient(app).get("/ping", headers={"traceparent": parent})
+    assert resp.headers["traceparent"].startswith("00-" + "a" * 32)
+
+    by_name = {s["name"]: s for s in exported}
+    assert by_name["GET /ping"]["parent_id"] == "b" * 16
+    assert by_name["inner"]["trace_id"] == "a" * 32
+
+def test_unsampled_trace_is_not_exported(monkeypatch):
+    exported = []
+    monkeypatch.setattr(tracing, "TRACE_EXPORT", "file")
+    monkeypatch.setattr(tracing._exporter, "submit", exported.append)
+    with tracing.span("root", traceparent="00-" + "a" * 32 + "-" + "b" * 16 + "-00") as s:
+        assert tracing.inject()["traceparent"].endswith("-00")
+    assert s is not None and exported == []
+
+def span(span_id, parent_id, start, end, name=None):
+    return {"trace_id": "t", "span_id": span_id, "parent_id": parent_id, "service": "svc",
+            "name": name or span_id, "start": start, "end": end, "duration_ms": (end - start) * 1000,
+            "attrs": {}}
+
+def test_critical_path_follows_last_finishing_child():
+    spans = [
+        span("root", None, 0.0, 1.0),
+        span("fast", "root", 0.1, 0.2),
+        span("slow", "root", 0.1, 0.9),   # overlaps fast and finishes last
+        span("db", "slow", 0.2, 0.6)
+    ]
+    result = trace_report.analyze(spans)
+    path = {s["span_id"]: round(ms) for s, ms in result["path"]}
+    assert "fast" not in path
+    assert path == {"root": 200, "slow": 400, "db": 400}